@@ -1,17 +1,55 @@
 
 import json
+import logging
+import math
 import os
 import asyncio
+import struct
+import time
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from fastapi import FastAPI, Depends, HTTPException, status, Request, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Depends, HTTPException, status, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from pydantic import BaseModel
 
+try:
+    from .utils.repository import Collection
+    from .utils.storage import JsonStore, create_store
+    from .utils.location_events import LocationEventBus
+    from .utils.tracking_hub import TrackingHub
+    from .utils.token_cache import TokenCache
+    from .utils.bus_views import BusViews
+    from .utils.response_cache import ResponseCache
+    from .utils.live_locations import LiveLocationStore
+    from .utils.route_match import RouteMatcher
+    from .utils.eta import EtaEngine
+    from .utils.spatial import StopIndex
+    from .utils.stop_events import StopEventDetector
+    from .utils.stop_alerts import StopAlertIndex
+    from .utils import frames
+except ImportError:  # Running from inside backend/ (uvicorn main:app)
+    from utils.repository import Collection
+    from utils.storage import JsonStore, create_store
+    from utils.location_events import LocationEventBus
+    from utils.tracking_hub import TrackingHub
+    from utils.token_cache import TokenCache
+    from utils.bus_views import BusViews
+    from utils.response_cache import ResponseCache
+    from utils.live_locations import LiveLocationStore
+    from utils.route_match import RouteMatcher
+    from utils.eta import EtaEngine
+    from utils.spatial import StopIndex
+    from utils.stop_events import StopEventDetector
+    from utils.stop_alerts import StopAlertIndex
+    from utils import frames
+
+logger = logging.getLogger(__name__)
+
 app = FastAPI()
 
 app.add_middleware(
@@ -22,44 +60,160 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Helper function to load data from JSON files
+# Storage backend for AppState collections: "json" rewrites data/<name>.json,
+# "wal" appends each change to data/<name>.wal and compacts it into the JSON
+# snapshot in the background, "sqlite" keeps everything in a shared SQLite
+# database (data/bus_tracking.db unless BUS_TRACKING_SQLITE_PATH is set). File
+# writes are coalesced over BUS_TRACKING_PERSIST_WINDOW seconds and run on a
+# background thread; shutdown flushes anything still pending. The files live in
+# backend/data unless BUS_TRACKING_DATA_DIR points elsewhere.
+STORAGE_MODE = os.environ.get("BUS_TRACKING_STORAGE", "json")
+DATA_DIR = Path(os.environ.get("BUS_TRACKING_DATA_DIR") or Path(__file__).parent / "data")
+store = create_store(STORAGE_MODE, DATA_DIR)
+
+# Helper function to load data from the configured store
 def load_data(filename: str):
-    backend_dir = Path(__file__).parent
-    file_path = backend_dir / "data" / f"{filename}.json"
-    file_path.parent.mkdir(exist_ok=True)
-    if not file_path.exists():
-        with open(file_path, 'w') as f:
-            json.dump([], f)
-    with open(file_path, 'r') as f:
-        return json.load(f)
-
-# Helper function to save data to JSON files
+    return store.load(filename)
+
+# Helper function to save a whole collection to the configured store
 def save_data(filename: str, data):
-    backend_dir = Path(__file__).parent
-    file_path = backend_dir / "data" / f"{filename}.json"
-    file_path.parent.mkdir(exist_ok=True)
-    with open(file_path, 'w') as f:
-        json.dump(data, f, indent=4)
+    store.save(filename, data)
 
 class AppState:
-    def __init__(self):
-        self.students_db = load_data("students")
-        self.drivers_db = load_data("drivers")
-        self.buses_db = load_data("buses")
-        self.routes_db = load_data("routes")
+    def __init__(self, store: JsonStore):
+        # Loading replays any write-ahead log left behind by the last run
+        self.store = store
+        # Users resolved from access tokens, dropped whenever the user record changes
+        self.token_cache = TokenCache(
+            max_size=int(os.environ.get("BUS_TRACKING_TOKEN_CACHE_SIZE", "10000")),
+            ttl=float(os.environ.get("BUS_TRACKING_TOKEN_CACHE_TTL", "300")),
+        )
+        self.students_db = store.collection("students", unique_indexes=("student_id",), on_change=self.user_changed)
+        self.drivers_db = store.collection("drivers", unique_indexes=("username",), on_change=self.user_changed)
+        self.buses_db = store.collection("buses", indexes=("assigned_driver_id", "route_id"), on_change=self.persist)
+        self.routes_db = store.collection("routes", on_change=self.persist)
+        # Bus + route + driver joins served by the listing endpoints
+        self.views = BusViews(self.buses_db, self.routes_db, self.drivers_db)
+        # Route geometry for snapping fixes onto their route. Fixes more than
+        # BUS_TRACKING_MAX_ROUTE_OFFSET metres from it count as off route, and
+        # within BUS_TRACKING_STOP_RADIUS metres of a stop as having reached it.
+        self.matcher = RouteMatcher(
+            self.routes_db,
+            max_offset=float(os.environ.get("BUS_TRACKING_MAX_ROUTE_OFFSET", "1000")),
+            stop_radius=float(os.environ.get("BUS_TRACKING_STOP_RADIUS", "25")),
+        )
+        # Per-stop ETAs for every live bus on its route, recomputed for the
+        # fleet each tick. Buses slower than BUS_TRACKING_ETA_MIN_SPEED km/h are
+        # assumed to move at that speed.
+        self.eta = EtaEngine(self.matcher, min_speed=float(os.environ.get("BUS_TRACKING_ETA_MIN_SPEED", "10")))
+        # Route stops and live buses are indexed on a grid of
+        # BUS_TRACKING_GRID_CELL_SIZE metre cells for nearby queries
+        grid_cell_size = float(os.environ.get("BUS_TRACKING_GRID_CELL_SIZE", "500"))
+        self.stops = StopIndex(self.routes_db, cell_size=grid_cell_size)
+        # Arrival/departure events at route stops from driver fixes: a bus
+        # arrives within BUS_TRACKING_STOP_ENTER_RADIUS metres of a stop and
+        # departs beyond BUS_TRACKING_STOP_EXIT_RADIUS. The last
+        # BUS_TRACKING_STOP_EVENT_LOG_SIZE events are kept.
+        self.stop_events = StopEventDetector(
+            enter_radius=float(os.environ.get("BUS_TRACKING_STOP_ENTER_RADIUS", "40")),
+            exit_radius=float(os.environ.get("BUS_TRACKING_STOP_EXIT_RADIUS", "60")),
+            max_events=int(os.environ.get("BUS_TRACKING_STOP_EVENT_LOG_SIZE", "10000")),
+        )
+        # Students' "bus is N minutes from my stop" alerts, at most
+        # BUS_TRACKING_ALERTS_PER_USER each, using the same speed floor as ETAs
+        self.alerts = StopAlertIndex(min_speed=self.eta.min_speed,
+                                     max_per_user=int(os.environ.get("BUS_TRACKING_ALERTS_PER_USER", "20")))
+        # Encoded listing responses, keyed by the collection versions they were
+        # built from: the store's shared write counters in SQLite mode, so that
+        # every worker hands out the same ETag for the same data
+        self.response_cache = ResponseCache(shared=store.data_versions() is not None)
+        store.start()
         self.admin_db_raw = load_data("users")
         self.admin_db = {user["username"]: user for user in self.admin_db_raw if user["role"] == "admin"}
-        self.active_trips: Dict[int, Dict[str, Any]] = {}
-        self.dummy_all_bus_locations: Dict[int, Dict[str, Any]] = {
-            1: {"lat": 18.5204, "lng": 73.8567, "speed": 20, "driver_name": "Driver A", "estimated_arrival": "10:30 AM", "bus_name": "Bus 1"},
-            2: {"lat": 18.6000, "lng": 73.9000, "speed": 25, "driver_name": "Driver B", "estimated_arrival": "10:45 AM", "bus_name": "Bus 2"},
-            3: {"lat": 18.7000, "lng": 73.7000, "speed": 15, "driver_name": "Driver C", "estimated_arrival": "11:00 AM", "bus_name": "Bus 3"}
-        }
+        # Live position of every bus: simulated demo buses plus driver trips.
+        # Each bus keeps its last BUS_TRACKING_HISTORY_SIZE positions, including
+        # fixes uploaded late in a batch that never became the live position.
+        self.live = LiveLocationStore(history_size=int(os.environ.get("BUS_TRACKING_HISTORY_SIZE", "1000")), cell_size=grid_cell_size)
+        self.live.simulate(1, 18.5204, 73.8567, speed=20, driver_name="Driver A", bus_name="Bus 1")
+        self.live.simulate(2, 18.6000, 73.9000, speed=25, driver_name="Driver B", bus_name="Bus 2")
+        self.live.simulate(3, 18.7000, 73.7000, speed=15, driver_name="Driver C", bus_name="Bus 3")
+        # Shared write counters as of the last sync (SQLite mode only)
+        self.synced_versions = store.data_versions()
+        if self.synced_versions is not None:
+            self.response_cache.set_versions(self.synced_versions)
+
+    def collections(self) -> List[Any]:
+        return [self.students_db, self.drivers_db, self.buses_db, self.routes_db]
+
+    # Persist every insert, update or delete through the configured store
+    def persist(self, collection: Collection, op: str, record: Dict[str, Any]):
+        self.store.append(collection, op, record)
+        self.views.changed(collection.name, op, record)
+        self.matcher.changed(collection.name, op, record)
+        self.stops.changed(collection.name, op, record)
+        if self.synced_versions is None:
+            self.response_cache.bump(collection.name)
+        elif collection.version == self.synced_versions.get(collection.name, 0) + 1:
+            # Nobody else wrote since the last sync and the hooks above have
+            # applied this write, so there is nothing to rebuild
+            self.synced_versions[collection.name] = collection.version
+            self.response_cache.set_versions({collection.name: collection.version})
+        else:
+            # Another worker wrote to this collection in between; sync()
+            # picks up both
+            self.sync()
+
+    # With several worker processes on one SQLite database, the views and
+    # route indexes built here only see this process's writes through the
+    # change hooks. sync() compares the store's shared write counters with the
+    # last ones seen and rebuilds whatever another process may have changed.
+    # It costs one query, and nothing outside SQLite mode.
+    def sync(self):
+        if self.synced_versions is None:
+            return
+        versions = self.store.data_versions()
+        changed = {name for name, version in versions.items() if self.synced_versions.get(name) != version}
+        if not changed:
+            return
+        synced, self.synced_versions = self.synced_versions, versions
+        if changed & {"buses", "routes", "drivers"}:
+            self.views.rebuild_all()
+        if "routes" in changed:
+            self.matcher.rebuild()
+            self.stops.rebuild()
+        for name, role in (("students", "student"), ("drivers", "driver")):
+            if name not in changed:
+                continue
+            user_ids = self.store.changed_ids(name, synced.get(name, 0), versions[name])
+            if user_ids is None:
+                # Too far behind to know which users changed
+                self.token_cache.clear()
+                break
+            for user_id in user_ids:
+                self.token_cache.invalidate_user(f"{role}:{user_id}")
+        self.response_cache.set_versions(versions)
+
+    # Student and driver edits or deletions (by an admin or anyone else) also
+    # drop the cached logins of that user
+    def user_changed(self, collection: Collection, op: str, record: Dict[str, Any]):
+        self.persist(collection, op, record)
+        role = "student" if collection is self.students_db else "driver"
+        self.token_cache.invalidate_user(f"{role}:{record['id']}")
 
 def get_db(request: Request) -> AppState:
     return request.app.state.db
 
-app.state.db = AppState() # Initialize the AppState and store it in app.state.db
+# Serve a listing from the response cache, or 304 when the client's
+# If-None-Match already names the current version
+def cached_response(request: Request, key: str, depends_on: Tuple[str, ...], build: Callable[[], Any]) -> Response:
+    response_cache = request.app.state.db.response_cache
+    body, etag = response_cache.get(key, depends_on, build)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if response_cache.matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+app.state.db = AppState(store) # Initialize the AppState and store it in app.state.db
 app.state.load_data = load_data # Attach load_data utility to app.state
 app.state.save_data = save_data # Attach save_data utility to app.state
 
@@ -80,41 +234,70 @@ ensure_admin_user()
 
 # --- Start of Tracking Router (integrated) ---
 
-# In-memory dictionary to store connected WebSocket clients
-connected_clients: List[WebSocket] = []
+# Connected WebSocket clients, their bus/route topic subscriptions,
+# per-client outbound queues, connection caps and heartbeats
+tracking_hub = TrackingHub(
+    max_queue=int(os.environ.get("BUS_TRACKING_WS_QUEUE_SIZE", "32")),
+    lag_threshold=float(os.environ.get("BUS_TRACKING_WS_LAG_THRESHOLD", "5")),
+    evict_after=float(os.environ.get("BUS_TRACKING_WS_EVICT_AFTER", "30")),
+    max_connections=int(os.environ.get("BUS_TRACKING_WS_MAX_CONNECTIONS", "10000")),
+    max_per_user=int(os.environ.get("BUS_TRACKING_WS_MAX_PER_USER", "5")),
+    heartbeat_interval=float(os.environ.get("BUS_TRACKING_WS_PING_INTERVAL", "20")),
+    heartbeat_timeout=float(os.environ.get("BUS_TRACKING_WS_PING_TIMEOUT", "60")),
+)
+
+# Accepted driver fixes are pushed to WebSocket clients right away, at most once
+# per BUS_TRACKING_MIN_PUSH_INTERVAL seconds per bus (newer fixes in between are
+# coalesced)
+location_events = LocationEventBus(min_interval=float(os.environ.get("BUS_TRACKING_MIN_PUSH_INTERVAL", "0.25")))
+
+# Called for every fix, so it reads the in-memory bus views rather than the
+# store (which may be SQLite)
+def bus_route_id(bus_id: int) -> Optional[int]:
+    return (app.state.db.views.admin_buses.get(bus_id) or {}).get("route_id")
 
-# Function to simulate bus movement
+async def push_locations(locations: Dict[int, Dict[str, Any]]):
+    try:
+        await tracking_hub.publish(locations, bus_route_id)
+    except Exception:
+        logger.exception("Failed to push locations for buses %s", sorted(locations))
+
+location_events.subscribe(push_locations)
+
+# Function to simulate bus movement; each pass is also the fleet ETA tick. A
+# failing pass is logged and the loop carries on with the next one.
 async def simulate_bus_movement(app_state: Any):
     while True:
-        for bus_id in app_state.dummy_all_bus_locations:
-            if bus_id not in app_state.active_trips:
-                app_state.dummy_all_bus_locations[bus_id]["lat"] += 0.0001
-                app_state.dummy_all_bus_locations[bus_id]["lng"] += 0.0001
-        
-        message = json.dumps({"bus_locations": list(app_state.dummy_all_bus_locations.values())})
-        clients_to_remove = []
-        for client in connected_clients:
-            try:
-                await client.send_text(message)
-            except WebSocketDisconnect:
-                clients_to_remove.append(client)
-            except RuntimeError:
-                clients_to_remove.append(client)
-        for client in clients_to_remove:
-            if client in connected_clients:
-                connected_clients.remove(client)
+        try:
+            app_state.sync()
+            for location in app_state.live:
+                if location.simulated and location.trip_id is None:
+                    app_state.live.move(location, location.lat + 0.0001, location.lng + 0.0001)
+                    app_state.matcher.match_location(location, bus_route_id(location.bus_id))
+                    notify_stop_alerts(app_state, location)
+
+            app_state.eta.update(app_state.live)
+            await tracking_hub.publish(app_state.live.snapshot(), bus_route_id)
+        except Exception:
+            logger.exception("Bus simulation tick failed")
 
         await asyncio.sleep(10)
 
 @app.on_event("startup")
 async def startup_event():
     asyncio.create_task(simulate_bus_movement(app.state.db))
+    asyncio.create_task(tracking_hub.run_heartbeats())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.db.store.close()
 
 # OAuth2PasswordBearer for token extraction (from auth.py)
 SECRET_KEY = "super-secret-key"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token", auto_error=False)
 
 class Token(BaseModel):
     access_token: str
@@ -166,8 +349,15 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-# Dependency to get the current user based on the token
+# Dependency to get the current user based on the token. Verified tokens are
+# cached until they expire, so repeat requests skip the JWT decode and lookup.
 async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)):
+    request.app.state.db.sync()
+    token_cache = request.app.state.db.token_cache
+    cached_user = token_cache.get(token)
+    if cached_user is not None:
+        return cached_user
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -185,13 +375,11 @@ async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)
     
     user = None
     if token_data.role == "student":
-        students_db = request.app.state.db.students_db
-        user_data = next((s for s in students_db if s["student_id"] == token_data.username), None)
+        user_data = request.app.state.db.students_db.find_one("student_id", token_data.username)
         if user_data:
             user = {"id": user_data["id"], "student_id": user_data["student_id"], "name": user_data["name"], "role": token_data.role}
     elif token_data.role == "driver":
-        drivers_db = request.app.state.db.drivers_db
-        user_data = next((d for d in drivers_db if d["username"] == token_data.username), None)
+        user_data = request.app.state.db.drivers_db.find_one("username", token_data.username)
         if user_data:
             user = {"id": user_data["id"], "username": user_data["username"], "name": user_data["name"], "phone": user_data["phone"], "role": token_data.role}
     elif token_data.role == "admin":
@@ -202,14 +390,27 @@ async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)
 
     if user is None:
         raise credentials_exception
+    user_key = f"{token_data.role}:{user['id'] if 'id' in user else user['username']}"
+    token_cache.put(token, user, user_key, expires=payload.get("exp"))
     return user
 
+# Browsers' EventSource cannot set headers, so streaming endpoints also accept
+# the access token as ?token=
+async def get_current_user_or_query_token(request: Request, token: Optional[str] = Depends(optional_oauth2_scheme)):
+    token = token or request.query_params.get("token")
+    if not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return await get_current_user(request, token)
+
 
 # --- Start of Auth Router (integrated) ---
 @app.post("/auth/login/student", response_model=Token, tags=["Authentication"])
 async def login_student(form_data: StudentLogin, request: Request):
-    students_db = request.app.state.db.students_db
-    student = next((s for s in students_db if s["student_id"] == form_data.student_id), None)
+    student = request.app.state.db.students_db.find_one("student_id", form_data.student_id)
     if not student or student["password"] != form_data.password:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect student ID or password")
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -222,33 +423,27 @@ async def login_student(form_data: StudentLogin, request: Request):
 @app.post("/auth/register/student", tags=["Authentication"])
 async def register_student(new_student: StudentRegister, request: Request):
     students_db = request.app.state.db.students_db
-    if any(s["student_id"] == new_student.student_id for s in students_db):
+    if students_db.exists("student_id", new_student.student_id):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Student ID already registered")
     
-    new_id = max([s["id"] for s in students_db]) + 1 if students_db else 1
-    
     student_data = new_student.dict()
-    student_data["id"] = new_id
+    student_data["id"] = students_db.next_id()
     
-    students_db.append(student_data)
-    request.app.state.save_data("students", students_db)
+    students_db.insert(student_data)
     
     return {"message": "Student registered successfully", "student_id": student_data["student_id"], "name": student_data["name"], "id": student_data["id"]}
 
 @app.post("/auth/register/driver", tags=["Authentication"])
 async def register_driver(new_driver: DriverRegister, request: Request):
     drivers_db = request.app.state.db.drivers_db
-    if any(d["username"] == new_driver.username for d in drivers_db):
+    if drivers_db.exists("username", new_driver.username):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already registered as a driver")
     
-    new_id = max([d["id"] for d in drivers_db]) + 1 if drivers_db else 1
-    
     driver_data = new_driver.dict()
-    driver_data["id"] = new_id
+    driver_data["id"] = drivers_db.next_id()
     driver_data["role"] = "driver"
     
-    drivers_db.append(driver_data)
-    request.app.state.save_data("drivers", drivers_db)
+    drivers_db.insert(driver_data)
     
     return {"message": "Driver registered successfully", "username": driver_data["username"], "name": driver_data["name"], "id": driver_data["id"]}
 
@@ -271,8 +466,7 @@ async def register_admin(new_admin: AdminRegister, request: Request):
 
 @app.post("/auth/login/driver", response_model=dict, tags=["Authentication"])
 async def login_driver(form_data: DriverLogin, request: Request):
-    drivers_db = request.app.state.db.drivers_db
-    driver = next((d for d in drivers_db if d["username"] == form_data.username), None)
+    driver = request.app.state.db.drivers_db.find_one("username", form_data.username)
     if not driver or driver["password"] != form_data.password:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect username or password")
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -308,37 +502,15 @@ async def get_all_buses(request: Request, current_user: Any = Depends(get_curren
     if current_user["role"] != "student":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to access this resource")
 
-    buses_db = request.app.state.db.buses_db
-    routes_db = request.app.state.db.routes_db
-    drivers_db = request.app.state.db.drivers_db
-    
-    buses_info = []
-    for bus in buses_db:
-        route_id = bus.get("route_id") # Safely get route_id
-        route = next((r for r in routes_db if r["id"] == route_id), None)
-        driver_id = bus.get("assigned_driver_id") # Corrected to assigned_driver_id
-        driver = next((d for d in drivers_db if d["id"] == driver_id), None)
-        
-        bus_data = {
-            "id": bus["id"],
-            "name": bus["bus_number"],
-            "route_name": route.get("name") if route else "N/A", # Safely access route name
-            "start_time": bus.get("departure_time", "9:00 AM"),
-            "stops": route.get("stops") if route else [], # Safely access stops
-            "driver_name": driver.get("name") if driver else "N/A", # Safely access driver name
-            "bus_number": bus.get("bus_number", f"GIT-{str(bus["id"]).zfill(3)}"), # Ensure bus_number is always present
-            "capacity": bus.get("capacity", 40) # Ensure capacity is always present
-        }
-        buses_info.append(bus_data)
-    return buses_info
+    views = request.app.state.db.views
+    return cached_response(request, "students/buses", ("buses", "routes", "drivers"), views.student_bus_list)
 
 @app.get("/students/{student_id}", tags=["Students"])
 async def get_student_details(student_id: str, request: Request, current_user: Any = Depends(get_current_user)):
     if current_user["role"] != "student" and current_user["student_id"] != student_id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to access this resource")
 
-    students_db = request.app.state.db.students_db
-    student = next((s for s in students_db if s["student_id"] == student_id), None)
+    student = request.app.state.db.students_db.find_one("student_id", student_id)
 
     if not student:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Student not found")
@@ -348,7 +520,7 @@ async def get_student_details(student_id: str, request: Request, current_user: A
     # Or, if student object itself has an 'assigned_bus_id', use that.
     assigned_bus_id = student.get("assigned_bus_id", None)
     if assigned_bus_id is None and request.app.state.db.buses_db:
-        assigned_bus_id = request.app.state.db.buses_db[0]["id"] # Default to first bus if not explicitly assigned
+        assigned_bus_id = request.app.state.db.buses_db.first()["id"] # Default to first bus if not explicitly assigned
 
     return {"student_id": student["student_id"], "name": student["name"], "assigned_bus_id": assigned_bus_id}
 
@@ -357,29 +529,9 @@ async def get_bus_details(bus_id: int, request: Request, current_user: Any = Dep
     if current_user["role"] != "student":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to access this resource")
 
-    buses_db = request.app.state.db.buses_db
-    routes_db = request.app.state.db.routes_db
-    drivers_db = request.app.state.db.drivers_db
-
-    bus = next((b for b in buses_db if b["id"] == bus_id), None)
-    if not bus:
+    bus_data = request.app.state.db.views.student_buses.get(bus_id)
+    if bus_data is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Bus not found")
-    
-    route_id = bus.get("route_id")
-    route = next((r for r in routes_db if r["id"] == route_id), None)
-    driver_id = bus.get("assigned_driver_id")
-    driver = next((d for d in drivers_db if d["id"] == driver_id), None)
-
-    bus_data = {
-        "id": bus["id"],
-        "name": bus.get("bus_number", f"GIT-{str(bus["id"]).zfill(3)}"), # Use bus_number and default
-        "route_name": route.get("name") if route else "N/A", # Safely access route name
-        "start_time": bus.get("departure_time", "9:00 AM"), # Safely access departure time
-        "stops": route.get("stops") if route else [], # Safely access stops
-        "driver_name": driver.get("name") if driver else "N/A", # Safely access driver name
-        "bus_number": bus.get("bus_number", f"KA{bus_id}ABC"), # Default if not present
-        "capacity": bus.get("capacity", 40) # Default capacity
-    }
     return bus_data
 
 @app.get("/students/track/{bus_id}", tags=["Students"])
@@ -387,11 +539,103 @@ async def track_bus(bus_id: int, request: Request, current_user: Any = Depends(g
     if current_user["role"] != "student":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to access this resource")
 
-    dummy_all_bus_locations = request.app.state.db.dummy_all_bus_locations
-    if bus_id not in dummy_all_bus_locations:
+    location = request.app.state.db.live.get(bus_id)
+    if location is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Bus not found or not currently tracking")
     
-    return dummy_all_bus_locations[bus_id]
+    return location.to_dict()
+
+# Route stops within ?radius= metres of a point, nearest first, each with the
+# routes that serve it
+NEARBY_MAX_RADIUS = float(os.environ.get("BUS_TRACKING_NEARBY_MAX_RADIUS", "5000"))
+NEARBY_MAX_RESULTS = int(os.environ.get("BUS_TRACKING_NEARBY_MAX_RESULTS", "50"))
+
+@app.get("/students/nearby/stops", tags=["Students"])
+async def get_nearby_stops(lat: float, lng: float, request: Request, radius: float = 500, limit: int = 20,
+                           current_user: Any = Depends(get_current_user)):
+    if current_user["role"] != "student":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to access this resource")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid coordinates")
+    if not math.isfinite(radius):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid radius")
+
+    radius = min(max(radius, 0), NEARBY_MAX_RADIUS)
+    limit = min(max(limit, 0), NEARBY_MAX_RESULTS)
+    return {"stops": request.app.state.db.stops.near(lat, lng, radius, limit)}
+
+# "Bus is N minutes from my stop" alerts. A subscription fires each time the
+# bus heads for the stop, once its ETA there drops to `minutes` or below, and is
+# delivered as a {"type": "stop_alert", ...} message on the student's tracking
+# WebSockets (connected with ?token=) and on /students/alerts/stream.
+class StopAlertCreate(BaseModel):
+    bus_id: int
+    stop_index: int
+    minutes: float
+
+def student_key(current_user: Dict[str, Any]) -> str:
+    # The key tracking WebSockets register under for the same student
+    if current_user["role"] != "student":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to access this resource")
+    return f"student:{current_user['student_id']}"
+
+@app.post("/students/alerts/subscriptions", tags=["Students"])
+async def create_stop_alert(alert: StopAlertCreate, request: Request, current_user: Any = Depends(get_current_user)):
+    user_key = student_key(current_user)
+    app_state = request.app.state.db
+    bus = app_state.buses_db.get(alert.bus_id)
+    if bus is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Bus not found")
+    geometry = app_state.matcher.geometries.get(bus.get("route_id"))
+    if geometry is None or not 0 <= alert.stop_index < len(geometry.names):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unknown stop for this bus")
+    if not 0 < alert.minutes <= 120:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="minutes must be between 0 and 120")
+    try:
+        created = app_state.alerts.add(user_key, alert.bus_id, alert.stop_index, alert.minutes)
+    except ValueError as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc))
+    # The bus may already be within the threshold
+    location = app_state.live.get(alert.bus_id)
+    if location is not None and location.trip_id is not None:
+        notify_stop_alerts(app_state, location)
+    return {**created.to_dict(), "stop_name": geometry.names[alert.stop_index]}
+
+@app.get("/students/alerts/subscriptions", tags=["Students"])
+async def list_stop_alerts(request: Request, current_user: Any = Depends(get_current_user)):
+    alerts = request.app.state.db.alerts.for_user(student_key(current_user))
+    return {"alerts": [alert.to_dict() for alert in alerts]}
+
+@app.delete("/students/alerts/subscriptions/{alert_id}", tags=["Students"])
+async def delete_stop_alert(alert_id: int, request: Request, current_user: Any = Depends(get_current_user)):
+    if not request.app.state.db.alerts.remove(student_key(current_user), alert_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Alert not found")
+    return {"message": "Alert deleted successfully"}
+
+# Server-sent "stop_alert" events for the signed-in student, ids
+# <epoch>:<notification id>; a reconnect with Last-Event-ID gets the alerts it
+# missed while they are still among the student's recent ones
+@app.get("/students/alerts/stream", tags=["Students"])
+async def stream_stop_alerts(request: Request, current_user: Any = Depends(get_current_user_or_query_token)):
+    user_key = student_key(current_user)
+    alerts = request.app.state.db.alerts
+
+    async def events():
+        sent = last_event_seq(request, alerts.epoch)
+        if sent is None or sent > alerts.last_id:
+            sent = alerts.last_id
+        yield "retry: 3000\n\n"
+        while not await request.is_disconnected():
+            pending = alerts.pending(user_key, sent)
+            if pending:
+                for notification in pending:
+                    yield f"id: {alerts.epoch}:{notification['id']}\nevent: stop_alert\ndata: {json.dumps(notification)}\n\n"
+                sent = pending[-1]["id"]
+            elif not await alerts.wait_for_alert(user_key, sent, SSE_KEEPALIVE):
+                yield ": keepalive\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 # --- Start of Driver Router (integrated) ---
@@ -399,6 +643,15 @@ class UpdateLocation(BaseModel):
     latitude: float
     longitude: float
 
+class TimedLocation(BaseModel):
+    seq: int
+    latitude: float
+    longitude: float
+    timestamp: float  # Unix seconds when the fix was taken
+
+class UpdateLocationBatch(BaseModel):
+    fixes: List[TimedLocation]
+
 class BusDetailsResponse(BaseModel):
     id: int
     bus_number: str
@@ -418,54 +671,22 @@ class DriverDashboardResponse(BaseModel):
 
 @app.get("/driver/my_bus", response_model=BusDetailsResponse, tags=["Driver"])
 async def get_my_bus(request: Request, current_user: Any = Depends(get_current_user)):
-    print(f"Accessing /driver/my_bus endpoint. Current User: {current_user}")
     if current_user["role"] != "driver":
-        print(f"Forbidden access to /driver/my_bus for role: {current_user["role"]}")
+        logger.warning("Forbidden access to /driver/my_bus for role %s", current_user["role"])
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to access this resource")
     
     driver_id = current_user.get("id")
-    print(f"Extracted driver_id from token: {driver_id}")
     if not driver_id:
-        print("Error: Driver ID not found in token.")
+        logger.warning("Driver ID not found in token")
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Driver ID not found in token")
     
-    buses_db = request.app.state.db.buses_db
-    routes_db = request.app.state.db.routes_db
-
-    print(f"Searching for bus assigned to driver_id: {driver_id}")
-    print(f"Current buses_db: {buses_db}")
-    assigned_bus = next((b for b in buses_db if b.get("assigned_driver_id") == driver_id), None)
-    if not assigned_bus:
-        print(f"Error: No bus assigned to driver_id: {driver_id}")
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No bus assigned to this driver.")
-    
-    print(f"Found assigned bus: {assigned_bus}")
-    print(f"Current routes_db: {routes_db}")
-    route = next((r for r in routes_db if r["id"] == assigned_bus.get("route_id")), None)
-    if not route:
-        print(f"Error: Route not found for assigned bus: {assigned_bus.get("route_id")}")
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Route not found for assigned bus.")
-
-    print(f"Found route: {route}")
-
-    first_stop_lat = route["stops"][0]["lat"] if route["stops"] else None
-    first_stop_lng = route["stops"][0]["lng"] if route["stops"] else None
-
-    if first_stop_lat is None or first_stop_lng is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Route stops with coordinates not found.")
-
-    return {
-        "id": assigned_bus.get("id"),
-        "bus_number": assigned_bus.get("bus_number"),
-        "route_name": route.get("name"),
-        "starting_point": assigned_bus.get("starting_point"),
-        "departure_time": assigned_bus.get("departure_time"),
-        "estimated_arrival": assigned_bus.get("estimated_arrival"),
-        "route_stops": route.get("stops"),
-        "latitude": first_stop_lat,
-        "longitude": first_stop_lng,
-        "capacity": assigned_bus.get("capacity", 0)
-    }
+    views = request.app.state.db.views
+    bus_details = views.driver_buses.get(driver_id)
+    if bus_details is None:
+        detail = views.driver_errors.get(driver_id, "No bus assigned to this driver.")
+        logger.debug("No bus for driver %s: %s", driver_id, detail)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=detail)
+    return bus_details
 
 @app.post("/driver/trip/start", tags=["Driver"])
 async def start_trip(request: Request, current_user: Any = Depends(get_current_user)):
@@ -473,16 +694,27 @@ async def start_trip(request: Request, current_user: Any = Depends(get_current_u
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to access this resource")
     
     driver_id = current_user["id"]
-    active_trips = request.app.state.db.active_trips
-    if driver_id in active_trips:
+    app_state = request.app.state.db
+    if app_state.live.for_driver(driver_id) is not None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Trip already active for this driver")
 
-    assigned_bus_data = await get_my_bus(request, current_user)
+    views = app_state.views
+    assigned_bus_data = views.driver_buses.get(driver_id)
+    if assigned_bus_data is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=views.driver_errors.get(driver_id, "No bus assigned to this driver."))
     start_lat = assigned_bus_data["latitude"]
     start_lng = assigned_bus_data["longitude"]
     bus_id = assigned_bus_data["id"]
+    if app_state.live.on_trip(bus_id):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="This bus is already on a trip")
     
-    active_trips[driver_id] = {"latitude": start_lat, "longitude": start_lng, "bus_id": bus_id}
+    location = app_state.live.start_trip(bus_id, driver_id, start_lat, start_lng, driver_name=current_user["name"],
+                                         bus_name=assigned_bus_data.get("bus_number") or f"Bus {bus_id}")
+    app_state.matcher.match_location(location, bus_route_id(bus_id))
+    observe_stops(app_state, location)
+    notify_stop_alerts(app_state, location)
+    app_state.eta.update([location])
+    location_events.publish(bus_id, location.to_dict())
     return {"message": "Trip started successfully", "initial_location": {"latitude": start_lat, "longitude": start_lng}}
 
 @app.post("/driver/trip/update", tags=["Driver"])
@@ -491,25 +723,165 @@ async def update_trip_location(location: UpdateLocation, request: Request, curre
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to access this resource")
     
     driver_id = current_user["id"]
-    active_trips = request.app.state.db.active_trips
-    if driver_id not in active_trips:
+    if apply_driver_fix(request.app.state.db, driver_id, location.latitude, location.longitude) is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No active trip for this driver. Start a trip first.")
-    
-    active_trips[driver_id]["latitude"] = location.latitude
-    active_trips[driver_id]["longitude"] = location.longitude
     return {"message": "Location updated successfully", "current_location": location.dict()}
 
+# Fixes buffered while the driver was out of coverage, uploaded in one request.
+# Entries at or below the trip's highest seq so far (duplicates, replays,
+# stragglers) are dropped; the rest go into the bus history and only the newest
+# one becomes the live position, unless a live fix taken later already has.
+# Timestamps come from the phone's clock: fixes dated up to a day ahead are
+# clamped to BUS_TRACKING_MAX_FIX_SKEW seconds from now, and fixes further out
+# (such as milliseconds from JavaScript's Date.now()), non-positive timestamps
+# and out-of-range coordinates are rejected.
+MAX_FIX_SKEW = float(os.environ.get("BUS_TRACKING_MAX_FIX_SKEW", "5"))
+
+def fix_timestamp(fix: TimedLocation, now: float) -> Optional[float]:
+    # The timestamp to record for a batch fix, or None to reject it
+    if not (-90 <= fix.latitude <= 90 and -180 <= fix.longitude <= 180):
+        return None
+    if not math.isfinite(fix.timestamp) or fix.timestamp <= 0 or fix.timestamp > now + 86400:
+        return None
+    return min(fix.timestamp, now + MAX_FIX_SKEW)
+
+@app.post("/driver/trip/update/batch", tags=["Driver"])
+async def update_trip_location_batch(batch: UpdateLocationBatch, request: Request, current_user: Any = Depends(get_current_user)):
+    if current_user["role"] != "driver":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to access this resource")
+
+    driver_id = current_user["id"]
+    app_state = request.app.state.db
+    trip = app_state.live.for_driver(driver_id)
+    if trip is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No active trip for this driver. Start a trip first.")
+
+    last_seq = trip.last_seq
+    accepted = []
+    rejected = 0
+    now = time.time()
+    geometry = app_state.matcher.geometries.get(bus_route_id(trip.bus_id))
+    for fix in sorted(batch.fixes, key=lambda fix: fix.seq):
+        if fix.seq <= last_seq:
+            continue
+        timestamp = fix_timestamp(fix, now)
+        if timestamp is None:
+            rejected += 1
+            continue
+        last_seq = fix.seq
+        accepted.append((fix, timestamp))
+        trip.history.add(timestamp, fix.latitude, fix.longitude)
+        # Stops passed while offline still get their events, with the fix times
+        app_state.stop_events.observe(trip.bus_id, geometry, fix.latitude, fix.longitude, timestamp, trip_id=trip.trip_id)
+    trip.last_seq = last_seq
+
+    if accepted and accepted[-1][1] >= trip.timestamp:
+        newest, timestamp = accepted[-1]
+        apply_driver_fix(app_state, driver_id, newest.latitude, newest.longitude, timestamp=timestamp, record=False)
+    return {
+        "message": "Locations updated successfully",
+        "accepted": len(accepted),
+        "dropped": len(batch.fixes) - len(accepted),
+        "rejected": rejected,
+        "last_seq": last_seq,
+        "current_location": {"latitude": trip.lat, "longitude": trip.lng, "timestamp": trip.timestamp},
+    }
+
+# Record a fix for the driver's active trip and push it to tracking clients;
+# returns None when the driver has no active trip
+def apply_driver_fix(app_state: Any, driver_id: int, latitude: float, longitude: float,
+                     timestamp: Optional[float] = None, record: bool = True) -> Optional[Any]:
+    trip = app_state.live.for_driver(driver_id)
+    if trip is None:
+        return None
+    app_state.live.move(trip, latitude, longitude, timestamp, record=record)
+    app_state.matcher.match_location(trip, bus_route_id(trip.bus_id))
+    observe_stops(app_state, trip)
+    notify_stop_alerts(app_state, trip)
+    location_events.publish(trip.bus_id, trip.to_dict())
+    return trip
+
+# Check a trip's current position against the geofences of its upcoming stops
+def observe_stops(app_state: Any, trip: Any):
+    match = trip.match
+    if match is None:
+        app_state.stop_events.forget(trip.bus_id)
+        return
+    next_index = match.next_index if match.on_route else None
+    app_state.stop_events.observe(trip.bus_id, match.geometry, trip.lat, trip.lng, trip.timestamp,
+                                  next_index=next_index, trip_id=trip.trip_id)
+
+# Fire the stop alerts this position triggers and push them to the students'
+# tracking WebSockets (alert streams pick them up from the outboxes)
+def notify_stop_alerts(app_state: Any, location: Any):
+    for user_key, notification in app_state.alerts.check(location):
+        tracking_hub.send_to_user(user_key, json.dumps(notification))
+
+# Identify the driver behind a WebSocket from ?token=<access token>
+def websocket_driver(websocket: WebSocket) -> Optional[Dict[str, Any]]:
+    token = websocket.query_params.get("token")
+    if not token:
+        return None
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    if payload.get("role") != "driver" or payload.get("sub") is None:
+        return None
+    return websocket.app.state.db.drivers_db.find_one("username", payload["sub"])
+
+# Long-lived alternative to POST /driver/trip/update: the token is checked once
+# at connect time, then each message is one compact fix for the driver's active
+# trip (see utils/frames.py) answered with a small ack
+@app.websocket("/driver/ws/location")
+async def websocket_driver_location(websocket: WebSocket):
+    driver = websocket_driver(websocket)
+    if driver is None:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    app_state = websocket.app.state.db
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            binary = message.get("bytes") is not None
+            try:
+                seq, latitude, longitude = frames.parse_driver_fix(message["bytes"] if binary else message.get("text") or "")
+            except ValueError:
+                await websocket.send_text(json.dumps({"type": "error", "detail": "Invalid location frame"}))
+                continue
+            if apply_driver_fix(app_state, driver["id"], latitude, longitude) is None:
+                await websocket.send_text(json.dumps({"type": "error", "seq": seq, "detail": "No active trip for this driver. Start a trip first."}))
+                continue
+            ack = frames.driver_ack(seq, binary)
+            if binary:
+                await websocket.send_bytes(ack)
+            else:
+                await websocket.send_text(ack)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+
 @app.post("/driver/trip/end", tags=["Driver"])
 async def end_trip(request: Request, current_user: Any = Depends(get_current_user)):
     if current_user["role"] != "driver":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to access this resource")
     
     driver_id = current_user["id"]
-    active_trips = request.app.state.db.active_trips
-    if driver_id not in active_trips:
+    app_state = request.app.state.db
+    trip = app_state.live.end_trip(driver_id)
+    if trip is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No active trip to end for this driver")
     
-    del active_trips[driver_id]
+    app_state.eta.forget(trip.bus_id)
+    app_state.stop_events.forget(trip.bus_id)
+    app_state.alerts.rearm(trip.bus_id)
+    # Deliver the trip's last fix before the bus leaves the map; simulated
+    # buses stay on it and go back to being simulated
+    await location_events.finish(trip.bus_id)
+    if app_state.live.get(trip.bus_id) is None:
+        tracking_hub.remove(trip.bus_id)
     return {"message": "Trip ended successfully"}
 
 
@@ -582,143 +954,121 @@ async def get_admin_stats(request: Request, current_user: Any = Depends(get_admi
         "total_students": len(request.app.state.db.students_db),
     }
 
+@app.get("/admin/tracking/clients", tags=["Admin"])
+async def get_tracking_clients(current_user: Any = Depends(get_admin_user)):
+    return tracking_hub.stats()
+
+@app.get("/admin/auth/token_cache", tags=["Admin"])
+async def get_token_cache_stats(request: Request, current_user: Any = Depends(get_admin_user)):
+    return request.app.state.db.token_cache.stats()
+
+@app.get("/admin/response_cache", tags=["Admin"])
+async def get_response_cache_stats(request: Request, current_user: Any = Depends(get_admin_user)):
+    return request.app.state.db.response_cache.stats()
+
+@app.get("/admin/eta", tags=["Admin"])
+async def get_eta_stats(request: Request, current_user: Any = Depends(get_admin_user)):
+    app_state = request.app.state.db
+    return {**app_state.eta.stats(), "matcher": app_state.matcher.stats(), "stop_events": app_state.stop_events.stats()}
+
+@app.get("/admin/alerts", tags=["Admin"])
+async def get_alert_stats(request: Request, current_user: Any = Depends(get_admin_user)):
+    return request.app.state.db.alerts.stats()
+
 @app.get("/admin/buses", tags=["Admin"])
 async def get_all_buses_admin(request: Request, current_user: Any = Depends(get_admin_user)):
-    buses_with_details = []
-    for bus in request.app.state.db.buses_db:
-        driver = next((d for d in request.app.state.db.drivers_db if d.get("id") == bus.get("assigned_driver_id")), None)
-        route = next((r for r in request.app.state.db.routes_db if r.get("id") == bus.get("route_id")), None)
-        bus_details = {
-            **bus,
-            "driver_name": driver["name"] if driver else "N/A",
-            "route_name": route["name"] if route else "N/A",
-        }
-        buses_with_details.append(bus_details)
-    return buses_with_details
+    views = request.app.state.db.views
+    return cached_response(request, "admin/buses", ("buses", "routes", "drivers"), views.admin_bus_list)
 
 @app.post("/admin/buses", tags=["Admin"])
 async def add_bus(bus: BusCreate, request: Request, current_user: Any = Depends(get_admin_user)):
     buses_db = request.app.state.db.buses_db
-    new_id = max([b["id"] for b in buses_db]) + 1 if buses_db else 1
     new_bus = bus.dict()
-    new_bus["id"] = new_id
-    buses_db.append(new_bus)
-    request.app.state.save_data("buses", buses_db)
+    new_bus["id"] = buses_db.next_id()
+    buses_db.insert(new_bus)
     return new_bus
 
 @app.put("/admin/buses/{bus_id}", tags=["Admin"])
 async def update_bus(bus_id: int, bus_update: BusUpdate, request: Request, current_user: Any = Depends(get_admin_user)):
     buses_db = request.app.state.db.buses_db
     routes_db = request.app.state.db.routes_db
-    bus_found = False
-    for idx, bus in enumerate(buses_db):
-        if bus["id"] == bus_id:
-            updated_bus_data = bus.copy()
-            updated_bus_data.update(bus_update.dict(exclude_unset=True, exclude={'route_stops'}))
-            
-            if bus_update.route_stops is not None:
-                route_id_to_update = updated_bus_data.get("route_id")
-                if route_id_to_update:
-                    route_found = False
-                    for r_idx, route in enumerate(routes_db):
-                        if route["id"] == route_id_to_update:
-                            updated_route = route.copy()
-                            updated_route["stops"] = [stop.dict() for stop in bus_update.route_stops]
-                            routes_db[r_idx] = updated_route
-                            request.app.state.save_data("routes", routes_db)
-                            route_found = True
-                            break
-                    if not route_found:
-                        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Route with ID {route_id_to_update} not found for bus update")
-
-            buses_db[idx] = updated_bus_data
-            request.app.state.save_data("buses", buses_db)
-            bus_found = True
-            return updated_bus_data
-    if not bus_found:
+    bus = buses_db.get(bus_id)
+    if not bus:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Bus not found")
 
+    bus_changes = bus_update.dict(exclude_unset=True, exclude={'route_stops'})
+    if bus_update.route_stops is not None:
+        route_id_to_update = bus_changes.get("route_id", bus.get("route_id"))
+        if route_id_to_update:
+            if routes_db.get(route_id_to_update) is None:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Route with ID {route_id_to_update} not found for bus update")
+            routes_db.update(route_id_to_update, {"stops": [stop.dict() for stop in bus_update.route_stops]})
+
+    return buses_db.update(bus_id, bus_changes)
+
 @app.delete("/admin/buses/{bus_id}", tags=["Admin"])
 async def delete_bus(bus_id: int, request: Request, current_user: Any = Depends(get_admin_user)):
-    buses_db = request.app.state.db.buses_db
-    initial_len = len(buses_db)
-    request.app.state.db.buses_db = [bus for bus in buses_db if bus["id"] != bus_id]
-    if len(request.app.state.db.buses_db) == initial_len:
+    app_state = request.app.state.db
+    if app_state.buses_db.delete(bus_id) is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Bus not found")
-    request.app.state.save_data("buses", request.app.state.db.buses_db)
+    # A deleted bus stops being tracked, mid-trip or not
+    app_state.live.remove(bus_id)
+    app_state.eta.forget(bus_id)
+    app_state.stop_events.forget(bus_id)
+    await location_events.finish(bus_id)
+    tracking_hub.remove(bus_id)
     return {"message": "Bus deleted successfully"}
 
 @app.get("/admin/drivers", tags=["Admin"])
 async def get_all_drivers(request: Request, current_user: Any = Depends(get_admin_user)):
     drivers_db = request.app.state.db.drivers_db
-    return [{k: v for k, v in driver.items() if k != "password"} for driver in drivers_db]
+    return cached_response(request, "admin/drivers", ("drivers",),
+                           lambda: [{k: v for k, v in driver.items() if k != "password"} for driver in drivers_db])
 
 @app.post("/admin/drivers/add", tags=["Admin"])
 async def add_driver(driver: DriverCreate, request: Request, current_user: Any = Depends(get_admin_user)):
     drivers_db = request.app.state.db.drivers_db
-    new_id = max([d["id"] for d in drivers_db]) + 1 if drivers_db else 1
     new_driver = driver.dict()
-    new_driver["id"] = new_id
-    drivers_db.append(new_driver)
-    request.app.state.save_data("drivers", drivers_db)
+    new_driver["id"] = drivers_db.next_id()
+    drivers_db.insert(new_driver)
     return {k: v for k, v in new_driver.items() if k != "password"}
 
 @app.put("/admin/drivers/{driver_id}", tags=["Admin"])
 async def update_driver(driver_id: int, driver_update: DriverUpdate, request: Request, current_user: Any = Depends(get_admin_user)):
-    drivers_db = request.app.state.db.drivers_db
-    for idx, driver in enumerate(drivers_db):
-        if driver["id"] == driver_id:
-            updated_driver = driver.copy()
-            updated_driver.update(driver_update.dict(exclude_unset=True))
-            drivers_db[idx] = updated_driver
-            request.app.state.save_data("drivers", drivers_db)
-            return {k: v for k, v in updated_driver.items() if k != "password"}
-    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Driver not found")
+    updated_driver = request.app.state.db.drivers_db.update(driver_id, driver_update.dict(exclude_unset=True))
+    if updated_driver is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Driver not found")
+    return {k: v for k, v in updated_driver.items() if k != "password"}
 
 @app.delete("/admin/drivers/{driver_id}", tags=["Admin"])
 async def delete_driver(driver_id: int, request: Request, current_user: Any = Depends(get_admin_user)):
-    drivers_db = request.app.state.db.drivers_db
-    initial_len = len(drivers_db)
-    request.app.state.db.drivers_db = [driver for driver in drivers_db if driver["id"] != driver_id]
-    if len(request.app.state.db.drivers_db) == initial_len:
+    if request.app.state.db.drivers_db.delete(driver_id) is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Driver not found")
-    request.app.state.save_data("drivers", request.app.state.db.drivers_db)
     return {"message": "Driver deleted successfully"}
 
 @app.get("/admin/routes", tags=["Admin"])
 async def get_all_routes(request: Request, current_user: Any = Depends(get_admin_user)):
-    return request.app.state.db.routes_db
+    return cached_response(request, "admin/routes", ("routes",), request.app.state.db.routes_db.to_list)
 
 @app.post("/admin/routes/add", tags=["Admin"])
 async def add_route(route: RouteCreate, request: Request, current_user: Any = Depends(get_admin_user)):
     routes_db = request.app.state.db.routes_db
-    new_id = max([r["id"] for r in routes_db]) + 1 if routes_db else 1
     new_route = route.dict()
-    new_route["id"] = new_id
-    routes_db.append(new_route)
-    request.app.state.save_data("routes", routes_db)
+    new_route["id"] = routes_db.next_id()
+    routes_db.insert(new_route)
     return new_route
 
 @app.put("/admin/routes/{route_id}", tags=["Admin"])
 async def update_route(route_id: int, route_update: RouteUpdate, request: Request, current_user: Any = Depends(get_admin_user)):
-    routes_db = request.app.state.db.routes_db
-    for idx, route in enumerate(routes_db):
-        if route["id"] == route_id:
-            updated_route = route.copy()
-            updated_route.update(route_update.dict(exclude_unset=True))
-            routes_db[idx] = updated_route
-            request.app.state.save_data("routes", routes_db)
-            return updated_route
-    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Route not found")
+    updated_route = request.app.state.db.routes_db.update(route_id, route_update.dict(exclude_unset=True))
+    if updated_route is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Route not found")
+    return updated_route
 
 @app.delete("/admin/routes/{route_id}", tags=["Admin"])
 async def delete_route(route_id: int, request: Request, current_user: Any = Depends(get_admin_user)):
-    routes_db = request.app.state.db.routes_db
-    initial_len = len(routes_db)
-    request.app.state.db.routes_db = [route for route in routes_db if route["id"] != route_id]
-    if len(request.app.state.db.routes_db) == initial_len:
+    if request.app.state.db.routes_db.delete(route_id) is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Route not found")
-    request.app.state.save_data("routes", request.app.state.db.routes_db)
     return {"message": "Route deleted successfully"}
 
 
@@ -728,64 +1078,249 @@ async def read_root():
     return {"message": "Welcome to the College Bus Tracking API"}
 
 # --- Tracking Endpoints (integrated) ---
-@app.get("/tracking/bus/{bus_id}", tags=["Tracking"])
-async def get_bus_current_location(bus_id: int, request: Request, current_user: Any = Depends(get_current_user)):
-    active_trips = request.app.state.db.active_trips
-    dummy_all_bus_locations = request.app.state.db.dummy_all_bus_locations
-    drivers_db = request.app.state.db.drivers_db
+# Live locations are served from the tracking hub, the same state WebSocket
+# clients see, and versioned by the seq of each bus's latest change (the "seq"
+# field). Polling clients can send If-None-Match, or ?since=<seq>&wait=<seconds>
+# to hold the request until the location moves past that seq; a request that
+# ends with nothing new gets a 304.
+LONG_POLL_MAX_WAIT = float(os.environ.get("BUS_TRACKING_LONG_POLL_MAX_WAIT", "30"))
+
+async def wait_for_location(since: Optional[int], wait: float, bus_id: Optional[int] = None):
+    if since is not None and wait > 0:
+        await tracking_hub.wait_for_change(since, bus_id, min(wait, LONG_POLL_MAX_WAIT))
+
+def location_response(request: Request, body: bytes, etag: str, version: int, since: Optional[int],
+                      media_type: str = "application/json") -> Response:
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "X-Tracking-Version": str(version)}
+    unchanged = since is not None and version <= since <= tracking_hub.seq
+    if unchanged or request.app.state.db.response_cache.matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type=media_type, headers=headers)
 
-    if bus_id in active_trips and active_trips[bus_id].get("bus_id") == bus_id:
-        location_data = {
-            "bus_id": bus_id,
-            "lat": active_trips[bus_id]["latitude"],
-            "lng": active_trips[bus_id]["longitude"],
-            "speed": 30,
-            "driver_name": next((d["name"] for d in drivers_db if d["id"] == active_trips[bus_id].get("driver_id")), "N/A"),
-            "estimated_arrival": "Realtime Update"
-        }
-        return location_data
-    
-    if bus_id in dummy_all_bus_locations:
-        return dummy_all_bus_locations[bus_id]
+@app.get("/tracking/bus/{bus_id}", tags=["Tracking"])
+async def get_bus_current_location(bus_id: int, request: Request, since: Optional[int] = None, wait: float = 0,
+                                   current_user: Any = Depends(get_current_user)):
+    await wait_for_location(since, wait, bus_id)
+    latest = tracking_hub.latest.get(bus_id)
+    if latest is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Bus not found or not currently tracking")
+    version, fragment = latest[0], latest[3]
+    return location_response(request, fragment.encode("utf-8"), f'"{tracking_hub.epoch}-{version}"', version, since)
+
+# The ?k= live buses nearest to a point (optionally within ?radius= metres),
+# nearest first, as location payloads with their distance
+@app.get("/tracking/nearby", tags=["Tracking"])
+async def get_nearby_buses(lat: float, lng: float, request: Request, k: int = 5, radius: Optional[float] = None,
+                           current_user: Any = Depends(get_current_user)):
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid coordinates")
+    if radius is not None and not math.isfinite(radius):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid radius")
+    k = min(max(k, 0), NEARBY_MAX_RESULTS)
+    nearest = request.app.state.db.live.nearest(lat, lng, k, radius)
+    return {"buses": [{**location.to_dict(), "distance_m": round(metres, 1)} for metres, location in nearest]}
+
+# Breadcrumb trail of one bus, oldest first. With ?since=<unix time> it returns
+# the first `limit` points after that time (has_more says whether to page on);
+# without, the latest `limit` points. ?format=binary returns a uint32 count
+# followed by the timestamp, latitude and longitude columns as float64 arrays,
+# written straight from the history buffers.
+@app.get("/tracking/bus/{bus_id}/history", tags=["Tracking"])
+async def get_bus_history(bus_id: int, request: Request, since: Optional[float] = None, limit: int = 100,
+                          format: str = "json", current_user: Any = Depends(get_current_user)):
+    if format not in ("json", "binary"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown format '{format}'")
+    location = request.app.state.db.live.get(bus_id)
+    if location is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Bus not found or not currently tracking")
+    history = location.history
+    first, last = history.window(since, limit)
+    if format == "binary":
+        segments = history.segments(first, last)
+        columns = [segment[column] for column in range(3) for segment in segments]
+        return Response(content=struct.pack("<I", last - first) + b"".join(columns), media_type="application/octet-stream")
+    return {
+        "bus_id": bus_id,
+        "count": last - first,
+        "has_more": since is not None and last < len(history),
+        "points": [[timestamp, lat, lng] for timestamp, lat, lng in history.between(first, last)],
+    }
 
-    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Bus not found or not currently tracking")
+# Where the bus is along its route: its last fix snapped onto the route line,
+# the distance covered from the first stop, and the next stop
+@app.get("/tracking/bus/{bus_id}/progress", tags=["Tracking"])
+async def get_bus_progress(bus_id: int, request: Request, current_user: Any = Depends(get_current_user)):
+    location = request.app.state.db.live.get(bus_id)
+    if location is None or location.match is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Bus not found or not on a known route")
+    return {"bus_id": bus_id, **location.match.to_dict()}
+
+# Remaining distance and time to every stop still ahead of the bus, as of the
+# last ETA tick; location payloads only carry the next stop and final arrival
+@app.get("/tracking/bus/{bus_id}/eta", tags=["Tracking"])
+async def get_bus_eta(bus_id: int, request: Request, current_user: Any = Depends(get_current_user)):
+    etas = request.app.state.db.eta.stops_for(bus_id)
+    if etas is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No ETA for this bus")
+    return etas
+
+# Server-sent events for one bus: an "location" event (id <epoch>:<seq>, data
+# the same JSON as /tracking/bus/{id}) whenever the bus moves, and a comment
+# line every BUS_TRACKING_SSE_KEEPALIVE seconds so proxies keep the response
+# open. Reconnecting browsers send Last-Event-ID and only get a newer location.
+# A "remove" event says the bus has left the map (trip ended or bus deleted).
+SSE_KEEPALIVE = float(os.environ.get("BUS_TRACKING_SSE_KEEPALIVE", "15"))
+
+def last_event_seq(request: Request, current_epoch: Optional[int] = None) -> Optional[int]:
+    last_event_id = request.headers.get("last-event-id") or request.query_params.get("last_event_id")
+    try:
+        epoch, seq = (int(part) for part in (last_event_id or "").split(":"))
+    except ValueError:
+        return None
+    return seq if epoch == (tracking_hub.epoch if current_epoch is None else current_epoch) else None
+
+@app.get("/tracking/bus/{bus_id}/stream", tags=["Tracking"])
+async def stream_bus_location(bus_id: int, request: Request, current_user: Any = Depends(get_current_user_or_query_token)):
+    if bus_id not in tracking_hub.latest and bus_id not in request.app.state.db.views.admin_buses:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Bus not found")
 
+    async def events():
+        sent = last_event_seq(request)
+        yield "retry: 3000\n\n"
+        while not await request.is_disconnected():
+            latest = tracking_hub.latest.get(bus_id)
+            removed = tracking_hub.removed.get(bus_id)
+            if latest is not None and (sent is None or latest[0] > sent or sent > tracking_hub.seq):
+                sent = latest[0]
+                yield f"id: {tracking_hub.epoch}:{sent}\nevent: location\ndata: {latest[3]}\n\n"
+            elif removed is not None and (sent is None or removed[0] > sent or sent > tracking_hub.seq):
+                sent = removed[0]
+                yield f"id: {tracking_hub.epoch}:{sent}\nevent: remove\ndata: {json.dumps({'bus_id': bus_id})}\n\n"
+            elif not await tracking_hub.wait_for_change(sent or 0, bus_id, SSE_KEEPALIVE):
+                yield ": keepalive\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Stop arrival and departure events, oldest first. With ?since=<event id> they
+# are the events after it (optionally waiting up to ?wait= seconds for one);
+# without, the latest `limit`. Filter with ?bus_id=, ?route_id= and ?stop_index=.
+@app.get("/tracking/stop_events", tags=["Tracking"])
+async def get_stop_events(request: Request, since: Optional[int] = None, wait: float = 0, bus_id: Optional[int] = None,
+                          route_id: Optional[int] = None, stop_index: Optional[int] = None, limit: int = 100,
+                          current_user: Any = Depends(get_current_user)):
+    detector = request.app.state.db.stop_events
+    limit = min(max(limit, 1), 1000)
+    filters = {"bus_id": bus_id, "route_id": route_id, "stop_index": stop_index}
+    events = detector.query(since, limit=limit, **filters)
+    if since is not None and not events and wait > 0:
+        deadline = time.monotonic() + min(wait, LONG_POLL_MAX_WAIT)
+        last_id = max(since, detector.last_id)
+        while not events and await detector.wait_for_event(last_id, deadline - time.monotonic()):
+            events = detector.query(last_id, limit=limit, **filters)
+            last_id = detector.last_id
+    return {"events": events, "last_id": detector.last_id}
+
+# The same events as server-sent "arrival" and "departure" events, ids
+# <epoch>:<event id>, filtered like /tracking/stop_events. A reconnect with
+# Last-Event-ID resumes after that event while it is still in the log.
+@app.get("/tracking/stop_events/stream", tags=["Tracking"])
+async def stream_stop_events(request: Request, bus_id: Optional[int] = None, route_id: Optional[int] = None,
+                             stop_index: Optional[int] = None, current_user: Any = Depends(get_current_user_or_query_token)):
+    detector = request.app.state.db.stop_events
+
+    async def events():
+        sent = last_event_seq(request, detector.epoch)
+        if sent is None or sent > detector.last_id:
+            sent = detector.last_id
+        yield "retry: 3000\n\n"
+        while not await request.is_disconnected():
+            if detector.last_id > sent:
+                for event in detector.query(sent, bus_id=bus_id, route_id=route_id, stop_index=stop_index):
+                    yield f"id: {detector.epoch}:{event['id']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+                sent = detector.last_id
+            elif not await detector.wait_for_event(sent, SSE_KEEPALIVE):
+                yield ": keepalive\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ?format=binary returns the fleet as one packed snapshot frame (see
+# utils/frames.py) and ?format=metadata the per-bus fields it leaves out
 @app.get("/tracking/all", tags=["Tracking"])
-async def get_all_buses_current_location(request: Request, current_user: Any = Depends(get_current_user)):
-    active_trips = request.app.state.db.active_trips
-    dummy_all_bus_locations = request.app.state.db.dummy_all_bus_locations
-    buses_db = request.app.state.db.buses_db
-    drivers_db = request.app.state.db.drivers_db
-
-    all_locations = []
-    for bus in buses_db:
-        bus_id = bus["id"]
-        if bus_id in active_trips and active_trips[bus_id].get("bus_id") == bus_id:
-            location_data = {
-                "bus_id": bus_id,
-                "lat": active_trips[bus_id]["latitude"],
-                "lng": active_trips[bus_id]["longitude"],
-                "speed": 30,
-                "driver_name": next((d["name"] for d in drivers_db if d["id"] == active_trips[bus_id].get("driver_id")), "N/A"),
-                "estimated_arrival": "Realtime Update",
-                "bus_name": bus["name"]
-            }
-        elif bus_id in dummy_all_bus_locations:
-            location_data = dummy_all_bus_locations[bus_id]
+async def get_all_buses_current_location(request: Request, format: str = "json", since: Optional[int] = None, wait: float = 0,
+                                         current_user: Any = Depends(get_current_user)):
+    if format not in ("json", "binary", "metadata"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown format '{format}'")
+    await wait_for_location(since, wait)
+    app_state = request.app.state.db
+
+    # Buses that have never reported get a placeholder entry
+    locations, fragments, records = [], [], []
+    buses = app_state.views.admin_bus_list()
+    for bus in buses:
+        latest = tracking_hub.latest.get(bus["id"])
+        if latest is not None:
+            location, fragment, record = latest[2], latest[3], latest[4]
         else:
-            location_data = {"bus_id": bus_id, "lat": 0.0, "lng": 0.0, "speed": 0, "driver_name": "N/A", "estimated_arrival": "N/A", "bus_name": bus["name"]}
-        all_locations.append(location_data)
-
-    return all_locations
+            location = {"bus_id": bus["id"], "lat": 0.0, "lng": 0.0, "speed": 0, "driver_name": "N/A", "estimated_arrival": "N/A", "bus_name": bus.get("bus_number")}
+            fragment, record = json.dumps(location), frames.pack_record(bus["id"], location)
+        locations.append(location)
+        fragments.append(fragment)
+        records.append(record)
+
+    version = tracking_hub.seq
+    etag = f'"{tracking_hub.epoch}-{version}-{app_state.response_cache.versions.get("buses", 0)}-{format}"'
+    if format == "binary":
+        return location_response(request, frames.pack_frame("snapshot", tracking_hub.epoch, version, records), etag, version, since,
+                                 media_type="application/octet-stream")
+    if format == "metadata":
+        metadata = {location["bus_id"]: frames.metadata_of(location) for location in locations}
+        route_ids = {bus["id"]: bus.get("route_id") for bus in buses}
+        return location_response(request, frames.metadata_message(metadata, route_ids).encode("utf-8"), etag, version, since)
+    return location_response(request, ("[" + ", ".join(fragments) + "]").encode("utf-8"), etag, version, since)
+
+# Identify a WebSocket client from an optional ?token=<access token> so that
+# per-user connection caps apply; anonymous or invalid tokens return None
+def websocket_user_key(websocket: WebSocket) -> Optional[str]:
+    token = websocket.query_params.get("token")
+    if not token:
+        return None
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    if payload.get("sub") is None or payload.get("role") is None:
+        return None
+    return f"{payload['role']}:{payload['sub']}"
 
 @app.websocket("/tracking/ws/bus_locations")
-async def websocket_bus_locations(websocket: WebSocket, request: Request):
+async def websocket_bus_locations(websocket: WebSocket):
+    user_key = websocket_user_key(websocket)
+    if tracking_hub.admit(user_key) is not None:
+        await websocket.close(code=1013)
+        return
     await websocket.accept()
-    connected_clients.append(websocket)
+    client = tracking_hub.connect(websocket, user_key)
+    tracking_hub.subscribe_from_query(websocket)
     try:
+        # Full snapshot (or the changes since ?since=<seq>) first, deltas after.
+        # All sends go through the client's queue so its writer task owns the socket.
+        for message in tracking_hub.connect_messages(websocket):
+            client.send(message)
         while True:
-            await websocket.receive_text()
-    except WebSocketDisconnect:
-        connected_clients.remove(websocket)
-    except RuntimeError:
-        connected_clients.remove(websocket)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect" or client.closed:
+                break  # Closed by the client, or evicted by the hub
+            client.touch()
+            if message.get("text") is None:
+                # Control messages are JSON text; binary frames only go out
+                client.send(json.dumps({"type": "error", "detail": "Invalid message"}))
+                continue
+            for reply in tracking_hub.handle_message(websocket, message["text"]):
+                client.send(reply)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        # Whatever ended the connection, free its registry entry and user slot
+        tracking_hub.disconnect(websocket)
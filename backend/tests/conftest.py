@@ -0,0 +1,64 @@
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# The app writes its collections back to disk, so tests run it against a copy
+# of backend/data. The directory has to be set before backend.main is imported.
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+SEED_DATA = BACKEND_DIR / "data"
+sys.path.insert(0, str(BACKEND_DIR.parent))
+os.environ.setdefault("BUS_TRACKING_DATA_DIR", tempfile.mkdtemp(prefix="bus-tracking-"))
+for seed in SEED_DATA.glob("*.json"):
+    shutil.copy(seed, os.environ["BUS_TRACKING_DATA_DIR"])
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from backend import main  # noqa: E402
+
+
+@pytest.fixture
+def app_state(tmp_path, monkeypatch):
+    # A fresh AppState, tracking hub and event bus on a private copy of the data
+    for seed in SEED_DATA.glob("*.json"):
+        shutil.copy(seed, tmp_path)
+    store = main.create_store("json", tmp_path)
+    monkeypatch.setattr(main, "store", store)
+    monkeypatch.setattr(main, "tracking_hub", main.TrackingHub())
+    events = main.LocationEventBus(min_interval=0)
+    events.subscribe(main.push_locations)
+    monkeypatch.setattr(main, "location_events", events)
+    state = main.app.state.db = main.AppState(store)
+    yield state
+    store.close()
+
+
+@pytest.fixture
+def client(app_state):
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+def login(client: TestClient, role: str, **credentials) -> dict:
+    response = client.post(f"/auth/login/{role}", json=credentials)
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+@pytest.fixture
+def student(client):
+    return login(client, "student", student_id="studentA", password="passwordA")
+
+
+@pytest.fixture
+def driver(client):
+    # Driver B drives bus 2 on route 2
+    return login(client, "driver", username="driverB", password="passwordB")
+
+
+@pytest.fixture
+def admin(client):
+    return login(client, "admin", username="admin", password="adminpass")
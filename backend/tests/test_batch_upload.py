@@ -0,0 +1,72 @@
+import time
+
+from backend import main
+from backend.utils import frames
+
+
+def upload(client, driver, *fixes):
+    fixes = [{"seq": seq, "latitude": lat, "longitude": lng, "timestamp": timestamp} for seq, lat, lng, timestamp in fixes]
+    response = client.post("/driver/trip/update/batch", headers=driver, json={"fixes": fixes})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_batch_requires_trip(client, driver):
+    response = client.post("/driver/trip/update/batch", headers=driver, json={"fixes": []})
+    assert response.status_code == 400
+
+
+def test_duplicates_and_replays_are_dropped(client, driver, app_state):
+    client.post("/driver/trip/start", headers=driver)
+    now = time.time()
+    body = upload(client, driver, (1, 15.841, 74.511, now + 1), (2, 15.842, 74.512, now + 2), (2, 15.842, 74.512, now + 2))
+    assert (body["accepted"], body["dropped"], body["last_seq"]) == (2, 1, 2)
+
+    # A retry of the same upload changes nothing
+    body = upload(client, driver, (1, 15.841, 74.511, now + 1), (2, 15.842, 74.512, now + 2))
+    assert (body["accepted"], body["dropped"]) == (0, 2)
+    trip = app_state.live.get(2)
+    assert [point[1:] for point in trip.history][-2:] == [(15.841, 74.511), (15.842, 74.512)]
+
+
+def test_out_of_order_fixes_apply_in_seq_order(client, driver, app_state):
+    client.post("/driver/trip/start", headers=driver)
+    now = time.time()
+    body = upload(client, driver, (3, 15.843, 74.513, now + 0.3), (1, 15.841, 74.511, now + 0.1), (2, 15.842, 74.512, now + 0.2))
+    assert body["accepted"] == 3
+    assert body["current_location"] == {"latitude": 15.843, "longitude": 74.513, "timestamp": now + 0.3}
+
+    # A live fix taken after the buffered ones stays the current position
+    time.sleep(0.5)
+    client.post("/driver/trip/update", headers=driver, json={"latitude": 15.85, "longitude": 74.52})
+    body = upload(client, driver, (4, 15.844, 74.514, now + 0.4))
+    assert body["accepted"] == 1
+    assert (body["current_location"]["latitude"], body["current_location"]["longitude"]) == (15.85, 74.52)
+    # The late fix still lands in the history, in time order
+    points = [point[1:] for point in app_state.live.get(2).history][-5:]
+    assert points == [(15.841, 74.511), (15.842, 74.512), (15.843, 74.513), (15.844, 74.514), (15.85, 74.52)]
+
+
+def test_bad_timestamps_are_rejected_or_clamped(client, driver, admin, app_state):
+    client.post("/driver/trip/start", headers=driver)
+    now = time.time()
+    body = upload(
+        client, driver,
+        (1, 15.841, 74.511, now * 1000),  # Date.now() milliseconds
+        (2, 15.842, 74.512, -1),
+        (3, 95.0, 74.512, now),  # Latitude out of range
+        (4, 15.843, 74.513, now + 3600),  # Clock an hour fast
+    )
+    assert (body["accepted"], body["rejected"], body["last_seq"]) == (1, 3, 4)
+    assert body["current_location"]["timestamp"] <= time.time() + main.MAX_FIX_SKEW
+
+    # Rejected fixes don't use up their seq
+    assert upload(client, driver, (2, 15.842, 74.512, now))["accepted"] == 0
+    assert upload(client, driver, (5, 15.842, 74.512, now + 1))["accepted"] == 1
+
+    # Binary encodings of the bus still work and live fixes still count
+    frame = frames.unpack_frame(client.get("/tracking/all?format=binary", headers=admin).content)
+    assert any(record["bus_id"] == 2 for record in frame["bus_locations"])
+    client.post("/driver/trip/update", headers=driver, json={"latitude": 15.8401, "longitude": 74.5149})
+    # A fast clock holds stop detection back by MAX_FIX_SKEW at most
+    assert app_state.stop_events.buses[2].last_timestamp <= time.time() + main.MAX_FIX_SKEW
@@ -0,0 +1,36 @@
+import json
+
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+from backend.utils import frames
+
+
+def driver_socket(client, driver):
+    return client.websocket_connect(f"/driver/ws/location?token={driver['Authorization'].split()[1]}")
+
+
+def test_text_and_binary_fixes_are_acked(client, driver, app_state):
+    client.post("/driver/trip/start", headers=driver)
+    with driver_socket(client, driver) as websocket:
+        websocket.send_text("1,15.841,74.511")
+        assert json.loads(websocket.receive_text()) == {"ack": 1}
+        websocket.send_bytes(frames.DRIVER_FIX.pack(2, 15842000, 74512000))
+        assert websocket.receive_bytes() == frames.ACK.pack(2)
+        websocket.send_text("garbage")
+        assert json.loads(websocket.receive_text())["detail"] == "Invalid location frame"
+    location = app_state.live.get(2)
+    assert (location.lat, location.lng) == (15.842, 74.512)
+
+
+def test_fixes_need_a_trip(client, driver):
+    with driver_socket(client, driver) as websocket:
+        websocket.send_text("1,15.841,74.511")
+        assert json.loads(websocket.receive_text())["seq"] == 1
+
+
+def test_only_drivers_may_connect(client, student):
+    with pytest.raises(WebSocketDisconnect) as refused:
+        with driver_socket(client, student):
+            pass
+    assert refused.value.code == 1008
@@ -0,0 +1,37 @@
+import pytest
+
+from backend.utils.eta import EtaEngine
+from backend.utils.live_locations import LiveLocation
+from backend.utils.route_match import METRES_PER_DEGREE, RouteMatcher
+
+ROUTES = [
+    {"id": 1, "stops": [{"name": name, "lat": 15.80 + n / 100, "lng": 74.5} for n, name in enumerate("ABC")]},
+    {"id": 2, "stops": [{"name": name, "lat": 15.90, "lng": 74.5 + n / 100} for n, name in enumerate("XY")]},
+]
+LEG = 0.01 * METRES_PER_DEGREE
+
+
+def on_route(matcher, bus_id, route_id, lat, lng, speed):
+    location = LiveLocation(bus_id, lat, lng, speed=speed)
+    matcher.match_location(location, route_id)
+    return location
+
+
+def test_fleet_etas_to_every_stop_ahead():
+    matcher = RouteMatcher(ROUTES)
+    engine = EtaEngine(matcher, min_speed=10)
+    fast = on_route(matcher, 1, 1, 15.805, 74.5, speed=36)  # 10 m/s, halfway to B
+    parked = on_route(matcher, 2, 2, 15.90, 74.5, speed=0)  # At X
+    engine.update([fast, parked], now=1000)
+
+    ahead = engine.stops_for(1)["stops"]
+    assert [stop["name"] for stop in ahead] == ["B", "C"]
+    assert [stop["eta_seconds"] for stop in ahead] == pytest.approx([LEG / 20, LEG * 1.5 / 10], rel=1e-3)
+    # A standing bus is assumed to move at min_speed
+    [next_stop] = engine.stops_for(2)["stops"]
+    assert next_stop["name"] == "Y"
+    assert next_stop["eta_seconds"] == pytest.approx(next_stop["distance_m"] / (10 / 3.6), rel=1e-3)
+    assert fast.next_stop == "B" and fast.next_stop_eta is not None
+
+    engine.forget(1)
+    assert engine.stops_for(1) is None
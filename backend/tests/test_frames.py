@@ -0,0 +1,56 @@
+import asyncio
+import time
+
+import pytest
+
+from backend import main
+from backend.utils import frames
+
+
+def test_frame_round_trip():
+    location = {"lat": 15.845123, "lng": 74.51, "speed": 32.4, "heading": 90.5, "timestamp": 1700000000}
+    frame = frames.pack_frame("delta", 123, 7, [frames.pack_record(2, location)])
+    assert frames.unpack_frame(frame) == {
+        "type": "delta", "version": frames.VERSION, "epoch": 123, "seq": 7,
+        "bus_locations": [{"bus_id": 2, "lat": 15.845123, "lng": 74.51, "speed": 32.4, "heading": 90.5, "timestamp": 1700000000}],
+    }
+
+
+@pytest.mark.parametrize("location, expected", [
+    ({"lat": 15.0, "lng": 74.0, "timestamp": time.time() * 1000}, {"timestamp": 0xFFFFFFFF}),
+    ({"lat": 15.0, "lng": 74.0, "timestamp": -5}, {"timestamp": 0}),
+    ({"lat": 15.0, "lng": 74.0, "speed": -3, "timestamp": 1}, {"speed": 0}),
+    ({"lat": 15.0, "lng": 74.0, "speed": 1e9, "timestamp": 1}, {"speed": 6553.5}),
+    ({"lat": float("nan"), "lng": 1e9, "heading": float("inf"), "timestamp": 1}, {"lat": 0.0, "lng": 180.0, "heading": 0.0}),
+    ({"lat": 15.0, "lng": 74.0, "heading": 359.999, "timestamp": 1}, {"heading": 0.0}),
+])
+def test_out_of_range_fields_are_clamped(location, expected):
+    record = frames.unpack_frame(frames.pack_frame("snapshot", 1, 1, [frames.pack_record(1, location)]))["bus_locations"][0]
+    assert {field: record[field] for field in expected} == expected
+
+
+def test_driver_fix_parsing():
+    assert frames.parse_driver_fix("5,15.84,74.51") == (5, 15.84, 74.51)
+    assert frames.parse_driver_fix(frames.DRIVER_FIX.pack(6, 15840000, 74510000)) == (6, 15.84, 74.51)
+    for bad in ("5,95,74", "nonsense", b"\x00\x01"):
+        with pytest.raises(ValueError):
+            frames.parse_driver_fix(bad)
+
+
+def test_simulation_survives_a_failing_tick(app_state, monkeypatch):
+    publishes = []
+
+    async def publish(locations, route_of):
+        publishes.append(len(publishes))
+        if len(publishes) == 1:
+            raise RuntimeError("broken tick")
+
+    async def sleep(seconds):
+        if len(publishes) == 3:
+            raise asyncio.CancelledError
+
+    monkeypatch.setattr(main.tracking_hub, "publish", publish)
+    monkeypatch.setattr(main.asyncio, "sleep", sleep)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(main.simulate_bus_movement(app_state))
+    assert publishes == [0, 1, 2]
@@ -0,0 +1,31 @@
+from backend.utils.history import LocationHistory
+
+
+def test_points_stay_in_time_order_and_old_ones_fall_off():
+    history = LocationHistory(capacity=3)
+    for timestamp in (1, 2, 4):
+        assert history.add(timestamp, timestamp / 10, 0.0)
+    assert history.add(3, 0.3, 0.0)  # Late fix slotted in, oldest dropped
+    assert [point[0] for point in history] == [2, 3, 4]
+    assert not history.add(1.5, 0.15, 0.0)  # Older than everything kept
+
+
+def test_window_pages_forward_from_since():
+    history = LocationHistory(capacity=10)
+    for timestamp in range(1, 8):
+        history.add(timestamp, 0.0, 0.0)
+    assert history.window() == (0, 7)
+    assert history.window(limit=2) == (5, 7)
+    assert history.window(since=3, limit=2) == (3, 5)
+    assert history.window(since=7) == (7, 7)
+
+
+def test_segments_cover_the_ring_without_copying():
+    history = LocationHistory(capacity=4)
+    for timestamp in range(1, 7):
+        history.add(timestamp, timestamp, -timestamp)
+    first, last = history.window()
+    segments = history.segments(first, last)
+    assert len(segments) == 2
+    assert [value for segment in segments for value in segment[0]] == [3, 4, 5, 6]
+    assert [value for segment in segments for value in segment[2]] == [-3, -4, -5, -6]
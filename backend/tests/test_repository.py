@@ -0,0 +1,72 @@
+import pytest
+from conftest import login
+
+from backend.utils.repository import Collection
+
+
+def buses() -> Collection:
+    return Collection("buses", [
+        {"id": 1, "assigned_driver_id": 1, "route_id": 1},
+        {"id": 2, "assigned_driver_id": 2, "route_id": 2},
+        {"id": 4, "assigned_driver_id": 1, "route_id": 1},
+    ], indexes=("assigned_driver_id", "route_id"))
+
+
+def test_lookups():
+    collection = buses()
+    assert collection.find_one("assigned_driver_id", 1)["id"] == 1
+    assert [bus["id"] for bus in collection.find_all("route_id", 1)] == [1, 4]
+    assert collection.find_one("route_id", 9) is None
+    with pytest.raises(KeyError):
+        collection.find_one("bus_number", "GIT-001")
+
+
+def test_update_of_other_fields_keeps_index_order():
+    collection = buses()
+    collection.update(1, {"departure_time": "8:05 AM"})
+    assert collection.find_one("assigned_driver_id", 1)["id"] == 1
+    assert [bus["id"] for bus in collection.find_all("assigned_driver_id", 1)] == [1, 4]
+    assert [bus["id"] for bus in collection] == [1, 2, 4]
+
+
+def test_update_moves_changed_fields_in_id_order():
+    collection = buses()
+    collection.update(1, {"assigned_driver_id": 2})
+    assert [bus["id"] for bus in collection.find_all("assigned_driver_id", 1)] == [4]
+    assert [bus["id"] for bus in collection.find_all("assigned_driver_id", 2)] == [1, 2]
+    collection.update(1, {"assigned_driver_id": None})
+    assert [bus["id"] for bus in collection.find_all("assigned_driver_id", 2)] == [2]
+    collection.update(1, {"assigned_driver_id": 1})
+    assert collection.find_one("assigned_driver_id", 1)["id"] == 1
+
+
+def test_unique_index():
+    students = Collection("students", [{"id": 1, "student_id": "a"}], unique_indexes=("student_id",))
+    students.update(1, {"name": "A"})
+    assert students.find_one("student_id", "a")["name"] == "A"
+    students.update(1, {"student_id": "b"})
+    assert students.find_one("student_id", "a") is None
+    assert students.find_one("student_id", "b")["id"] == 1
+    students.delete(1)
+    assert students.find_one("student_id", "b") is None
+
+
+def test_ids_come_from_the_counter():
+    changes = []
+    collection = Collection("routes", [{"id": 3}], last_id=7, on_change=lambda c, op, record: changes.append((op, record["id"])))
+    assert collection.insert({"name": "x"})["id"] == 8
+    collection.delete(8)
+    assert collection.insert({"name": "y"})["id"] == 9  # Deleted ids are not reused
+    with pytest.raises(KeyError):
+        collection.insert({"id": 3})
+    assert changes == [("put", 8), ("delete", 8), ("put", 9)]
+
+
+def test_bus_edit_keeps_drivers_bus(client, admin, app_state):
+    # Driver A has buses 1 and 4; editing bus 1 must not hand them bus 4
+    response = client.put("/admin/buses/1", headers=admin, json={"departure_time": "8:05 AM"})
+    assert response.status_code == 200
+    assert app_state.views.driver_buses[1]["id"] == 1
+    driver_a = login(client, "driver", username="driverA", password="passwordA")
+    assert client.post("/driver/trip/start", headers=driver_a).status_code == 200
+    assert app_state.live.for_driver(1).bus_id == 1
@@ -0,0 +1,56 @@
+import pytest
+
+from backend.utils.route_match import METRES_PER_DEGREE, RouteMatcher
+
+# Stops every 0.01 degrees of latitude (~1.1 km) north along one meridian
+LINE = {"id": 1, "stops": [{"name": name, "lat": 15.80 + n / 100, "lng": 74.5} for n, name in enumerate("ABC")]}
+# Out to B and back to A along the same road
+OUT_AND_BACK = {"id": 2, "stops": [{"name": "A", "lat": 15.80, "lng": 74.5}, {"name": "B", "lat": 15.81, "lng": 74.5},
+                                    {"name": "A again", "lat": 15.80, "lng": 74.5}]}
+LEG = 0.01 * METRES_PER_DEGREE
+
+
+@pytest.fixture
+def matcher():
+    return RouteMatcher([LINE, OUT_AND_BACK], max_offset=100)
+
+
+def test_fix_is_snapped_onto_the_route(matcher):
+    match = matcher.match(1, 15.815, 74.5002)  # ~20 m east of the road
+    assert match.along == pytest.approx(1.5 * LEG, abs=1)
+    assert match.offset == pytest.approx(21, abs=2)
+    assert (match.lat, match.lng) == pytest.approx((15.815, 74.5))
+    assert match.on_route and match.next_index == 2 and match.next_stop == "C"
+    assert not matcher.match(1, 15.815, 74.51).on_route
+    assert matcher.match(99, 15.815, 74.5) is None
+
+
+def test_reaching_a_stop_moves_next_stop_on(matcher):
+    assert matcher.match(1, 15.8099, 74.5).next_index == 2  # Within stop_radius of B
+    assert matcher.match(1, 15.82, 74.5).next_stop is None
+
+
+def test_jitter_does_not_walk_the_bus_backwards(matcher):
+    first = matcher.match(1, 15.805, 74.5)
+    jitter = matcher.match(1, 15.8049, 74.5, first)  # ~11 m back
+    assert jitter.along == first.along
+    reversed_far = matcher.match(1, 15.801, 74.5, jitter)  # A real move back
+    assert reversed_far.along < first.along
+
+
+def test_shared_road_continues_in_the_direction_of_travel(matcher):
+    outbound = matcher.match(2, 15.805, 74.5)
+    assert outbound.along == pytest.approx(0.5 * LEG, abs=1)
+    at_b = matcher.match(2, 15.81, 74.5, outbound)
+    inbound = matcher.match(2, 15.805, 74.5, at_b)
+    assert inbound.along == pytest.approx(1.5 * LEG, abs=1)
+    assert inbound.next_stop == "A again"
+
+
+def test_route_changes_rebuild_geometry(matcher):
+    matcher.changed("routes", "put", {"id": 1, "stops": LINE["stops"][:1]})
+    assert 1 not in matcher.geometries  # One stop is not a route
+    matcher.changed("routes", "put", LINE)
+    assert matcher.geometries[1].total == pytest.approx(2 * LEG)
+    matcher.changed("routes", "delete", LINE)
+    assert matcher.match(1, 15.805, 74.5) is None
@@ -0,0 +1,38 @@
+from backend.utils.route_match import RouteMatcher
+from backend.utils.spatial import GridIndex, StopIndex
+
+
+def test_grid_nearest_and_within():
+    grid = GridIndex(cell_size=500)
+    for key, lat in (("a", 15.800), ("b", 15.805), ("c", 15.830), ("d", 15.900)):
+        grid.put(key, lat, 74.5)
+    assert [key for _, key, _ in grid.nearest(15.801, 74.5, 2)] == ["a", "b"]
+    assert [key for _, key, _ in grid.within(15.801, 74.5, 1000)] == ["a", "b"]
+    assert [key for _, key, _ in grid.nearest(15.801, 74.5, 5, max_radius=4000)] == ["a", "b", "c"]
+    grid.put("a", 15.899, 74.5)  # Moves cell
+    grid.remove("b")
+    assert [key for _, key, _ in grid.nearest(15.901, 74.5, 2)] == ["d", "a"]
+    assert "b" not in grid and len(grid) == 3
+
+
+def test_stop_numbers_match_route_geometry():
+    # The depot has no coordinates, so "Market" is stop 0 everywhere
+    route = {"id": 1, "name": "Line", "stops": [
+        {"name": "Depot"},
+        {"name": "Market", "lat": 15.80, "lng": 74.5},
+        {"name": "Campus", "lat": 15.81, "lng": 74.5},
+    ]}
+    stops, geometry = StopIndex([route]), RouteMatcher([route]).geometries[1]
+    for place in stops.near(15.805, 74.5, 1000):
+        [entry] = place["routes"]
+        assert geometry.names[entry["stop_index"]] == place["name"]
+
+
+def test_nearby_queries_reject_non_finite_numbers(client, student):
+    for url in ("/students/nearby/stops", "/tracking/nearby"):
+        assert client.get(f"{url}?lat=15.85&lng=74.5&radius=500", headers=student).status_code == 200
+        for query in ("radius=nan", "radius=inf", "radius=-inf"):
+            response = client.get(f"{url}?lat=15.85&lng=74.5&{query}", headers=student)
+            assert response.status_code == 400 and response.json()["detail"] == "Invalid radius"
+        for query in ("lat=nan&lng=74.5", "lat=15.85&lng=inf"):
+            assert client.get(f"{url}?{query}", headers=student).status_code == 400
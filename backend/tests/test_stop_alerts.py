@@ -0,0 +1,61 @@
+import pytest
+
+from backend.utils.live_locations import LiveLocation
+from backend.utils.route_match import RouteMatcher
+from backend.utils.stop_alerts import StopAlertIndex
+
+# Three stops about 1.1 km apart along a meridian
+ROUTE = {"id": 7, "name": "Line", "stops": [{"name": f"Stop {n}", "lat": 15.80 + n / 100, "lng": 74.5} for n in range(3)]}
+
+
+def drive(matcher, alerts, location, *lats):
+    fired = []
+    for lat in lats:
+        location.lat = lat
+        matcher.match_location(location, ROUTE["id"])
+        fired.extend(notification["alert_id"] for _, notification in alerts.check(location, now=0))
+    return fired
+
+
+@pytest.fixture
+def matcher():
+    return RouteMatcher([ROUTE])
+
+
+def test_alert_fires_inside_its_threshold_once_per_pass(matcher):
+    alerts = StopAlertIndex(min_speed=10)
+    alert = alerts.add("student:1", 5, 2, minutes=2)
+    bus = LiveLocation(5, 15.801, 74.5, speed=30, simulated=True)
+    assert drive(matcher, alerts, bus, 15.801, 15.805) == []  # Over 2 minutes out at 30 km/h
+    assert drive(matcher, alerts, bus, 15.813, 15.815) == [alert.id]
+    assert drive(matcher, alerts, bus, 15.8199) == []
+    assert alert.fired_at is None  # Reached the stop: armed for the next lap
+    # The simulated bus starts its next lap without ever ending a trip
+    assert drive(matcher, alerts, bus, 15.8001, 15.801, 15.813) == [alert.id]
+
+
+def test_stops_behind_the_bus_wait(matcher):
+    alerts = StopAlertIndex()
+    alerts.add("student:1", 5, 0, minutes=5)
+    bus = LiveLocation(5, 15.805, 74.5, speed=30)
+    assert drive(matcher, alerts, bus, 15.805, 15.806) == []
+    assert alerts.stats()["armed"] == 1
+
+
+def test_end_of_trip_rearms_and_removed_alerts_stay_gone(matcher):
+    alerts = StopAlertIndex()
+    kept = alerts.add("student:1", 5, 2, minutes=10)
+    dropped = alerts.add("student:2", 5, 2, minutes=10)
+    bus = LiveLocation(5, 15.81, 74.5, speed=30)
+    assert sorted(drive(matcher, alerts, bus, 15.81)) == [kept.id, dropped.id]
+    assert alerts.remove("student:2", dropped.id)
+    alerts.rearm(5)
+    assert kept.fired_at is None and alerts.stats()["armed"] == 1
+    assert alerts.pending("student:1", 0)[0]["stop_name"] == "Stop 2"
+
+
+def test_per_user_limit():
+    alerts = StopAlertIndex(max_per_user=1)
+    alerts.add("student:1", 5, 2, minutes=2)
+    with pytest.raises(ValueError):
+        alerts.add("student:1", 5, 1, minutes=2)
@@ -0,0 +1,68 @@
+import pytest
+
+from backend.utils.route_match import METRES_PER_DEGREE, RouteMatcher
+from backend.utils.stop_events import StopEventDetector
+
+ROUTE = {"id": 4, "stops": [{"name": name, "lat": 15.80 + n / 100, "lng": 74.5} for n, name in enumerate(("Gate", "Market", "Campus"))]}
+
+
+def metres_north(stop: int, metres: float) -> float:
+    return ROUTE["stops"][stop]["lat"] + metres / METRES_PER_DEGREE
+
+
+@pytest.fixture
+def geometry():
+    return RouteMatcher([ROUTE]).geometries[4]
+
+
+def kinds(events):
+    return [(event["type"], event["stop_name"]) for event in events]
+
+
+def test_arrival_and_departure_with_hysteresis(geometry):
+    detector = StopEventDetector(enter_radius=40, exit_radius=60)
+    observed = []
+    for timestamp, metres in enumerate((-100, -30, 50, -35, 55, 80)):
+        observed += detector.observe(9, geometry, metres_north(1, metres), 74.5, 100 + timestamp, trip_id=1)
+    # Drifting between 40 and 60 m of Market is neither a new arrival nor a departure
+    assert kinds(observed) == [("arrival", "Market"), ("departure", "Market")]
+    assert observed[1]["dwell_seconds"] == 4 and observed[1]["trip_id"] == 1
+
+
+def test_late_fixes_are_ignored(geometry):
+    detector = StopEventDetector()
+    assert kinds(detector.observe(9, geometry, metres_north(0, 0), 74.5, 100)) == [("arrival", "Gate")]
+    assert detector.observe(9, geometry, metres_north(0, 500), 74.5, 99) == []
+    assert detector.buses[9].at == 0
+
+
+def test_cursor_catches_up_after_a_gap(geometry):
+    detector = StopEventDetector(lookahead=1)
+    detector.observe(9, geometry, metres_north(0, 0), 74.5, 100)
+    detector.observe(9, geometry, metres_north(0, 500), 74.5, 101)
+    # No fixes near Market; the matcher's next stop moves the cursor on
+    events = detector.observe(9, geometry, metres_north(2, 0), 74.5, 200, next_index=3)
+    assert kinds(events) == [("arrival", "Campus")]
+
+
+def test_query_filters_and_pages(geometry):
+    detector = StopEventDetector()
+    for bus_id in (1, 2):
+        detector.observe(bus_id, geometry, metres_north(0, 0), 74.5, 100)
+        detector.observe(bus_id, geometry, metres_north(0, 500), 74.5, 101)
+    assert [event["id"] for event in detector.query()] == [1, 2, 3, 4]
+    assert [event["id"] for event in detector.query(limit=1)] == [4]
+    assert [event["id"] for event in detector.query(since=1, bus_id=2)] == [3, 4]
+    assert detector.query(since=1, stop_index=1) == []
+
+
+def test_driver_fixes_produce_stop_events(client, driver, app_state):
+    # Driver B's trip starts at the first stop of route 2; Market Area is next
+    client.post("/driver/trip/start", headers=driver)
+    client.post("/driver/trip/update", headers=driver, json={"latitude": 15.842, "longitude": 74.5125})
+    client.post("/driver/trip/update", headers=driver, json={"latitude": 15.84, "longitude": 74.515})
+    body = client.get("/tracking/stop_events?bus_id=2", headers=driver).json()
+    assert kinds(body["events"]) == [
+        ("arrival", "Central Bus Stand Start"), ("departure", "Central Bus Stand Start"), ("arrival", "Market Area"),
+    ]
+    assert body["last_id"] == body["events"][-1]["id"]
@@ -0,0 +1,179 @@
+import shutil
+
+import pytest
+from conftest import SEED_DATA
+
+from backend import main
+from backend.utils.persistence import PersistenceScheduler
+from backend.utils import sqlite_store
+from backend.utils.storage import create_store
+
+MODES = ("json", "wal", "sqlite")
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    for seed in SEED_DATA.glob("*.json"):
+        shutil.copy(seed, tmp_path)
+    return tmp_path
+
+
+def open_buses(mode, data_dir):
+    # AppState.persist hands every change to store.append the same way
+    store = create_store(mode, data_dir)
+    return store, store.collection("buses", indexes=("assigned_driver_id", "route_id"), on_change=store.append)
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_writes_survive_a_restart(mode, data_dir):
+    store, buses = open_buses(mode, data_dir)
+    store.start()
+    added = buses.insert({"bus_number": "GIT-005", "route_id": 2, "assigned_driver_id": 2})
+    buses.update(1, {"departure_time": "8:05 AM"})
+    buses.delete(3)
+    store.close()
+
+    store, buses = open_buses(mode, data_dir)
+    try:
+        assert added["id"] == 5
+        assert buses.get(5)["bus_number"] == "GIT-005"
+        assert buses.get(1)["departure_time"] == "8:05 AM"
+        assert buses.get(3) is None
+        assert [bus["id"] for bus in buses.find_all("assigned_driver_id", 2)] == [2, 5]
+        assert buses.find_one("assigned_driver_id", 1)["id"] == 1
+        # Ids are never handed out twice, even after a delete and a restart
+        assert buses.next_id() == 6
+    finally:
+        store.close()
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_lookups_need_an_index(mode, data_dir):
+    store, buses = open_buses(mode, data_dir)
+    try:
+        with pytest.raises(KeyError):
+            buses.find_one("bus_number", "GIT-001")
+        with pytest.raises(KeyError):
+            buses.insert({"id": 1})
+    finally:
+        store.close()
+
+
+def test_sqlite_app_state(data_dir):
+    store = create_store("sqlite", data_dir)
+    state = main.AppState(store)
+    try:
+        state.buses_db.update(2, {"route_id": 3})
+        assert state.views.admin_buses[2]["route_id"] == 3
+        assert state.drivers_db.find_one("username", "driverB")["id"] == 2
+    finally:
+        store.close()
+
+
+def test_sqlite_own_writes_are_applied_incrementally(data_dir):
+    store = create_store("sqlite", data_dir)
+    state = main.AppState(store)
+    try:
+        rebuilds, routes_version, stop_rebuilds = state.views.rebuilds, state.matcher.version, state.stops.rebuilds
+        state.buses_db.update(1, {"bus_number": "GIT-101"})
+        assert state.views.rebuilds == rebuilds + 1
+        state.routes_db.update(2, {"name": "Ring Road"})
+        assert state.matcher.version == routes_version + 1 and state.stops.rebuilds == stop_rebuilds + 1
+        assert state.synced_versions == store.data_versions()
+        assert state.response_cache.versions["buses"] == state.synced_versions["buses"]
+    finally:
+        store.close()
+
+
+def test_failed_writes_are_logged_and_retried(caplog):
+    attempts = []
+
+    def write(name):
+        attempts.append(name)
+        if len(attempts) == 1:
+            raise OSError("disk full")
+
+    scheduler = PersistenceScheduler(write, window=0, max_delay=0)
+    scheduler.start()
+    try:
+        scheduler.mark_dirty("buses")
+        assert scheduler.flush(timeout=5)
+    finally:
+        scheduler.close()
+    assert attempts == ["buses", "buses"]
+    assert "Error persisting 'buses'" in caplog.text
+
+
+def test_sqlite_workers_see_each_others_writes(data_dir):
+    # Two stores on one database file behave like two worker processes
+    first, second = create_store("sqlite", data_dir), create_store("sqlite", data_dir)
+    worker_a, worker_b = main.AppState(first), main.AppState(second)
+    try:
+        worker_a.buses_db.update(1, {"assigned_driver_id": 2, "bus_number": "GIT-101"})
+        worker_a.routes_db.update(2, {"stops": [{"name": "Gate", "lat": 15.8, "lng": 74.5}, {"name": "Depot", "lat": 15.9, "lng": 74.6}]})
+        assert worker_b.views.admin_buses[1]["bus_number"] == "GIT-001"
+
+        worker_b.sync()
+        assert worker_b.views.admin_buses[1]["bus_number"] == "GIT-101"
+        assert worker_b.views.driver_buses[2]["id"] == 1
+        assert worker_b.matcher.geometries[2].names == ["Gate", "Depot"]
+        assert [place["name"] for place in worker_b.stops.near(15.8, 74.5, 10)] == ["Gate"]
+        rebuilds = worker_b.views.rebuilds
+        worker_b.sync()
+        assert worker_b.views.rebuilds == rebuilds
+    finally:
+        first.close()
+        second.close()
+
+
+def test_sqlite_workers_agree_on_etags(data_dir):
+    first, second = create_store("sqlite", data_dir), create_store("sqlite", data_dir)
+    worker_a, worker_b = main.AppState(first), main.AppState(second)
+    try:
+        depends_on = ("buses", "routes", "drivers")
+        assert worker_a.response_cache.etag(depends_on) == worker_b.response_cache.etag(depends_on)
+        body, etag = worker_b.response_cache.get("admin/buses", depends_on, worker_b.views.admin_bus_list)
+
+        worker_a.buses_db.update(1, {"bus_number": "GIT-101"})
+        worker_b.sync()
+        assert worker_a.response_cache.etag(depends_on) == worker_b.response_cache.etag(depends_on) != etag
+        body, _ = worker_b.response_cache.get("admin/buses", depends_on, worker_b.views.admin_bus_list)
+        assert b"GIT-101" in body
+    finally:
+        first.close()
+        second.close()
+
+
+def test_sqlite_workers_drop_revoked_logins(data_dir):
+    first, second = create_store("sqlite", data_dir), create_store("sqlite", data_dir)
+    worker_a, worker_b = main.AppState(first), main.AppState(second)
+    try:
+        worker_b.token_cache.put("token", {"id": 2, "role": "driver"}, "driver:2")
+        worker_b.token_cache.put("other", {"id": 1, "role": "student"}, "student:1")
+        worker_a.students_db.insert({"student_id": "studentZ", "name": "Z", "password": "z"})
+        worker_a.drivers_db.delete(2)
+        worker_b.sync()
+        assert worker_b.token_cache.get("token") is None
+        # Only the changed users' logins go
+        assert worker_b.token_cache.get("other") == {"id": 1, "role": "student"}
+        # and a worker's own writes never clear the cache
+        worker_b.students_db.insert({"student_id": "studentY", "name": "Y", "password": "y"})
+        assert worker_b.token_cache.get("other") == {"id": 1, "role": "student"}
+    finally:
+        first.close()
+        second.close()
+
+
+def test_sqlite_worker_far_behind_drops_every_login(data_dir, monkeypatch):
+    monkeypatch.setattr(sqlite_store, "CHANGE_LOG_SIZE", 2)
+    first, second = create_store("sqlite", data_dir), create_store("sqlite", data_dir)
+    worker_a, worker_b = main.AppState(first), main.AppState(second)
+    try:
+        worker_b.token_cache.put("other", {"id": 1, "role": "student"}, "student:1")
+        for name in ("X", "Y", "Z"):
+            worker_a.students_db.insert({"student_id": f"student{name}", "name": name, "password": name})
+        worker_b.sync()
+        assert worker_b.token_cache.get("other") is None
+    finally:
+        first.close()
+        second.close()
@@ -0,0 +1,30 @@
+import asyncio
+
+from backend import main
+
+
+def test_conditional_reads_of_a_bus(client, driver, admin):
+    client.post("/driver/trip/start", headers=driver)
+    first = client.get("/tracking/bus/2", headers=admin)
+    version = int(first.headers["X-Tracking-Version"])
+    assert client.get("/tracking/bus/2", headers={**admin, "If-None-Match": first.headers["ETag"]}).status_code == 304
+    assert client.get(f"/tracking/bus/2?since={version}", headers=admin).status_code == 304
+
+    client.post("/driver/trip/update", headers=driver, json={"latitude": 15.842, "longitude": 74.5125})
+    moved = client.get(f"/tracking/bus/2?since={version}", headers=admin)
+    assert moved.status_code == 200 and int(moved.headers["X-Tracking-Version"]) > version
+    assert (moved.json()["lat"], moved.json()["lng"]) == (15.842, 74.5125)
+
+
+def test_long_poll_returns_on_change(app_state):
+    async def scenario():
+        hub = main.tracking_hub
+        await hub.publish({2: {"bus_id": 2, "lat": 15.0, "lng": 74.0}}, lambda bus_id: 2)
+        since = hub.version(2)
+        waiting = asyncio.create_task(hub.wait_for_change(since, 2, timeout=5))
+        await asyncio.sleep(0)
+        await hub.publish({2: {"bus_id": 2, "lat": 15.1, "lng": 74.0}}, lambda bus_id: 2)
+        assert await asyncio.wait_for(waiting, 1)
+        assert not await hub.wait_for_change(hub.version(2), 2, timeout=0.01)
+
+    asyncio.run(scenario())
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import time
+
+import pytest
+from starlette.datastructures import QueryParams
+from starlette.websockets import WebSocketDisconnect
+
+from backend import main
+from backend.utils.tracking_hub import TrackingHub
+
+ROUTES = {1: 1, 2: 2, 3: 3}
+
+
+class FakeSocket:
+    # Stands in for a WebSocket; a cleared `open` gate stalls its sends
+    def __init__(self, query: str = ""):
+        self.query_params = QueryParams(query)
+        self.messages = []
+        self.open = asyncio.Event()
+        self.open.set()
+
+    async def send_text(self, text):
+        await self.open.wait()
+        self.messages.append(json.loads(text))
+
+    async def send_bytes(self, data):
+        await self.open.wait()
+        self.messages.append(data)
+
+    async def close(self, code=1000):
+        pass
+
+
+def fix(bus_id, lat, lng):
+    return {"bus_id": bus_id, "lat": lat, "lng": lng, "speed": 20, "driver_name": "N/A", "estimated_arrival": "N/A",
+            "bus_name": f"Bus {bus_id}", "timestamp": 1700000000}
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def located(messages):
+    return [location["bus_id"] for message in messages if message.get("bus_locations") for location in message["bus_locations"]]
+
+
+def test_topics_and_firehose():
+    async def scenario():
+        hub = TrackingHub()
+        everything, route_2 = FakeSocket(), FakeSocket()
+        hub.connect(everything)
+        hub.connect(route_2)
+        hub.handle_message(route_2, json.dumps({"action": "subscribe", "route_ids": [2]}))
+        await hub.publish({1: fix(1, 15.0, 74.0), 2: fix(2, 15.1, 74.1)}, ROUTES.get)
+        await settle()
+        assert located(everything.messages) == [1, 2]
+        assert located(route_2.messages) == [2]
+
+    asyncio.run(scenario())
+
+
+def test_resume_sends_only_newer_changes():
+    async def scenario():
+        hub = TrackingHub()
+        socket = FakeSocket()
+        hub.connect(socket)
+        await hub.publish({1: fix(1, 15.0, 74.0), 2: fix(2, 15.1, 74.1)}, ROUTES.get)
+        since = hub.seq
+        await hub.publish({1: fix(1, 15.0, 74.0), 2: fix(2, 15.2, 74.2)}, ROUTES.get)
+        [delta] = hub.resume_messages(socket, since, hub.epoch)
+        assert json.loads(delta)["type"] == "delta" and located([json.loads(delta)]) == [2]
+        # Seqs from another epoch (a restart) get a full snapshot
+        [snapshot] = hub.resume_messages(socket, since, hub.epoch - 1)
+        assert json.loads(snapshot)["type"] == "snapshot" and located([json.loads(snapshot)]) == [1, 2]
+
+    asyncio.run(scenario())
+
+
+def test_stalled_client_is_caught_up_with_latest_positions():
+    async def scenario():
+        hub = TrackingHub(max_queue=2)
+        slow = FakeSocket()
+        slow.open.clear()
+        client = hub.connect(slow)
+        for step in range(6):
+            await hub.publish({1: fix(1, 15.0 + step / 100, 74.0)}, ROUTES.get)
+        assert client.dropped > 0 and len(client.queue) <= 3
+        slow.open.set()
+        await settle()
+        # Whatever was dropped, the last thing the client hears is where the bus is now
+        assert slow.messages[-1]["bus_locations"][-1]["lat"] == 15.05
+
+    asyncio.run(scenario())
+
+
+def test_stalled_client_is_evicted_once_only_undroppable_messages_are_queued():
+    async def scenario():
+        hub = TrackingHub(max_queue=2)
+        slow = FakeSocket()
+        slow.open.clear()
+        client = hub.connect(slow, user_key="student:1")
+        await hub.publish({1: fix(1, 15.0, 74.0)}, ROUTES.get)
+        await settle()
+        # The writer holds the first frame; a queued location frame makes room
+        # for an alert
+        alert = json.dumps({"type": "stop_alert"})
+        hub.send_to_user("student:1", alert)
+        await hub.publish({1: fix(1, 15.1, 74.0)}, ROUTES.get)
+        hub.send_to_user("student:1", alert)
+        assert client.dropped == 1 and len(client.queue) == 2 and slow in hub.connections
+        # Only alerts are left, so the next message cannot fit
+        hub.send_to_user("student:1", alert)
+        assert slow not in hub.connections and hub.evicted == 1
+        assert len(client.queue) == 2
+
+    asyncio.run(scenario())
+
+
+def test_clients_that_never_reply_are_reaped():
+    async def scenario():
+        hub = TrackingHub(heartbeat_timeout=60)
+        answering, silent = FakeSocket(), FakeSocket()
+        replies, gone = hub.connect(answering), hub.connect(silent)
+        replies.last_seen = gone.last_seen = time.monotonic() - 120
+        # Frames still go out to both, but only one answers
+        await hub.publish({1: fix(1, 15.0, 74.0)}, ROUTES.get)
+        await settle()
+        assert located(silent.messages) == [1]
+        # What the endpoint does for every inbound frame, e.g. a pong
+        replies.touch()
+        assert await hub.reap_idle_clients() == 1
+        assert answering in hub.connections and silent not in hub.connections
+
+    asyncio.run(scenario())
+
+
+def test_removed_bus_is_announced_to_viewport_clients():
+    async def scenario():
+        hub = TrackingHub()
+        await hub.publish({1: fix(1, 15.0, 74.0), 2: fix(2, 16.0, 75.0)}, ROUTES.get)
+        viewer = FakeSocket()
+        hub.connect(viewer)
+        hub.handle_message(viewer, json.dumps({"action": "viewport", "bbox": [14.9, 73.9, 15.1, 74.1], "zoom": 12}))
+        assert hub.remove(1) and not hub.remove(1)
+        await settle()
+        assert viewer.messages == [{"type": "remove", "epoch": hub.epoch, "seq": hub.seq, "bus_ids": [1]}]
+        assert not hub.viewports.sees(viewer, 1)
+
+    asyncio.run(scenario())
+
+
+def test_infinite_numbers_in_messages_are_rejected():
+    async def scenario():
+        hub = TrackingHub()
+        viewer = FakeSocket()
+        hub.connect(viewer)
+        invalid = json.dumps({"type": "error", "detail": "Invalid viewport"})
+        # json.loads reads 1e999 as inf, which int() cannot convert
+        assert hub.handle_message(viewer, '{"action": "viewport", "bbox": [14.9, 73.9, 15.1, 74.1], "zoom": 1e999}') == [invalid]
+        assert hub.handle_message(viewer, '{"action": "viewport", "bbox": [14.9, 73.9, 15.1, 1e999], "zoom": 12}') == [invalid]
+        assert hub.handle_message(viewer, '{"action": "resume", "since": 1e999}') == [
+            json.dumps({"type": "error", "detail": "Invalid message"})]
+        assert viewer not in hub.viewports
+
+    asyncio.run(scenario())
+
+
+def test_binary_frame_from_client_does_not_leak_its_slot(client, student):
+    token = student["Authorization"].split()[1]
+    with client.websocket_connect(f"/tracking/ws/bus_locations?token={token}") as websocket:
+        assert json.loads(websocket.receive_text())["type"] == "snapshot"
+        websocket.send_bytes(b"\x01\x02")
+        assert json.loads(websocket.receive_text()) == {"type": "error", "detail": "Invalid message"}
+        websocket.send_text(json.dumps({"action": "subscribe", "bus_ids": [2]}))
+        assert json.loads(websocket.receive_text())["type"] == "subscriptions"
+    assert main.tracking_hub.connections == {}
+    assert main.tracking_hub.by_user == {}
+
+
+def test_per_user_connection_cap(client, driver):
+    url = f"/tracking/ws/bus_locations?token={driver['Authorization'].split()[1]}"
+    main.tracking_hub.max_per_user = 1
+    with client.websocket_connect(url) as websocket:
+        websocket.receive_text()
+        with pytest.raises(WebSocketDisconnect) as refused:
+            with client.websocket_connect(url):
+                pass
+        assert refused.value.code == 1013
+    # The slot is free again once the first connection closes
+    with client.websocket_connect(url) as websocket:
+        assert json.loads(websocket.receive_text())["type"] == "snapshot"
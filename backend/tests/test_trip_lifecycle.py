@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+from conftest import login
+from starlette.requests import Request
+
+from backend import main
+
+
+def receive_until(websocket, kind: str) -> dict:
+    while True:
+        message = json.loads(websocket.receive_text())
+        if message["type"] == kind:
+            return message
+
+
+def test_deleted_bus_leaves_the_map(client, admin, app_state):
+    assert client.get("/tracking/bus/3", headers=admin).status_code == 200
+    since = main.tracking_hub.seq
+    with client.websocket_connect("/tracking/ws/bus_locations") as websocket:
+        receive_until(websocket, "snapshot")
+        assert client.delete("/admin/buses/3", headers=admin).status_code == 200
+        assert receive_until(websocket, "remove")["bus_ids"] == [3]
+
+    assert client.get("/tracking/bus/3", headers=admin).status_code == 404
+    assert 3 not in [location["bus_id"] for location in client.get("/tracking/all", headers=admin).json()]
+    assert app_state.live.get(3) is None
+
+    # A client resuming from before the delete hears about it too
+    url = f"/tracking/ws/bus_locations?since={since}&epoch={main.tracking_hub.epoch}"
+    with client.websocket_connect(url) as websocket:
+        assert json.loads(websocket.receive_text()) == {
+            "type": "remove", "epoch": main.tracking_hub.epoch, "seq": main.tracking_hub.seq, "bus_ids": [3],
+        }
+
+
+def test_ended_trip_delivers_its_last_fix_then_leaves(client, admin, app_state):
+    # Bus 4 is not a simulated bus; give it to driver C
+    client.delete("/admin/buses/3", headers=admin)
+    client.put("/admin/buses/4", headers=admin, json={"assigned_driver_id": 3})
+    driver_c = login(client, "driver", username="driverC", password="passwordC")
+    delivered = []
+
+    async def record(locations):
+        delivered.extend(locations.items())
+
+    main.location_events.subscribe(record)
+    main.location_events.min_interval = 60
+    assert client.post("/driver/trip/start", headers=driver_c).status_code == 200
+    # Held back by the rate limit, so only the end of the trip delivers it
+    client.post("/driver/trip/update", headers=driver_c, json={"latitude": 15.8501, "longitude": 74.5201})
+    assert len(delivered) == 1
+
+    with client.websocket_connect("/tracking/ws/bus_locations?bus_id=4") as websocket:
+        receive_until(websocket, "snapshot")
+        assert client.post("/driver/trip/end", headers=driver_c).status_code == 200
+        assert receive_until(websocket, "remove")["bus_ids"] == [4]
+    bus_id, location = delivered[-1]
+    assert (bus_id, location["lat"], location["lng"]) == (4, 15.8501, 74.5201)
+    assert 4 not in main.tracking_hub.latest
+    assert client.get("/tracking/bus/4", headers=admin).status_code == 404
+
+    # A new trip puts the bus back on the map
+    client.post("/driver/trip/start", headers=driver_c)
+    assert client.get("/tracking/bus/4", headers=admin).status_code == 200
+
+
+def test_simulated_bus_stays_after_its_trip(client, driver, admin):
+    client.post("/driver/trip/start", headers=driver)
+    assert client.post("/driver/trip/end", headers=driver).status_code == 200
+    assert client.get("/tracking/bus/2", headers=admin).status_code == 200
+
+
+def test_stream_of_an_ended_trip_says_it_left(client, admin, app_state):
+    client.delete("/admin/buses/3", headers=admin)
+    client.put("/admin/buses/4", headers=admin, json={"assigned_driver_id": 3})
+    driver_c = login(client, "driver", username="driverC", password="passwordC")
+    client.post("/driver/trip/start", headers=driver_c)
+    client.post("/driver/trip/end", headers=driver_c)
+    assert 4 in main.tracking_hub.removed
+
+    async def receive():
+        await asyncio.sleep(3600)
+
+    async def first_events():
+        # The test client buffers whole responses, so read the stream directly
+        request = Request({"type": "http", "method": "GET", "path": "/tracking/bus/4/stream", "headers": [], "query_string": b"",
+                           "app": main.app}, receive)
+        response = await main.stream_bus_location(4, request, current_user=None)
+        return [await anext(response.body_iterator) for _ in range(2)]
+
+    retry, event = asyncio.run(asyncio.wait_for(first_events(), timeout=5))
+    assert retry == "retry: 3000\n\n"
+    assert event.startswith(f"id: {main.tracking_hub.epoch}:{main.tracking_hub.removed[4][0]}\nevent: remove\n")
@@ -0,0 +1,122 @@
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+# Denormalized bus + route + driver rows served by the listing endpoints.
+# Every view is built once at startup and then patched from the collection
+# change hooks: a bus write rebuilds that bus, a route or driver write rebuilds
+# only the buses that reference it, and each affected driver's "my bus" view.
+
+
+def default_bus_number(bus_id: int) -> str:
+    return f"GIT-{str(bus_id).zfill(3)}"
+
+
+class BusViews:
+    def __init__(self, buses_db: Any, routes_db: Any, drivers_db: Any):
+        self.buses_db = buses_db
+        self.routes_db = routes_db
+        self.drivers_db = drivers_db
+        self.rebuilds = 0
+        self.student_buses: Dict[int, Dict[str, Any]] = {}  # /students/buses, /students/bus/{id}
+        self.admin_buses: Dict[int, Dict[str, Any]] = {}  # /admin/buses
+        self.driver_buses: Dict[int, Dict[str, Any]] = {}  # /driver/my_bus
+        self.driver_errors: Dict[int, str] = {}  # Why an assigned driver has no "my bus" view
+        self._bus_driver: Dict[int, Optional[int]] = {}
+        self.rebuild_all()
+
+    def rebuild_all(self):
+        self.student_buses.clear()
+        self.admin_buses.clear()
+        self.driver_buses.clear()
+        self.driver_errors.clear()
+        self._bus_driver.clear()
+        drivers = set()
+        for bus in self.buses_db:
+            self._build_bus(bus)
+            drivers.add(bus.get("assigned_driver_id"))
+        self._rebuild_drivers(drivers)
+
+    # --- Row builders ---
+    def _build_bus(self, bus: Dict[str, Any]):
+        bus_id = bus["id"]
+        route = self.routes_db.get(bus.get("route_id"))
+        driver = self.drivers_db.get(bus.get("assigned_driver_id"))
+        bus_number = bus.get("bus_number") or default_bus_number(bus_id)
+        self.student_buses[bus_id] = {
+            "id": bus_id,
+            "name": bus_number,
+            "route_name": route.get("name") if route else "N/A",
+            "start_time": bus.get("departure_time", "9:00 AM"),
+            "stops": route.get("stops") if route else [],
+            "driver_name": driver.get("name") if driver else "N/A",
+            "bus_number": bus_number,
+            "capacity": bus.get("capacity", 40),
+        }
+        self.admin_buses[bus_id] = {
+            **bus,
+            "driver_name": driver["name"] if driver else "N/A",
+            "route_name": route["name"] if route else "N/A",
+        }
+        self._bus_driver[bus_id] = bus.get("assigned_driver_id")
+        self.rebuilds += 1
+
+    def _build_driver(self, driver_id: int):
+        self.driver_buses.pop(driver_id, None)
+        self.driver_errors.pop(driver_id, None)
+        bus = self.buses_db.find_one("assigned_driver_id", driver_id)
+        if not bus:
+            return  # Readers treat a driver missing from both dicts as unassigned
+        route = self.routes_db.get(bus.get("route_id"))
+        if not route:
+            self.driver_errors[driver_id] = "Route not found for assigned bus."
+            return
+        stops = route.get("stops") or []
+        if not stops or stops[0].get("lat") is None or stops[0].get("lng") is None:
+            self.driver_errors[driver_id] = "Route stops with coordinates not found."
+            return
+        self.driver_buses[driver_id] = {
+            "id": bus.get("id"),
+            "bus_number": bus.get("bus_number"),
+            "route_name": route.get("name"),
+            "starting_point": bus.get("starting_point"),
+            "departure_time": bus.get("departure_time"),
+            "estimated_arrival": bus.get("estimated_arrival"),
+            "route_stops": stops,
+            "latitude": stops[0]["lat"],
+            "longitude": stops[0]["lng"],
+            "capacity": bus.get("capacity", 0),
+        }
+
+    def _rebuild_drivers(self, driver_ids: Iterable[Optional[int]]):
+        for driver_id in driver_ids:
+            if driver_id is not None:
+                self._build_driver(driver_id)
+
+    def _rebuild_buses(self, buses: List[Dict[str, Any]]):
+        for bus in buses:
+            self._build_bus(bus)
+        self._rebuild_drivers({bus.get("assigned_driver_id") for bus in buses})
+
+    # --- Change hook ---
+    def changed(self, collection: str, op: str, record: Dict[str, Any]):
+        record_id = record["id"]
+        if collection == "buses":
+            affected: Set[Optional[int]] = {self._bus_driver.pop(record_id, None)}
+            if op == "delete":
+                self.student_buses.pop(record_id, None)
+                self.admin_buses.pop(record_id, None)
+            else:
+                self._build_bus(record)
+                affected.add(record.get("assigned_driver_id"))
+            self._rebuild_drivers(affected)
+        elif collection == "routes":
+            self._rebuild_buses(self.buses_db.find_all("route_id", record_id))
+        elif collection == "drivers":
+            self._rebuild_buses(self.buses_db.find_all("assigned_driver_id", record_id))
+            self._build_driver(record_id)
+
+    # --- Reads ---
+    def student_bus_list(self) -> List[Dict[str, Any]]:
+        return list(self.student_buses.values())
+
+    def admin_bus_list(self) -> List[Dict[str, Any]]:
+        return list(self.admin_buses.values())
@@ -2,6 +2,8 @@ import json
 import os
 from pathlib import Path
 
+from .storage import write_json_atomic
+
 # Helper function to load data from JSON files
 def load_data(filename: str):
     # Get the directory of the main.py file (which is the backend root)
@@ -31,7 +33,6 @@ def save_data(filename: str, data):
     # Create the data directory if it doesn't exist
     file_path.parent.mkdir(exist_ok=True)
     
-    # Save the data
-    with open(file_path, 'w') as f:
-        json.dump(data, f, indent=4)
+    # Save the data through a temp file so a crash never truncates it
+    write_json_atomic(file_path, data)
 
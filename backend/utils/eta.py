@@ -0,0 +1,168 @@
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+# Remaining time from every live bus to every stop still ahead of it on its
+# route, computed for the whole fleet at once. The stop distances of every
+# route (from the route matcher's geometry) are packed into one padded
+# (route, stop) array; each tick the buses' matched progress along their route
+# is gathered into flat arrays, and the distance left to each downstream stop
+# is divided by the bus's recent speed in a single broadcast.
+
+
+class BusEta:
+    __slots__ = ("route_id", "first", "offset", "names", "distances", "seconds", "computed_at")
+
+    def __init__(self, route_id: int, first: int, offset: float, names: List[str],
+                 distances: np.ndarray, seconds: np.ndarray, computed_at: float):
+        self.route_id = route_id
+        self.first = first  # Index of the first stop ahead, == stop count at the last one
+        self.offset = offset  # Metres between the bus and the route line
+        self.names = names
+        # Remaining metres and seconds to stops first.. (views into the tick's arrays)
+        self.distances = distances
+        self.seconds = seconds
+        self.computed_at = computed_at
+
+
+def clock(timestamp: float) -> str:
+    # Same style as the timetable strings in buses.json, e.g. "8:45 AM"
+    moment = time.localtime(timestamp)
+    return f"{moment.tm_hour % 12 or 12}:{moment.tm_min:02d} {'AM' if moment.tm_hour < 12 else 'PM'}"
+
+
+class EtaEngine:
+    def __init__(self, matcher: Any, min_speed: float = 10.0):
+        self.matcher = matcher
+        self.min_speed = min_speed  # km/h assumed for buses that are standing still
+        self.etas: Dict[int, BusEta] = {}
+        self.compiles = 0
+        self.ticks = 0
+        self.last_buses = 0
+        self.last_compute_ms = 0.0
+        self._version: Optional[int] = None
+
+    # --- Route table ---
+    def _compile(self):
+        # Rebuilt whenever the matcher's route geometry has changed
+        geometries = list(self.matcher.geometries.values())
+        width = max((len(geometry.cumulative) for geometry in geometries), default=1)
+        self.geometries = geometries
+        self.route_index = {geometry.route_id: index for index, geometry in enumerate(geometries)}
+        self.stop_count = np.array([len(geometry.cumulative) for geometry in geometries], dtype=np.int64)
+        # Distance along the route from the first stop to each stop, padded
+        # with the route length
+        self.cumulative = np.zeros((len(geometries), width))
+        for index, geometry in enumerate(geometries):
+            self.cumulative[index, :len(geometry.cumulative)] = geometry.cumulative
+            self.cumulative[index, len(geometry.cumulative):] = geometry.total
+        self.compiles += 1
+        self._version = self.matcher.version
+
+    # --- Fleet pass ---
+    def compute(self, route_indexes: np.ndarray, along: np.ndarray, next_indexes: np.ndarray, speeds: np.ndarray) -> Dict[str, np.ndarray]:
+        # All inputs are aligned 1-d arrays, one entry per bus. Returns the
+        # metres and seconds to every stop (NaN for stops already reached and
+        # padding).
+        cumulative = self.cumulative[route_indexes]
+        remaining = cumulative - along[:, None]
+        stop_numbers = np.arange(cumulative.shape[1])
+        ahead = (stop_numbers >= next_indexes[:, None]) & (stop_numbers < self.stop_count[route_indexes][:, None])
+        metres_per_second = np.maximum(speeds, self.min_speed) / 3.6
+        seconds = np.where(ahead, remaining / metres_per_second[:, None], np.nan)
+        return {"remaining": remaining, "seconds": seconds}
+
+    def update(self, locations: Iterable[Any], now: Optional[float] = None):
+        # Recompute ETAs for the given live locations from their latest route
+        # match and write the summary fields (estimated_arrival, next_stop,
+        # next_stop_eta) back onto them
+        if self._version != self.matcher.version:
+            self._compile()
+        now = time.time() if now is None else now
+        started = time.perf_counter()
+        buses, indexes = [], []
+        for location in locations:
+            match = location.match
+            route_index = self.route_index.get(match.route_id) if match is not None and match.on_route else None
+            if route_index is None or self.geometries[route_index] is not match.geometry:
+                self._clear(location)
+                continue
+            buses.append(location)
+            indexes.append(route_index)
+        if buses:
+            r = np.array(indexes, dtype=np.int64)
+            first = np.fromiter((location.match.next_index for location in buses), dtype=np.int64, count=len(buses))
+            result = self.compute(
+                r,
+                np.fromiter((location.match.along for location in buses), dtype=np.float64, count=len(buses)),
+                first,
+                np.fromiter((location.speed or 0 for location in buses), dtype=np.float64, count=len(buses)),
+            )
+            rows = np.arange(len(buses))
+            remaining = np.round(result["remaining"], 1)
+            seconds = np.round(result["seconds"], 1)
+            last = self.stop_count[r] - 1
+            next_eta = seconds[rows, np.minimum(first, last)].tolist()
+            final_eta = seconds[rows, last].tolist()
+            arrivals: Dict[int, str] = {}
+            for row, (location, start, stop) in enumerate(zip(buses, first.tolist(), (last + 1).tolist())):
+                match = location.match
+                names = match.geometry.names
+                self.etas[location.bus_id] = BusEta(match.route_id, start, round(match.offset, 1), names,
+                                                    remaining[row, start:stop], seconds[row, start:stop], now)
+                if start < stop:
+                    minute = int(now + final_eta[row]) // 60
+                    if minute not in arrivals:
+                        arrivals[minute] = clock(minute * 60)
+                    location.next_stop = names[start]
+                    location.next_stop_eta = next_eta[row]
+                    location.estimated_arrival = arrivals[minute]
+                else:
+                    location.next_stop = None
+                    location.next_stop_eta = None
+                    location.estimated_arrival = "Arrived"
+        self.ticks += 1
+        self.last_buses = len(buses)
+        self.last_compute_ms = round((time.perf_counter() - started) * 1000, 3)
+
+    def _clear(self, location: Any):
+        self.etas.pop(location.bus_id, None)
+        location.next_stop = None
+        location.next_stop_eta = None
+        location.estimated_arrival = "N/A"
+
+    def forget(self, bus_id: int):
+        self.etas.pop(bus_id, None)
+
+    # --- Reads ---
+    def stops_for(self, bus_id: int) -> Optional[Dict[str, Any]]:
+        eta = self.etas.get(bus_id)
+        if eta is None:
+            return None
+        return {
+            "bus_id": bus_id,
+            "route_id": eta.route_id,
+            "computed_at": eta.computed_at,
+            "off_route_m": eta.offset,
+            "stops": [
+                {
+                    "stop_index": index,
+                    "name": eta.names[index],
+                    "distance_m": distance,
+                    "eta_seconds": seconds,
+                    "arrival": clock(eta.computed_at + seconds),
+                }
+                for index, distance, seconds in zip(range(eta.first, len(eta.names)), eta.distances.tolist(), eta.seconds.tolist())
+            ],
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "routes": len(self.geometries) if self._version is not None else None,
+            "compiles": self.compiles,
+            "ticks": self.ticks,
+            "buses": self.last_buses,
+            "with_eta": len(self.etas),
+            "last_compute_ms": self.last_compute_ms,
+        }
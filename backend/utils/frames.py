@@ -0,0 +1,122 @@
+import json
+import math
+import struct
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# Compact binary encoding for bus location frames. A frame is a fixed header
+# followed by one fixed-width record per bus; everything that rarely changes
+# (bus name, driver, ETA text, next stop) travels separately in a JSON
+# "metadata" message.
+#
+# Header  (little endian, 22 bytes): magic "BT", version u8, kind u8,
+#                                    epoch u64 (ms), seq u64, record count u16
+# Record  (little endian, 20 bytes): bus_id u32, lat i32 (1e-6 deg),
+#                                    lng i32 (1e-6 deg), speed u16 (0.1 km/h),
+#                                    heading u16 (0.01 deg), timestamp u32 (unix s)
+#
+# Drivers stream fixes the other way as either a 12-byte binary message
+# (client seq u32, lat i32, lng i32, same scaling) or the text "seq,lat,lng";
+# binary fixes are acknowledged with the 4-byte seq, text fixes with {"ack": seq}.
+
+MAGIC = b"BT"
+VERSION = 1
+KIND_SNAPSHOT = 1
+KIND_DELTA = 2
+KINDS = {"snapshot": KIND_SNAPSHOT, "delta": KIND_DELTA}
+
+HEADER = struct.Struct("<2sBBQQH")
+RECORD = struct.Struct("<IiiHHI")
+DRIVER_FIX = struct.Struct("<Iii")
+ACK = struct.Struct("<I")
+
+METADATA_FIELDS = ("bus_name", "driver_name", "estimated_arrival", "next_stop")
+EARTH_RADIUS = 6371000.0  # metres
+
+
+def bearing(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    # Initial great-circle bearing from point 1 to point 2, in degrees [0, 360)
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    delta_lng = math.radians(lng2 - lng1)
+    x = math.sin(delta_lng) * math.cos(phi2)
+    y = math.cos(phi1) * math.sin(phi2) - math.sin(phi1) * math.cos(phi2) * math.cos(delta_lng)
+    return math.degrees(math.atan2(x, y)) % 360
+
+
+def distance(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    # Great-circle distance between two points, in metres
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    h = math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+
+def _field(value: Any, scale: float, low: int, high: int) -> int:
+    # value * scale rounded and clamped into a record field's range, so one bad
+    # location can't make a whole frame unpackable (NaN packs as 0)
+    scaled = float(value or 0) * scale
+    if math.isnan(scaled):
+        return 0
+    return int(round(min(max(scaled, low), high)))
+
+
+def pack_record(bus_id: int, location: Dict[str, Any], heading: float = 0.0) -> bytes:
+    heading = location.get("heading", heading) or 0
+    return RECORD.pack(
+        _field(bus_id, 1, 0, 0xFFFFFFFF),
+        _field(location["lat"], 1e6, -90000000, 90000000),
+        _field(location["lng"], 1e6, -180000000, 180000000),
+        _field(location.get("speed"), 10, 0, 0xFFFF),
+        _field(heading % 360 if math.isfinite(heading) else 0, 100, 0, 36000) % 36000,
+        _field(location.get("timestamp") or time.time(), 1, 0, 0xFFFFFFFF),
+    )
+
+
+def pack_frame(kind: str, epoch: int, seq: int, records: List[bytes]) -> bytes:
+    return HEADER.pack(MAGIC, VERSION, KINDS[kind], epoch, seq, len(records)) + b"".join(records)
+
+
+def unpack_frame(data: bytes) -> Dict[str, Any]:
+    magic, version, kind, epoch, seq, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a bus location frame")
+    records = []
+    for index in range(count):
+        bus_id, lat, lng, speed, heading, timestamp = RECORD.unpack_from(data, HEADER.size + index * RECORD.size)
+        records.append({
+            "bus_id": bus_id, "lat": lat / 1e6, "lng": lng / 1e6,
+            "speed": speed / 10, "heading": heading / 100, "timestamp": timestamp,
+        })
+    kind_name = next(name for name, value in KINDS.items() if value == kind)
+    return {"type": kind_name, "version": version, "epoch": epoch, "seq": seq, "bus_locations": records}
+
+
+def metadata_of(location: Dict[str, Any]) -> Dict[str, Any]:
+    return {field: location.get(field) for field in METADATA_FIELDS}
+
+
+def metadata_message(metadata: Dict[int, Dict[str, Any]], route_ids: Optional[Dict[int, Optional[int]]] = None) -> str:
+    buses = {
+        str(bus_id): {**fields, "route_id": (route_ids or {}).get(bus_id)}
+        for bus_id, fields in metadata.items()
+    }
+    return json.dumps({"type": "metadata", "buses": buses})
+
+
+def parse_driver_fix(message: Any) -> Tuple[int, float, float]:
+    # Raises ValueError for malformed fixes
+    if isinstance(message, (bytes, bytearray)):
+        try:
+            seq, lat, lng = DRIVER_FIX.unpack(message)
+        except struct.error as exc:
+            raise ValueError(str(exc)) from exc
+        lat, lng = lat / 1e6, lng / 1e6
+    else:
+        seq_text, lat_text, lng_text = message.split(",")
+        seq, lat, lng = int(seq_text), float(lat_text), float(lng_text)
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError("Coordinates out of range")
+    return seq, lat, lng
+
+
+def driver_ack(seq: int, binary: bool) -> Any:
+    return ACK.pack(seq) if binary else f'{{"ack": {seq}}}'
@@ -0,0 +1,100 @@
+from array import array
+from bisect import bisect_right
+from typing import Iterator, List, Optional, Tuple
+
+# Fixed-capacity breadcrumb trail for one bus. Timestamps, latitudes and
+# longitudes live in three preallocated float arrays used as a ring, so a trip
+# of any length costs capacity * 24 bytes and the oldest points fall off the
+# end. Points are kept in timestamp order: a fix that arrives late (e.g. from a
+# batch upload) is slotted in place, which is O(n) but rare; everything else
+# is an O(1) append.
+
+
+class _Timestamps:
+    # Logical (oldest-first) view over the timestamp ring for bisect
+    def __init__(self, history: "LocationHistory"):
+        self.history = history
+
+    def __len__(self) -> int:
+        return self.history.count
+
+    def __getitem__(self, index: int) -> float:
+        return self.history.timestamps[self.history._slot(index)]
+
+
+class LocationHistory:
+    def __init__(self, capacity: int = 1000):
+        self.capacity = capacity
+        self.count = 0
+        self._start = 0
+        self.timestamps: Optional[array] = None
+        self.lats: Optional[array] = None
+        self.lngs: Optional[array] = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _slot(self, index: int) -> int:
+        return (self._start + index) % self.capacity
+
+    def _allocate(self):
+        zeros = bytes(8 * self.capacity)
+        self.timestamps, self.lats, self.lngs = array("d", zeros), array("d", zeros), array("d", zeros)
+
+    def _put(self, index: int, timestamp: float, lat: float, lng: float):
+        slot = self._slot(index)
+        self.timestamps[slot], self.lats[slot], self.lngs[slot] = timestamp, lat, lng
+
+    def add(self, timestamp: float, lat: float, lng: float) -> bool:
+        # Returns False when the point is older than a full buffer's oldest one
+        if self.capacity <= 0:
+            return False
+        if self.timestamps is None:
+            self._allocate()
+        position = bisect_right(_Timestamps(self), timestamp)
+        if self.count == self.capacity:
+            if position == 0:
+                return False
+            # Drop the oldest point to make room
+            self._start = self._slot(1)
+            self.count -= 1
+            position -= 1
+        for index in range(self.count, position, -1):
+            source = self._slot(index - 1)
+            self._put(index, self.timestamps[source], self.lats[source], self.lngs[source])
+        self._put(position, timestamp, lat, lng)
+        self.count += 1
+        return True
+
+    def clear(self):
+        self.count = 0
+        self._start = 0
+
+    def __iter__(self) -> Iterator[Tuple[float, float, float]]:
+        return self.between(0, self.count)
+
+    def between(self, first: int, last: int) -> Iterator[Tuple[float, float, float]]:
+        for index in range(first, last):
+            slot = self._slot(index)
+            yield self.timestamps[slot], self.lats[slot], self.lngs[slot]
+
+    def window(self, since: Optional[float] = None, limit: Optional[int] = None) -> Tuple[int, int]:
+        # Logical index range of the points to return: with `since`, the
+        # oldest `limit` points strictly after it (so clients can page
+        # forward); without, the newest `limit` points
+        limit = self.count if limit is None else max(0, limit)
+        if since is None:
+            return max(0, self.count - limit), self.count
+        first = bisect_right(_Timestamps(self), since)
+        return first, min(self.count, first + limit)
+
+    def segments(self, first: int, last: int) -> List[Tuple[memoryview, memoryview, memoryview]]:
+        # The logical range [first, last) as at most two contiguous slices of
+        # the underlying arrays, without copying them
+        if first >= last:
+            return []
+        start, end = self._slot(first), self._slot(last - 1) + 1
+        views = (memoryview(self.timestamps), memoryview(self.lats), memoryview(self.lngs))
+        if start < end:
+            return [tuple(view[start:end] for view in views)]
+        return [tuple(view[start:] for view in views), tuple(view[:end] for view in views)]
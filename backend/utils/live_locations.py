@@ -0,0 +1,183 @@
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .frames import bearing, distance
+from .history import LocationHistory
+from .spatial import GridIndex
+
+# The live position of every bus, keyed by bus_id, with a driver_id -> bus_id
+# index for driver-side writes and a spatial grid for nearby-bus queries. A bus is either simulated (demo data moved by
+# the background task) or on a trip reported by its driver; both kinds share
+# one record type so tracking reads are a single dict lookup. Every record
+# keeps a bounded breadcrumb trail of the positions it has moved through.
+
+# Fixes closer together than MIN_SPEED_INTERVAL seconds don't update the
+# speed; each one that does moves it SPEED_SMOOTHING of the way towards the
+# observed speed, capped at MAX_SPEED km/h to ride out GPS jumps
+MIN_SPEED_INTERVAL = 1.0
+SPEED_SMOOTHING = 0.3
+MAX_SPEED = 120.0
+# Speed assumed for a bus starting a trip (km/h), until its fixes measure one
+TRIP_START_SPEED = 30.0
+
+
+class LiveLocation:
+    __slots__ = (
+        "bus_id", "lat", "lng", "speed", "heading", "timestamp",
+        "driver_id", "trip_id", "driver_name", "bus_name", "estimated_arrival",
+        "simulated", "last_seq", "history", "match", "next_stop", "next_stop_eta",
+    )
+
+    def __init__(self, bus_id: int, lat: float, lng: float, speed: float = 0, driver_name: str = "N/A",
+                 bus_name: Optional[str] = None, estimated_arrival: str = "N/A", simulated: bool = False,
+                 history_size: int = 1000):
+        self.bus_id = bus_id
+        self.lat = lat
+        self.lng = lng
+        self.speed = speed
+        self.heading: Optional[float] = None
+        self.timestamp = time.time()
+        self.driver_id: Optional[int] = None
+        self.trip_id: Optional[int] = None
+        self.driver_name = driver_name
+        self.bus_name = bus_name
+        self.estimated_arrival = estimated_arrival
+        self.simulated = simulated
+        # Highest batch seq accepted on the current trip
+        self.last_seq = 0
+        self.history = LocationHistory(history_size)
+        self.history.add(self.timestamp, lat, lng)
+        # Filled in by the route matcher and ETA engine for buses on a known route
+        self.match: Optional[Any] = None
+        self.next_stop: Optional[str] = None
+        self.next_stop_eta: Optional[float] = None
+
+    def move(self, lat: float, lng: float, timestamp: Optional[float] = None, record: bool = True):
+        timestamp = time.time() if timestamp is None else timestamp
+        if (lat, lng) != (self.lat, self.lng):
+            self.heading = bearing(self.lat, self.lng, lat, lng)
+        # Track the speed actually covered between fixes (km/h, smoothed)
+        elapsed = timestamp - self.timestamp
+        if elapsed >= MIN_SPEED_INTERVAL:
+            observed = min(distance(self.lat, self.lng, lat, lng) / elapsed * 3.6, MAX_SPEED)
+            self.speed = round(self.speed + SPEED_SMOOTHING * (observed - self.speed), 1)
+        self.lat = lat
+        self.lng = lng
+        self.timestamp = timestamp
+        if record:
+            self.history.add(self.timestamp, lat, lng)
+
+    def to_dict(self) -> Dict[str, Any]:
+        # The broadcast payload for this bus
+        location = {
+            "bus_id": self.bus_id,
+            "lat": self.lat,
+            "lng": self.lng,
+            "speed": self.speed,
+            "driver_name": self.driver_name,
+            "estimated_arrival": self.estimated_arrival,
+            "bus_name": self.bus_name,
+            "timestamp": self.timestamp,
+        }
+        if self.heading is not None:
+            location["heading"] = self.heading
+        if self.match is not None and self.match.on_route:
+            location["distance_along_route"] = round(self.match.along, 1)
+        if self.next_stop is not None:
+            location["next_stop"] = self.next_stop
+            location["next_stop_eta"] = self.next_stop_eta
+        return location
+
+
+class LiveLocationStore:
+    def __init__(self, history_size: int = 1000, cell_size: float = 500.0):
+        self.history_size = history_size
+        self.grid = GridIndex(cell_size)
+        self._by_bus: Dict[int, LiveLocation] = {}
+        self._bus_by_driver: Dict[int, int] = {}
+        self._next_trip_id = 0
+
+    def __len__(self) -> int:
+        return len(self._by_bus)
+
+    def __iter__(self) -> Iterator[LiveLocation]:
+        return iter(list(self._by_bus.values()))
+
+    def __contains__(self, bus_id: int) -> bool:
+        return bus_id in self._by_bus
+
+    def get(self, bus_id: int) -> Optional[LiveLocation]:
+        return self._by_bus.get(bus_id)
+
+    def for_driver(self, driver_id: int) -> Optional[LiveLocation]:
+        bus_id = self._bus_by_driver.get(driver_id)
+        return self._by_bus.get(bus_id) if bus_id is not None else None
+
+    def on_trip(self, bus_id: int) -> bool:
+        location = self._by_bus.get(bus_id)
+        return location is not None and location.trip_id is not None
+
+    def simulate(self, bus_id: int, lat: float, lng: float, **fields: Any) -> LiveLocation:
+        location = LiveLocation(bus_id, lat, lng, simulated=True, history_size=self.history_size, **fields)
+        self._by_bus[bus_id] = location
+        self.grid.put(bus_id, lat, lng, location)
+        return location
+
+    def move(self, location: LiveLocation, lat: float, lng: float, timestamp: Optional[float] = None, record: bool = True):
+        # All position changes go through here so the grid stays current
+        location.move(lat, lng, timestamp, record)
+        self.grid.put(location.bus_id, location.lat, location.lng, location)
+
+    def start_trip(self, bus_id: int, driver_id: int, lat: float, lng: float, driver_name: str = "N/A",
+                   bus_name: Optional[str] = None, speed: float = TRIP_START_SPEED) -> LiveLocation:
+        if driver_id in self._bus_by_driver:
+            raise KeyError(f"Driver {driver_id} already has an active trip")
+        location = self._by_bus.get(bus_id)
+        if location is None:
+            location = self._by_bus[bus_id] = LiveLocation(bus_id, lat, lng, history_size=self.history_size)
+        elif location.trip_id is not None:
+            raise KeyError(f"Bus {bus_id} is already on a trip")
+        self._next_trip_id += 1
+        self.move(location, lat, lng)
+        location.heading = None
+        location.speed = speed
+        location.driver_id = driver_id
+        location.trip_id = self._next_trip_id
+        location.driver_name = driver_name
+        location.bus_name = bus_name
+        location.estimated_arrival = "N/A"
+        location.last_seq = 0
+        location.match = None
+        self._bus_by_driver[driver_id] = bus_id
+        return location
+
+    def end_trip(self, driver_id: int) -> Optional[LiveLocation]:
+        # Simulated buses keep their record and go back to being simulated
+        # from where the trip left them; other buses drop out of the store
+        bus_id = self._bus_by_driver.pop(driver_id, None)
+        if bus_id is None:
+            return None
+        location = self._by_bus[bus_id]
+        if not location.simulated:
+            del self._by_bus[bus_id]
+            self.grid.remove(bus_id)
+        location.driver_id = None
+        location.trip_id = None
+        location.estimated_arrival = "N/A"
+        location.match = None
+        location.next_stop = None
+        location.next_stop_eta = None
+        return location
+
+    def remove(self, bus_id: int) -> Optional[LiveLocation]:
+        location = self._by_bus.pop(bus_id, None)
+        if location is not None and location.driver_id is not None:
+            self._bus_by_driver.pop(location.driver_id, None)
+        self.grid.remove(bus_id)
+        return location
+
+    def nearest(self, lat: float, lng: float, k: int, max_radius: Optional[float] = None) -> List[Tuple[float, LiveLocation]]:
+        return [(metres, location) for metres, _, location in self.grid.nearest(lat, lng, k, max_radius)]
+
+    def snapshot(self) -> Dict[int, Dict[str, Any]]:
+        return {bus_id: location.to_dict() for bus_id, location in self._by_bus.items()}
@@ -0,0 +1,70 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List
+
+# In-process event bus for accepted bus location fixes. Each fix is pushed to
+# subscribers as soon as it arrives, unless the same bus was pushed less than
+# `min_interval` seconds ago; then it is held back and only the newest fix in
+# that window is delivered when the interval runs out.
+
+LocationSubscriber = Callable[[Dict[int, Dict[str, Any]]], Awaitable[None]]
+
+
+class LocationEventBus:
+    def __init__(self, min_interval: float = 0.25):
+        self.min_interval = min_interval
+        self.published = 0
+        self.coalesced = 0
+        self._subscribers: List[LocationSubscriber] = []
+        self._last_sent: Dict[int, float] = {}
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._timers: Dict[int, asyncio.TimerHandle] = {}
+        # In-flight subscriber calls and the bus each one is delivering
+        self._tasks: Dict[asyncio.Task, int] = {}
+
+    def subscribe(self, callback: LocationSubscriber):
+        self._subscribers.append(callback)
+
+    def publish(self, bus_id: int, location: Dict[str, Any]):
+        now = time.monotonic()
+        wait = self._last_sent.get(bus_id, float("-inf")) + self.min_interval - now
+        if wait <= 0 and bus_id not in self._timers:
+            self._dispatch(bus_id, location, now)
+            return
+        if bus_id in self._pending:
+            self.coalesced += 1
+        self._pending[bus_id] = location
+        if bus_id not in self._timers:
+            self._timers[bus_id] = asyncio.get_running_loop().call_later(max(wait, 0), self._flush, bus_id)
+
+    def _flush(self, bus_id: int):
+        self._timers.pop(bus_id, None)
+        location = self._pending.pop(bus_id, None)
+        if location is not None:
+            self._dispatch(bus_id, location, time.monotonic())
+
+    def _dispatch(self, bus_id: int, location: Dict[str, Any], now: float):
+        self._last_sent[bus_id] = now
+        self.published += 1
+        for callback in self._subscribers:
+            task = asyncio.get_running_loop().create_task(callback({bus_id: location}))
+            # Hold a reference until the task finishes so it is not collected early
+            self._tasks[task] = bus_id
+            task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task):
+        self._tasks.pop(task, None)
+
+    async def finish(self, bus_id: int):
+        # A bus's trip has ended: deliver the fix still held back for it, wait
+        # until subscribers have it, and drop its rate-limit state
+        timer = self._timers.pop(bus_id, None)
+        if timer is not None:
+            timer.cancel()
+        location = self._pending.pop(bus_id, None)
+        if location is not None:
+            self._dispatch(bus_id, location, time.monotonic())
+        tasks = [task for task, task_bus_id in self._tasks.items() if task_bus_id == bus_id]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._last_sent.pop(bus_id, None)
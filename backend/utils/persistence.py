@@ -0,0 +1,117 @@
+import asyncio
+import atexit
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+
+# Background writer for the storage backends. Handlers only mark a collection
+# dirty; a worker thread writes it once the collection has been quiet for
+# `window` seconds (or has been dirty for `max_delay`), so a burst of admin
+# edits costs one disk write and the event loop never waits on file I/O.
+# Only the JSON and WAL stores use it: the SQLite store commits each write
+# inline, on the request path, inside the collection call that made it.
+
+logger = logging.getLogger(__name__)
+
+
+class PersistenceScheduler:
+    def __init__(self, write: Callable[[str], None], window: float = 0.5, max_delay: float = 5.0):
+        self._write = write
+        self.window = window
+        self.max_delay = max_delay
+        self.writes = 0
+        self._cond = threading.Condition()
+        self._dirty: Dict[str, Tuple[float, float]] = {}  # name -> (first marked, last marked)
+        self._requested: Dict[str, int] = {}
+        self._durable: Dict[str, int] = {}
+        self._flush_now: Set[str] = set()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+    def mark_dirty(self, name: str) -> int:
+        with self._cond:
+            now = time.monotonic()
+            first_marked = self._dirty[name][0] if name in self._dirty else now
+            self._dirty[name] = (first_marked, now)
+            self._requested[name] = self._requested.get(name, 0) + 1
+            self._cond.notify_all()
+            return self._requested[name]
+
+    def _due(self, now: float) -> Tuple[Dict[str, int], Optional[float]]:
+        due: Dict[str, int] = {}
+        next_wakeup = None
+        for name, (first_marked, last_marked) in self._dirty.items():
+            deadline = min(last_marked + self.window, first_marked + self.max_delay)
+            if self._stopping or name in self._flush_now or now >= deadline:
+                due[name] = self._requested[name]
+            else:
+                next_wakeup = deadline if next_wakeup is None else min(next_wakeup, deadline)
+        return due, next_wakeup
+
+    def _run(self):
+        with self._cond:
+            while True:
+                due, next_wakeup = self._due(time.monotonic())
+                if not due:
+                    if self._stopping:
+                        return
+                    self._cond.wait(None if next_wakeup is None else max(0.0, next_wakeup - time.monotonic()))
+                    continue
+                for name in due:
+                    del self._dirty[name]
+                    self._flush_now.discard(name)
+                self._cond.release()
+                written: Dict[str, int] = {}
+                try:
+                    for name, generation in due.items():
+                        try:
+                            self._write(name)
+                            written[name] = generation
+                        except Exception:
+                            logger.exception("Error persisting '%s'", name)
+                finally:
+                    self._cond.acquire()
+                for name, generation in due.items():
+                    if name in written:
+                        self._durable[name] = max(self._durable.get(name, 0), generation)
+                        self.writes += 1
+                    elif not self._stopping:
+                        # Retry after the next window instead of dropping the change
+                        now = time.monotonic()
+                        self._dirty.setdefault(name, (now, now))
+                self._cond.notify_all()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def flush(self, names: Optional[Iterable[str]] = None, timeout: Optional[float] = None) -> bool:
+        # Block until everything marked dirty so far is on disk
+        with self._cond:
+            targets = {name: self._requested[name] for name in (names or list(self._requested)) if name in self._requested}
+            if self._thread is None:
+                for name in targets:
+                    self._dirty.pop(name, None)
+                    self._write(name)
+                    self._durable[name] = targets[name]
+                return True
+            self._flush_now.update(name for name in targets if name in self._dirty)
+            self._cond.notify_all()
+            return self._cond.wait_for(
+                lambda: all(self._durable.get(name, 0) >= target for name, target in targets.items()), timeout
+            )
+
+    async def wait_durable(self, *names: str, timeout: Optional[float] = None) -> bool:
+        return await asyncio.to_thread(self.flush, names or None, timeout)
+
+    def close(self):
+        with self._cond:
+            if self._thread is None:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
@@ -0,0 +1,174 @@
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# In-memory repository used by AppState. Each collection keeps its records keyed
+# by "id" plus hash indexes on the lookup fields used by the API handlers, so
+# auth and join lookups stay O(1) no matter how large the roster gets.
+
+
+class Collection:
+    def __init__(
+        self,
+        name: str,
+        records: Iterable[Dict[str, Any]],
+        unique_indexes: Tuple[str, ...] = (),
+        indexes: Tuple[str, ...] = (),
+        last_id: int = 0,
+        on_change: Optional[Callable[["Collection", str, Dict[str, Any]], None]] = None,
+    ):
+        self.name = name
+        self.unique_indexes = unique_indexes
+        self.indexes = indexes
+        self.on_change = on_change
+        self.lock = threading.RLock()
+        self._records: Dict[int, Dict[str, Any]] = {}
+        self._unique: Dict[str, Dict[Any, int]] = {field: {} for field in unique_indexes}
+        # Non-unique indexes map a value to the set of ids with it, kept in id
+        # order so find_one always returns the oldest record
+        self._multi: Dict[str, Dict[Any, Dict[int, None]]] = {field: {} for field in indexes}
+        for record in records:
+            self._add(record)
+        self.last_id = max([last_id, *self._records.keys()]) if self._records else last_id
+
+    # --- Index maintenance ---
+    def _index(self, record: Dict[str, Any]):
+        record_id = record["id"]
+        for field, index in self._unique.items():
+            if record.get(field) is not None:
+                index[record[field]] = record_id
+        for field, index in self._multi.items():
+            if record.get(field) is not None:
+                self._join(index, record[field], record_id)
+
+    @staticmethod
+    def _join(index: Dict[Any, Dict[int, None]], value: Any, record_id: int):
+        ids = index.setdefault(value, {})
+        ids[record_id] = None
+        if len(ids) > 1 and any(other > record_id for other in ids):
+            index[value] = dict.fromkeys(sorted(ids))
+
+    @staticmethod
+    def _leave(index: Dict[Any, Dict[int, None]], value: Any, record_id: int):
+        ids = index.get(value)
+        if ids is not None:
+            ids.pop(record_id, None)
+            if not ids:
+                del index[value]
+
+    def _reindex(self, current: Dict[str, Any], updated: Dict[str, Any]):
+        # Only fields whose value changed move, so records sharing an unchanged
+        # value keep their place (and find_one its answer)
+        record_id = updated["id"]
+        for field, index in self._unique.items():
+            old, new = current.get(field), updated.get(field)
+            if old != new:
+                if old is not None and index.get(old) == record_id:
+                    del index[old]
+                if new is not None:
+                    index[new] = record_id
+        for field, index in self._multi.items():
+            old, new = current.get(field), updated.get(field)
+            if old != new:
+                if old is not None:
+                    self._leave(index, old, record_id)
+                if new is not None:
+                    self._join(index, new, record_id)
+
+    def _unindex(self, record: Dict[str, Any]):
+        record_id = record["id"]
+        for field, index in self._unique.items():
+            if index.get(record.get(field)) == record_id:
+                del index[record[field]]
+        for field, index in self._multi.items():
+            if record.get(field) is not None:
+                self._leave(index, record[field], record_id)
+
+    def _add(self, record: Dict[str, Any]):
+        self._records[record["id"]] = record
+        self._index(record)
+
+    def _changed(self, op: str, record: Dict[str, Any]):
+        if self.on_change:
+            self.on_change(self, op, record)
+
+    # --- Reads ---
+    def get(self, record_id: Any) -> Optional[Dict[str, Any]]:
+        return self._records.get(record_id)
+
+    def find_one(self, field: str, value: Any) -> Optional[Dict[str, Any]]:
+        if field == "id":
+            return self._records.get(value)
+        if field in self._unique:
+            record_id = self._unique[field].get(value)
+            return self._records.get(record_id) if record_id is not None else None
+        if field in self._multi:
+            ids = self._multi[field].get(value)
+            return self._records[next(iter(ids))] if ids else None
+        raise KeyError(f"No index on '{field}' for collection '{self.name}'")
+
+    def find_all(self, field: str, value: Any) -> List[Dict[str, Any]]:
+        if field in self._multi:
+            return [self._records[record_id] for record_id in self._multi[field].get(value, ())]
+        record = self.find_one(field, value)
+        return [record] if record else []
+
+    def exists(self, field: str, value: Any) -> bool:
+        return self.find_one(field, value) is not None
+
+    def first(self) -> Optional[Dict[str, Any]]:
+        return next(iter(self._records.values()), None)
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            return list(self._records.values())
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(list(self._records.values()))
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __repr__(self) -> str:
+        return f"Collection({self.name!r}, {len(self._records)} records)"
+
+    # --- Writes ---
+    def next_id(self) -> int:
+        with self.lock:
+            self.last_id += 1
+            return self.last_id
+
+    def insert(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        with self.lock:
+            if record.get("id") is None:
+                record["id"] = self.next_id()
+            elif record["id"] in self._records:
+                raise KeyError(f"Duplicate id {record['id']} in collection '{self.name}'")
+            else:
+                self.last_id = max(self.last_id, record["id"])
+            self._add(record)
+        self._changed("put", record)
+        return record
+
+    def update(self, record_id: Any, changes: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            current = self._records.get(record_id)
+            if current is None:
+                return None
+            updated = current.copy()
+            updated.update(changes)
+            updated["id"] = record_id
+            # Assigning over the existing key keeps the record's position in listings
+            self._records[record_id] = updated
+            self._reindex(current, updated)
+        self._changed("put", updated)
+        return updated
+
+    def delete(self, record_id: Any) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            current = self._records.get(record_id)
+            if current is None:
+                return None
+            self._unindex(current)
+            del self._records[record_id]
+        self._changed("delete", current)
+        return current
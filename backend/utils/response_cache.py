@@ -0,0 +1,68 @@
+import json
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+# Encoded JSON bodies for read endpoints whose output only changes when a
+# collection is written. Every collection has a version counter that the
+# change hook bumps; a cached body is reused while the versions it was built
+# from are unchanged, and its ETag is derived from those versions so clients
+# can revalidate with If-None-Match and get a 304 without a body.
+#
+# A shared cache takes its versions from the store's write counters instead
+# (set_versions), which every worker process sees alike; ETags then carry no
+# per-process epoch, so any worker can validate another worker's ETag.
+
+
+class ResponseCache:
+    def __init__(self, shared: bool = False):
+        # A new epoch per process keeps ETags from a previous run from matching;
+        # shared versions never repeat, so they need none
+        self.shared = shared
+        self.epoch = 0 if shared else int(time.time() * 1000)
+        self.versions: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        # key -> (dependency versions, body, etag)
+        self._entries: Dict[str, Tuple[Tuple[int, ...], bytes, str]] = {}
+
+    def bump(self, collection: str):
+        self.versions[collection] = self.versions.get(collection, 0) + 1
+
+    def set_versions(self, versions: Dict[str, int]):
+        self.versions.update(versions)
+
+    def etag(self, depends_on: Iterable[str]) -> str:
+        return f'"{self.epoch}-' + "-".join(str(self.versions.get(name, 0)) for name in depends_on) + '"'
+
+    def get(self, key: str, depends_on: Tuple[str, ...], build: Callable[[], Any]) -> Tuple[bytes, str]:
+        versions = tuple(self.versions.get(name, 0) for name in depends_on)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == versions:
+            self.hits += 1
+            return entry[1], entry[2]
+        self.misses += 1
+        # Same encoding FastAPI's JSONResponse would produce
+        body = json.dumps(build(), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        etag = self.etag(depends_on)
+        self._entries[key] = (versions, body, etag)
+        return body, etag
+
+    def matches(self, if_none_match: Optional[str], etag: str) -> bool:
+        if not if_none_match:
+            return False
+        candidates = [tag.strip() for tag in if_none_match.split(",")]
+        if "*" in candidates or etag in candidates or f"W/{etag}" in candidates:
+            self.not_modified += 1
+            return True
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "shared": self.shared,
+            "versions": dict(self.versions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+        }
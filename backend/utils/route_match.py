@@ -0,0 +1,181 @@
+import math
+from bisect import bisect_right
+from typing import Any, Dict, List, Optional, Tuple
+
+from .frames import EARTH_RADIUS
+
+# Map matching of bus fixes onto their route. Each route's stop sequence is
+# compiled once (when routes load or change) into projected segments with
+# cumulative distances and padded bounding boxes; a fix is then projected onto
+# the nearest candidate segment to get its distance along the route and the
+# next stop. Progress is kept monotonic within a small tolerance so GPS jitter
+# around a stop doesn't walk the bus backwards, and when a road is used in both
+# directions the candidate that continues from the previous match wins.
+
+METRES_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+
+class RouteGeometry:
+    __slots__ = ("route_id", "names", "lats", "lngs", "x_scale", "xs", "ys", "lengths", "cumulative", "boxes", "total")
+
+    def __init__(self, route_id: int, stops: List[Dict[str, Any]], margin: float):
+        self.route_id = route_id
+        self.names = [stop.get("name") or f"Stop {number + 1}" for number, stop in enumerate(stops)]
+        self.lats = [float(stop["lat"]) for stop in stops]
+        self.lngs = [float(stop["lng"]) for stop in stops]
+        # Equirectangular projection around the route's mean latitude; plenty
+        # accurate over the few kilometres a route spans
+        self.x_scale = math.cos(math.radians(sum(self.lats) / len(self.lats))) * METRES_PER_DEGREE
+        self.xs = [lng * self.x_scale for lng in self.lngs]
+        self.ys = [lat * METRES_PER_DEGREE for lat in self.lats]
+        self.lengths: List[float] = []
+        self.cumulative = [0.0]
+        self.boxes: List[Tuple[float, float, float, float]] = []
+        for index in range(len(stops) - 1):
+            x1, y1, x2, y2 = self.xs[index], self.ys[index], self.xs[index + 1], self.ys[index + 1]
+            length = math.hypot(x2 - x1, y2 - y1)
+            self.lengths.append(length)
+            self.cumulative.append(self.cumulative[-1] + length)
+            self.boxes.append((min(x1, x2) - margin, min(y1, y2) - margin, max(x1, x2) + margin, max(y1, y2) + margin))
+        self.total = self.cumulative[-1]
+
+    def project(self, lat: float, lng: float) -> Tuple[float, float]:
+        return lng * self.x_scale, lat * METRES_PER_DEGREE
+
+    def point_at(self, along: float) -> Tuple[float, float]:
+        # (lat, lng) of the point `along` metres from the first stop
+        segment = min(max(bisect_right(self.cumulative, along) - 1, 0), len(self.lengths) - 1)
+        t = (along - self.cumulative[segment]) / self.lengths[segment] if self.lengths[segment] > 0 else 0.0
+        t = min(max(t, 0.0), 1.0)
+        return (self.lats[segment] + t * (self.lats[segment + 1] - self.lats[segment]),
+                self.lngs[segment] + t * (self.lngs[segment + 1] - self.lngs[segment]))
+
+
+class RouteMatch:
+    __slots__ = ("geometry", "segment", "along", "offset", "next_index", "on_route", "lat", "lng")
+
+    def __init__(self, geometry: RouteGeometry, segment: int, along: float, offset: float, next_index: int, on_route: bool):
+        self.geometry = geometry
+        self.segment = segment
+        self.along = along  # Metres from the first stop
+        self.offset = offset  # Metres between the fix and the route line
+        self.next_index = next_index  # == stop count once the last stop is reached
+        self.on_route = on_route
+        self.lat, self.lng = geometry.point_at(along)
+
+    @property
+    def route_id(self) -> int:
+        return self.geometry.route_id
+
+    @property
+    def next_stop(self) -> Optional[str]:
+        names = self.geometry.names
+        return names[self.next_index] if self.next_index < len(names) else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "route_id": self.route_id,
+            "distance_along_route": round(self.along, 1),
+            "route_length": round(self.geometry.total, 1),
+            "off_route_m": round(self.offset, 1),
+            "on_route": self.on_route,
+            "next_stop_index": self.next_index,
+            "next_stop": self.next_stop,
+            "snapped": {"lat": self.lat, "lng": self.lng},
+        }
+
+
+class RouteMatcher:
+    def __init__(self, routes_db: Any, max_offset: float = 1000.0, search_radius: float = 200.0,
+                 stop_radius: float = 25.0, backtrack: float = 30.0, ambiguity: float = 20.0):
+        self.max_offset = max_offset  # Fixes further than this (metres) from the route are off route
+        self.search_radius = search_radius  # Segment boxes are padded by this; no hit means all segments
+        self.stop_radius = stop_radius  # Within this of a stop counts as having reached it
+        self.backtrack = backtrack  # Backward moves up to this are treated as jitter
+        self.ambiguity = ambiguity  # Segments this close to the nearest one are also candidates
+        self.routes_db = routes_db
+        self.geometries: Dict[int, RouteGeometry] = {}
+        self.version = 0
+        self.matches = 0
+        self.rebuild()
+
+    # --- Route geometry ---
+    def rebuild(self):
+        self.geometries.clear()
+        for route in self.routes_db:
+            self._build(route)
+
+    def _build(self, route: Dict[str, Any]):
+        stops = [stop for stop in route.get("stops") or [] if stop.get("lat") is not None and stop.get("lng") is not None]
+        if len(stops) >= 2:
+            self.geometries[route["id"]] = RouteGeometry(route["id"], stops, self.search_radius)
+        else:
+            self.geometries.pop(route["id"], None)
+        self.version += 1
+
+    def changed(self, collection: str, op: str, record: Dict[str, Any]):
+        if collection != "routes":
+            return
+        if op == "delete":
+            self.geometries.pop(record["id"], None)
+            self.version += 1
+        else:
+            self._build(record)
+
+    # --- Matching ---
+    def match(self, route_id: Optional[int], lat: float, lng: float, previous: Optional[RouteMatch] = None) -> Optional[RouteMatch]:
+        geometry = self.geometries.get(route_id)
+        if geometry is None:
+            return None
+        self.matches += 1
+        x, y = geometry.project(lat, lng)
+        boxes = geometry.boxes
+        candidates = [index for index, (x1, y1, x2, y2) in enumerate(boxes) if x1 <= x <= x2 and y1 <= y <= y2]
+        # (offset, along, segment) for each candidate segment
+        projections = []
+        for index in candidates or range(len(boxes)):
+            ax, ay = geometry.xs[index], geometry.ys[index]
+            dx, dy = geometry.xs[index + 1] - ax, geometry.ys[index + 1] - ay
+            length = geometry.lengths[index]
+            t = ((x - ax) * dx + (y - ay) * dy) / (length * length) if length > 0 else 0.0
+            t = min(max(t, 0.0), 1.0)
+            offset = math.hypot(x - (ax + t * dx), y - (ay + t * dy))
+            projections.append((offset, geometry.cumulative[index] + t * length, index))
+        nearest = min(projections)[0]
+        pool = [projection for projection in projections if projection[0] <= nearest + self.ambiguity]
+
+        if previous is not None and previous.geometry is geometry:
+            # Continue from the previous match: the least progress that isn't
+            # a real step backwards, and no backwards jitter at all
+            forward = [projection for projection in pool if projection[1] >= previous.along - self.backtrack]
+            if forward:
+                offset, along, segment = min(forward, key=lambda projection: projection[1])
+                along = max(along, previous.along)
+            else:
+                offset, along, segment = min(pool)
+        else:
+            # A fresh match (trip start, new route): the earliest candidate
+            offset, along, segment = min(pool, key=lambda projection: projection[1])
+
+        next_index = bisect_right(geometry.cumulative, along + self.stop_radius)
+        return RouteMatch(geometry, segment, along, offset, next_index, offset <= self.max_offset)
+
+    def match_location(self, location: Any, route_id: Optional[int]) -> Optional[RouteMatch]:
+        # Match a live location's current position and keep the result (and
+        # its next stop) on it; the previous match there provides continuity
+        previous = location.match
+        match = location.match = self.match(route_id, location.lat, location.lng, previous)
+        next_stop = match.next_stop if match is not None and match.on_route else None
+        if next_stop != location.next_stop:
+            # The ETA to the old next stop no longer applies until the next tick
+            location.next_stop = next_stop
+            location.next_stop_eta = None
+        return match
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "routes": len(self.geometries),
+            "segments": sum(len(geometry.lengths) for geometry in self.geometries.values()),
+            "version": self.version,
+            "matches": self.matches,
+        }
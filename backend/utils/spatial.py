@@ -0,0 +1,165 @@
+import math
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from .frames import distance
+from .route_match import METRES_PER_DEGREE
+
+# Uniform lat/lng grid for "what is near this point" queries. Items live in
+# square cells of cell_size metres (measured along a meridian; cells get
+# narrower east-west away from the equator, which the queries account for).
+# Radius queries only look at the cells overlapping the circle's bounding box;
+# k-nearest queries scan rings of cells outwards until the k-th best distance
+# is inside the area already covered. Moving an item is O(1).
+
+Cell = Tuple[int, int]
+
+
+class GridIndex:
+    def __init__(self, cell_size: float = 500.0):
+        self.cell_size = cell_size
+        self.cell_degrees = cell_size / METRES_PER_DEGREE
+        self._cells: Dict[Cell, Dict[Hashable, Tuple[float, float, Any]]] = {}
+        self._where: Dict[Hashable, Cell] = {}
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._where
+
+    def _cell(self, lat: float, lng: float) -> Cell:
+        return math.floor(lat / self.cell_degrees), math.floor(lng / self.cell_degrees)
+
+    def put(self, key: Hashable, lat: float, lng: float, item: Any = None):
+        # Insert or move an item
+        cell = self._cell(lat, lng)
+        old = self._where.get(key)
+        if old is not None and old != cell:
+            self._discard(key, old)
+        self._cells.setdefault(cell, {})[key] = (lat, lng, item)
+        self._where[key] = cell
+
+    def remove(self, key: Hashable) -> bool:
+        cell = self._where.pop(key, None)
+        if cell is None:
+            return False
+        self._discard(key, cell)
+        return True
+
+    def _discard(self, key: Hashable, cell: Cell):
+        bucket = self._cells[cell]
+        del bucket[key]
+        if not bucket:
+            del self._cells[cell]
+
+    def clear(self):
+        self._cells.clear()
+        self._where.clear()
+
+    # --- Queries ---
+    def within(self, lat: float, lng: float, radius: float, limit: Optional[int] = None) -> List[Tuple[float, Hashable, Any]]:
+        # (distance in metres, key, item) for items within radius, nearest first
+        lat_cells = math.ceil(radius / self.cell_size)
+        lng_cells = math.ceil(radius / (self.cell_size * max(math.cos(math.radians(lat)), 0.01)))
+        row, column = self._cell(lat, lng)
+        found = []
+        if (2 * lat_cells + 1) * (2 * lng_cells + 1) > len(self._cells):
+            # A huge radius over a sparse grid: cheaper to walk the occupied cells
+            buckets = [bucket for (r, c), bucket in self._cells.items()
+                       if abs(r - row) <= lat_cells and abs(c - column) <= lng_cells]
+        else:
+            buckets = [self._cells[(r, c)] for r in range(row - lat_cells, row + lat_cells + 1)
+                       for c in range(column - lng_cells, column + lng_cells + 1) if (r, c) in self._cells]
+        for bucket in buckets:
+            for key, (item_lat, item_lng, item) in bucket.items():
+                metres = distance(lat, lng, item_lat, item_lng)
+                if metres <= radius:
+                    found.append((metres, key, item))
+        found.sort(key=lambda entry: entry[0])
+        return found[:limit] if limit is not None else found
+
+    def nearest(self, lat: float, lng: float, k: int, max_radius: Optional[float] = None) -> List[Tuple[float, Hashable, Any]]:
+        # The k items nearest to the point (optionally no further than max_radius)
+        if k <= 0 or not self._where:
+            return []
+        row, column = self._cell(lat, lng)
+        # Metres covered in every direction once rings 0..ring have been scanned
+        narrowest = self.cell_size * max(math.cos(math.radians(lat)), 0.01)
+        found: List[Tuple[float, Hashable, Any]] = []
+        seen = 0
+        ring = 0
+        while True:
+            if ring and 8 * ring > len(self._cells):
+                # Far from everything: take the rest of the occupied cells in one go
+                for (r, c), bucket in self._cells.items():
+                    if max(abs(r - row), abs(c - column)) >= ring:
+                        for key, (item_lat, item_lng, item) in bucket.items():
+                            found.append((distance(lat, lng, item_lat, item_lng), key, item))
+                found.sort(key=lambda entry: entry[0])
+                if max_radius is not None:
+                    found = [entry for entry in found if entry[0] <= max_radius]
+                break
+            for r, c in self._ring(row, column, ring):
+                bucket = self._cells.get((r, c))
+                if bucket is None:
+                    continue
+                seen += len(bucket)
+                for key, (item_lat, item_lng, item) in bucket.items():
+                    found.append((distance(lat, lng, item_lat, item_lng), key, item))
+            covered = ring * narrowest
+            found.sort(key=lambda entry: entry[0])
+            if max_radius is not None:
+                found = [entry for entry in found if entry[0] <= max_radius]
+                if covered >= max_radius:
+                    break
+            if (len(found) >= k and found[k - 1][0] <= covered) or seen >= len(self._where):
+                break
+            ring += 1
+        return found[:k]
+
+    @staticmethod
+    def _ring(row: int, column: int, ring: int):
+        if ring == 0:
+            yield row, column
+            return
+        for c in range(column - ring, column + ring + 1):
+            yield row - ring, c
+            yield row + ring, c
+        for r in range(row - ring + 1, row + ring):
+            yield r, column - ring
+            yield r, column + ring
+
+
+class StopIndex:
+    # Every route stop with coordinates, one entry per distinct place (stops
+    # shared by several routes, like the campus, list all of them). Rebuilt
+    # from the routes collection whenever a route changes.
+    def __init__(self, routes_db: Any, cell_size: float = 500.0):
+        self.routes_db = routes_db
+        self.grid = GridIndex(cell_size)
+        self.rebuilds = 0
+        self.rebuild()
+
+    def rebuild(self):
+        self.grid.clear()
+        places: Dict[Tuple[float, float, Optional[str]], Dict[str, Any]] = {}
+        for route in self.routes_db:
+            # Stops are numbered among those with coordinates, as RouteGeometry
+            # numbers them, so stop_index means the same thing in every API
+            located = [stop for stop in route.get("stops") or [] if stop.get("lat") is not None and stop.get("lng") is not None]
+            for index, stop in enumerate(located):
+                key = (stop["lat"], stop["lng"], stop.get("name"))
+                place = places.get(key)
+                if place is None:
+                    place = places[key] = {"name": stop.get("name"), "lat": stop["lat"], "lng": stop["lng"], "routes": []}
+                place["routes"].append({"route_id": route["id"], "route_name": route.get("name"), "stop_index": index})
+        for key, place in places.items():
+            self.grid.put(key, place["lat"], place["lng"], place)
+        self.rebuilds += 1
+
+    def changed(self, collection: str, op: str, record: Dict[str, Any]):
+        if collection == "routes":
+            self.rebuild()
+
+    def near(self, lat: float, lng: float, radius: float, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        return [{**place, "distance_m": round(metres, 1)} for metres, _, place in self.grid.within(lat, lng, radius, limit)]
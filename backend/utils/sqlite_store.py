@@ -0,0 +1,295 @@
+import json
+import queue
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from .storage import COUNTERS_FILE, JsonStore
+
+# SQLite storage for AppState collections. Records live in one table per
+# collection with the indexed lookup fields copied into real columns, so the
+# roster never has to be held in Python dicts and several worker processes can
+# share one database file (WAL journaling lets readers run alongside a writer).
+#
+# Collections are called synchronously, like the in-memory ones, so queries run
+# on the calling thread (the event loop for async handlers) and every write
+# commits before the call returns, on the request path. They are indexed
+# point lookups and single-row writes; the per-fix and fleet-wide tracking
+# paths read the in-memory BusViews instead of the database.
+#
+# Every write also bumps its collection's row in the versions table, so a
+# process can tell from one query whether any other process has written since
+# it last looked. Versions start at the time the row was created (in ms), so
+# they never repeat when the database is recreated. The last CHANGE_LOG_SIZE
+# writes per collection also record the id they touched, so that a process
+# can find out which records changed.
+CHANGE_LOG_SIZE = 10000
+
+
+class ConnectionPool:
+    def __init__(self, db_path: Path, size: int = 4):
+        self.db_path = Path(db_path)
+        self.size = size
+        self._connections: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        for _ in range(size):
+            self._connections.put(self._connect())
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self._connections.get()
+        try:
+            yield conn
+        finally:
+            self._connections.put(conn)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def close(self):
+        while not self._connections.empty():
+            self._connections.get_nowait().close()
+
+
+def create_version(conn: sqlite3.Connection, name: str):
+    conn.execute("INSERT OR IGNORE INTO versions (name, version) VALUES (?, ?)", (name, int(time.time() * 1000)))
+
+
+def bump_version(conn: sqlite3.Connection, name: str, record_id: Optional[int] = None) -> int:
+    conn.execute("UPDATE versions SET version = version + 1 WHERE name = ?", (name,))
+    version = conn.execute("SELECT version FROM versions WHERE name = ?", (name,)).fetchone()[0]
+    if record_id is not None:
+        conn.execute("INSERT INTO changes (name, version, record_id) VALUES (?, ?, ?)", (name, version, record_id))
+        conn.execute("DELETE FROM changes WHERE name = ? AND version <= ?", (name, version - CHANGE_LOG_SIZE))
+    return version
+
+
+class SqliteCollection:
+    def __init__(
+        self,
+        name: str,
+        pool: ConnectionPool,
+        unique_indexes: Tuple[str, ...] = (),
+        indexes: Tuple[str, ...] = (),
+        on_change: Optional[Callable[["SqliteCollection", str, Dict[str, Any]], None]] = None,
+    ):
+        self.name = name
+        self.pool = pool
+        self.unique_indexes = unique_indexes
+        self.indexes = indexes
+        self.on_change = on_change
+        self.columns = (*unique_indexes, *indexes)
+        # The shared version this process's last write produced, so change
+        # hooks can tell it apart from other processes' writes
+        self.version: Optional[int] = None
+
+    def create_table(self, conn: sqlite3.Connection):
+        columns = "".join(f", {field}" + (" UNIQUE" if field in self.unique_indexes else "") for field in self.columns)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {self.name} (id INTEGER PRIMARY KEY, data TEXT NOT NULL{columns})")
+        for field in self.indexes:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.name}_{field} ON {self.name} ({field})")
+        conn.execute("INSERT OR IGNORE INTO counters (collection, last_id) VALUES (?, 0)", (self.name,))
+        create_version(conn, self.name)
+
+    def _row(self, record: Dict[str, Any]) -> Tuple[Any, ...]:
+        return (record["id"], json.dumps(record), *(record.get(field) for field in self.columns))
+
+    def _changed(self, op: str, record: Dict[str, Any]):
+        if self.on_change:
+            self.on_change(self, op, record)
+
+    def _select(self, where: str = "", params: Tuple[Any, ...] = (), limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        sql = f"SELECT data FROM {self.name} {where} ORDER BY id"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        with self.pool.connection() as conn:
+            return [json.loads(row[0]) for row in conn.execute(sql, params)]
+
+    # --- Reads ---
+    def get(self, record_id: Any) -> Optional[Dict[str, Any]]:
+        rows = self._select("WHERE id = ?", (record_id,))
+        return rows[0] if rows else None
+
+    def find_one(self, field: str, value: Any) -> Optional[Dict[str, Any]]:
+        rows = self.find_all(field, value, limit=1)
+        return rows[0] if rows else None
+
+    def find_all(self, field: str, value: Any, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        if field != "id" and field not in self.columns:
+            raise KeyError(f"No index on '{field}' for collection '{self.name}'")
+        return self._select(f"WHERE {field} = ?", (value,), limit=limit)
+
+    def exists(self, field: str, value: Any) -> bool:
+        return self.find_one(field, value) is not None
+
+    def first(self) -> Optional[Dict[str, Any]]:
+        rows = self._select(limit=1)
+        return rows[0] if rows else None
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return self._select()
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(self._select())
+
+    def __len__(self) -> int:
+        with self.pool.connection() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM {self.name}").fetchone()[0]
+
+    def __bool__(self) -> bool:
+        return self.first() is not None
+
+    def __repr__(self) -> str:
+        return f"SqliteCollection({self.name!r})"
+
+    @property
+    def last_id(self) -> int:
+        with self.pool.connection() as conn:
+            return conn.execute("SELECT last_id FROM counters WHERE collection = ?", (self.name,)).fetchone()[0]
+
+    # --- Writes ---
+    def _allocate(self, conn: sqlite3.Connection) -> int:
+        conn.execute("UPDATE counters SET last_id = last_id + 1 WHERE collection = ?", (self.name,))
+        return conn.execute("SELECT last_id FROM counters WHERE collection = ?", (self.name,)).fetchone()[0]
+
+    def next_id(self) -> int:
+        with self.pool.transaction() as conn:
+            return self._allocate(conn)
+
+    def insert(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        placeholders = ", ".join("?" for _ in range(2 + len(self.columns)))
+        column_names = ", ".join(("id", "data", *self.columns))
+        with self.pool.transaction() as conn:
+            if record.get("id") is None:
+                record["id"] = self._allocate(conn)
+            else:
+                conn.execute("UPDATE counters SET last_id = MAX(last_id, ?) WHERE collection = ?", (record["id"], self.name))
+            try:
+                conn.execute(f"INSERT INTO {self.name} ({column_names}) VALUES ({placeholders})", self._row(record))
+            except sqlite3.IntegrityError as exc:
+                raise KeyError(f"Duplicate record in collection '{self.name}': {exc}") from exc
+            self.version = bump_version(conn, self.name, record["id"])
+        self._changed("put", record)
+        return record
+
+    def update(self, record_id: Any, changes: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        assignments = ", ".join(f"{column} = ?" for column in ("data", *self.columns))
+        with self.pool.transaction() as conn:
+            row = conn.execute(f"SELECT data FROM {self.name} WHERE id = ?", (record_id,)).fetchone()
+            if row is None:
+                return None
+            updated = json.loads(row[0])
+            updated.update(changes)
+            updated["id"] = record_id
+            conn.execute(f"UPDATE {self.name} SET {assignments} WHERE id = ?", (*self._row(updated)[1:], record_id))
+            self.version = bump_version(conn, self.name, record_id)
+        self._changed("put", updated)
+        return updated
+
+    def delete(self, record_id: Any) -> Optional[Dict[str, Any]]:
+        with self.pool.transaction() as conn:
+            row = conn.execute(f"SELECT data FROM {self.name} WHERE id = ?", (record_id,)).fetchone()
+            if row is None:
+                return None
+            conn.execute(f"DELETE FROM {self.name} WHERE id = ?", (record_id,))
+            self.version = bump_version(conn, self.name, record_id)
+        current = json.loads(row[0])
+        self._changed("delete", current)
+        return current
+
+
+class SqliteStore(JsonStore):
+    def __init__(self, data_dir: Path, db_path: Optional[Path] = None, pool_size: int = 4):
+        super().__init__(data_dir)
+        self.pool = ConnectionPool(db_path or self.data_dir / "bus_tracking.db", size=pool_size)
+        with self.pool.transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (collection TEXT PRIMARY KEY, last_id INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS documents (name TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS changes (name TEXT NOT NULL, version INTEGER NOT NULL, "
+                         "record_id INTEGER NOT NULL, PRIMARY KEY (name, version))")
+
+    def collection(self, name: str, unique_indexes: Tuple[str, ...] = (), indexes: Tuple[str, ...] = (),
+                   on_change: Optional[Callable[..., None]] = None) -> SqliteCollection:
+        collection = SqliteCollection(name, self.pool, unique_indexes=unique_indexes, indexes=indexes, on_change=on_change)
+        with self.pool.transaction() as conn:
+            collection.create_table(conn)
+            seeded = conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0] or conn.execute(
+                "SELECT last_id FROM counters WHERE collection = ?", (name,)).fetchone()[0]
+        if not seeded:
+            self._seed(collection)
+        self.attach(collection)
+        return collection
+
+    def _seed(self, collection: SqliteCollection):
+        # First run against this database: import the JSON file once
+        records = [record for record in JsonStore.load(self, collection.name) if record.get("id") is not None]
+        json_counters = {c["collection"]: c["last_id"] for c in JsonStore.load(self, COUNTERS_FILE)}
+        last_id = max([record["id"] for record in records] + [json_counters.get(collection.name, 0)])
+        columns = ("id", "data", *collection.columns)
+        with self.pool.transaction() as conn:
+            conn.executemany(
+                f"INSERT INTO {collection.name} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                [collection._row(record) for record in records],
+            )
+            conn.execute("UPDATE counters SET last_id = ? WHERE collection = ?", (last_id, collection.name))
+
+    # Collections that are not tables (e.g. the admin users list) are kept as
+    # whole JSON documents, seeded from data/<name>.json the first time
+    def load(self, name: str) -> List[Dict[str, Any]]:
+        if name in self.collections:
+            return self.collections[name].to_list()
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT data FROM documents WHERE name = ?", (name,)).fetchone()
+        if row is not None:
+            return json.loads(row[0])
+        data = JsonStore.load(self, name)
+        self.save(name, data)
+        return data
+
+    def load_counters(self) -> Dict[str, int]:
+        with self.pool.connection() as conn:
+            return dict(conn.execute("SELECT collection, last_id FROM counters").fetchall())
+
+    def save(self, name: str, data: List[Dict[str, Any]]):
+        with self.pool.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO documents (name, data) VALUES (?, ?)", (name, json.dumps(data)))
+            create_version(conn, name)
+            bump_version(conn, name)
+
+    def append(self, collection: Any, op: str, record: Dict[str, Any]):
+        pass  # Already committed by the collection itself
+
+    def data_versions(self) -> Optional[Dict[str, int]]:
+        with self.pool.connection() as conn:
+            return dict(conn.execute("SELECT name, version FROM versions").fetchall())
+
+    def changed_ids(self, name: str, since: int, until: int) -> Optional[Set[int]]:
+        # Ids of the records written to `name` after version `since` up to
+        # `until`, or None once some of those writes have left the change log
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT record_id FROM changes WHERE name = ? AND version > ? AND version <= ?",
+                                (name, since, until)).fetchall()
+        if len(rows) != until - since:
+            return None
+        return {row[0] for row in rows}
+
+    def close(self):
+        super().close()
+        self.pool.close()
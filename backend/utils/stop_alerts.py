@@ -0,0 +1,214 @@
+import asyncio
+import time
+from bisect import bisect_left, insort
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from .eta import clock
+
+# "Bus is N minutes from my stop" alerts. Armed subscriptions are kept in an
+# inverted index, bus -> stop -> (threshold seconds, subscription id) sorted by
+# threshold, so a location update only looks at the stops of that bus that
+# somebody is waiting at, and at each of those the subscriptions that fire are
+# the tail of the list at or above the current ETA (one bisect, then a slice).
+# A subscription fires once per pass of its stop: it is re-armed once the bus
+# has reached the stop (the route match has moved past it), or when the trip
+# ends, and then waits until the bus is heading for the stop again (its next
+# trip, or the next lap of a looping simulated bus).
+#
+# Fired alerts are kept in a short per-user outbox that streaming clients read
+# from and wait on.
+
+
+class StopAlert:
+    __slots__ = ("id", "user_key", "bus_id", "stop_index", "minutes", "created_at", "fired_at")
+
+    def __init__(self, alert_id: int, user_key: str, bus_id: int, stop_index: int, minutes: float):
+        self.id = alert_id
+        self.user_key = user_key
+        self.bus_id = bus_id
+        self.stop_index = stop_index
+        self.minutes = minutes
+        self.created_at = time.time()
+        self.fired_at: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "bus_id": self.bus_id,
+            "stop_index": self.stop_index,
+            "minutes": self.minutes,
+            "created_at": self.created_at,
+            "armed": self.fired_at is None,
+            "fired_at": self.fired_at,
+        }
+
+
+class StopAlertIndex:
+    def __init__(self, min_speed: float = 10.0, max_per_user: int = 20, outbox_size: int = 50):
+        self.min_speed = min_speed  # km/h assumed for buses that are standing still
+        self.max_per_user = max_per_user
+        self.outbox_size = outbox_size
+        self.alerts: Dict[int, StopAlert] = {}
+        self.by_user: Dict[str, Dict[int, StopAlert]] = {}
+        # bus_id -> stop_index -> [(threshold seconds, alert id)], ascending
+        self._armed: Dict[int, Dict[int, List[Tuple[float, int]]]] = {}
+        # bus_id -> alerts fired during the bus's current trip
+        self._fired: Dict[int, List[int]] = {}
+        self.outboxes: Dict[str, Deque[Dict[str, Any]]] = {}
+        # A new epoch per process tells clients their old notification ids are void
+        self.epoch = int(time.time() * 1000)
+        self._next_alert_id = 0
+        self.last_id = 0
+        self.checks = 0
+        self.fired = 0
+        self._waiters: Dict[str, asyncio.Event] = {}
+
+    # --- Subscriptions ---
+    def add(self, user_key: str, bus_id: int, stop_index: int, minutes: float) -> StopAlert:
+        # Raises ValueError once the user has max_per_user subscriptions
+        own = self.by_user.setdefault(user_key, {})
+        if len(own) >= self.max_per_user:
+            raise ValueError("Too many alerts for this user")
+        self._next_alert_id += 1
+        alert = StopAlert(self._next_alert_id, user_key, bus_id, stop_index, minutes)
+        self.alerts[alert.id] = alert
+        own[alert.id] = alert
+        self._arm(alert)
+        return alert
+
+    def remove(self, user_key: str, alert_id: int) -> bool:
+        alert = self.by_user.get(user_key, {}).pop(alert_id, None)
+        if alert is None:
+            return False
+        if not self.by_user[user_key]:
+            del self.by_user[user_key]
+        del self.alerts[alert_id]
+        if alert.fired_at is None:
+            stops = self._armed[alert.bus_id]
+            entries = stops[alert.stop_index]
+            entries.remove((alert.minutes * 60, alert.id))
+            if not entries:
+                del stops[alert.stop_index]
+                if not stops:
+                    del self._armed[alert.bus_id]
+        # A fired one is dropped when its bus re-arms
+        return True
+
+    def for_user(self, user_key: str) -> List[StopAlert]:
+        return list(self.by_user.get(user_key, {}).values())
+
+    def _arm(self, alert: StopAlert):
+        alert.fired_at = None
+        insort(self._armed.setdefault(alert.bus_id, {}).setdefault(alert.stop_index, []), (alert.minutes * 60, alert.id))
+
+    def rearm(self, bus_id: int, before: Optional[int] = None):
+        # Alerts of the bus that fired for a stop it has now reached (index
+        # below `before`), or all of them when its trip is over, apply again
+        # the next time it heads for their stop
+        fired = self._fired.pop(bus_id, ())
+        kept = []
+        for alert_id in fired:
+            alert = self.alerts.get(alert_id)
+            if alert is None:
+                continue
+            if before is None or alert.stop_index < before:
+                self._arm(alert)
+            else:
+                kept.append(alert_id)
+        if kept:
+            self._fired[bus_id] = kept
+
+    # --- Matching ---
+    def check(self, location: Any, now: Optional[float] = None) -> List[Tuple[str, Dict[str, Any]]]:
+        # Fire the alerts of this bus whose threshold its ETA to their stop
+        # has reached; returns (user key, notification) for each
+        match = location.match
+        if match is None or not match.on_route:
+            return []
+        if location.bus_id in self._fired:
+            self.rearm(location.bus_id, before=match.next_index)
+        stops = self._armed.get(location.bus_id)
+        if not stops:
+            return []
+        now = time.time() if now is None else now
+        geometry = match.geometry
+        metres_per_second = max(location.speed or 0, self.min_speed) / 3.6
+        notifications = []
+        for stop_index in list(stops):
+            # Stops already behind the bus wait for its next trip
+            if stop_index < match.next_index or stop_index >= len(geometry.cumulative):
+                continue
+            self.checks += 1
+            seconds = (geometry.cumulative[stop_index] - match.along) / metres_per_second
+            entries = stops[stop_index]
+            cut = bisect_left(entries, (seconds,))
+            if cut == len(entries):
+                continue
+            for _, alert_id in entries[cut:]:
+                alert = self.alerts[alert_id]
+                notifications.append((alert.user_key, self._fire(alert, location, geometry, seconds, now)))
+            del entries[cut:]
+            if not entries:
+                del stops[stop_index]
+        if not stops:
+            del self._armed[location.bus_id]
+        return notifications
+
+    def _fire(self, alert: StopAlert, location: Any, geometry: Any, seconds: float, now: float) -> Dict[str, Any]:
+        alert.fired_at = now
+        self._fired.setdefault(alert.bus_id, []).append(alert.id)
+        self.fired += 1
+        self.last_id += 1
+        notification = {
+            "type": "stop_alert",
+            "id": self.last_id,
+            "alert_id": alert.id,
+            "bus_id": alert.bus_id,
+            "bus_name": location.bus_name,
+            "route_id": geometry.route_id,
+            "stop_index": alert.stop_index,
+            "stop_name": geometry.names[alert.stop_index],
+            "minutes": alert.minutes,
+            "eta_seconds": round(seconds, 1),
+            "arrival": clock(now + seconds),
+            "timestamp": now,
+        }
+        outbox = self.outboxes.get(alert.user_key)
+        if outbox is None:
+            outbox = self.outboxes[alert.user_key] = deque(maxlen=self.outbox_size)
+        outbox.append(notification)
+        waiter = self._waiters.pop(alert.user_key, None)
+        if waiter is not None:
+            waiter.set()
+        return notification
+
+    # --- Delivery ---
+    def pending(self, user_key: str, since: int) -> List[Dict[str, Any]]:
+        return [notification for notification in self.outboxes.get(user_key, ()) if notification["id"] > since]
+
+    async def wait_for_alert(self, user_key: str, since: int, timeout: float) -> bool:
+        # Wait until the user has a notification newer than `since`
+        deadline = time.monotonic() + timeout
+        while not self.pending(user_key, since):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            waiter = self._waiters.get(user_key)
+            if waiter is None:
+                waiter = self._waiters[user_key] = asyncio.Event()
+            try:
+                await asyncio.wait_for(waiter.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "subscriptions": len(self.alerts),
+            "users": len(self.by_user),
+            "armed": sum(len(entries) for stops in self._armed.values() for entries in stops.values()),
+            "buses": len(self._armed),
+            "checks": self.checks,
+            "fired": self.fired,
+        }
@@ -0,0 +1,144 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from .frames import distance
+
+# Arrival and departure detection at route stops. Each bus on a trip has a
+# cursor at the first stop it hasn't left yet; a fix is only checked against
+# the geofences of the next `lookahead` stops from there (while the bus is at a
+# stop, that stop alone until it leaves), so the cost per fix doesn't depend on
+# the route length. A bus arrives when it comes within enter_radius of a stop
+# and departs once it is further than exit_radius (larger) away, so GPS jitter
+# around the edge doesn't produce a burst of arrive/depart pairs.
+#
+# Events go to a bounded in-memory log with increasing ids that readers can
+# page through or wait on.
+
+
+class BusStopState:
+    __slots__ = ("geometry", "trip_id", "cursor", "at", "arrived_at", "last_timestamp")
+
+    def __init__(self, geometry: Any, trip_id: Optional[int], cursor: int):
+        self.geometry = geometry
+        self.trip_id = trip_id
+        self.cursor = cursor  # First stop not yet departed
+        self.at: Optional[int] = None  # Stop the bus is currently at
+        self.arrived_at: Optional[float] = None
+        self.last_timestamp = float("-inf")
+
+
+class StopEventDetector:
+    def __init__(self, enter_radius: float = 40.0, exit_radius: float = 60.0, lookahead: int = 3, max_events: int = 10000):
+        self.enter_radius = enter_radius
+        self.exit_radius = max(exit_radius, enter_radius)
+        self.lookahead = lookahead
+        self.buses: Dict[int, BusStopState] = {}
+        self.events: Deque[Dict[str, Any]] = deque(maxlen=max_events)
+        # A new epoch per process tells clients their old event ids are void
+        self.epoch = int(time.time() * 1000)
+        self.last_id = 0
+        self.checks = 0
+        self._waiter: Optional[asyncio.Event] = None
+
+    def observe(self, bus_id: int, geometry: Any, lat: float, lng: float, timestamp: float,
+                next_index: Optional[int] = None, trip_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        # Feed one accepted fix; returns the events it caused. next_index (the
+        # route matcher's next stop) lets the cursor catch up after a gap in
+        # fixes longer than the lookahead window.
+        if geometry is None:
+            self.buses.pop(bus_id, None)
+            return []
+        state = self.buses.get(bus_id)
+        if state is None or state.geometry is not geometry or state.trip_id != trip_id:
+            state = self.buses[bus_id] = BusStopState(geometry, trip_id, max((next_index or 1) - 1, 0))
+        if timestamp <= state.last_timestamp:
+            return []  # Older than what was already processed
+        state.last_timestamp = timestamp
+
+        events = []
+        if state.at is not None:
+            self.checks += 1
+            if distance(lat, lng, geometry.lats[state.at], geometry.lngs[state.at]) > self.exit_radius:
+                events.append(self._event("departure", bus_id, state, state.at, timestamp,
+                                          dwell_seconds=round(timestamp - state.arrived_at, 1)))
+                state.cursor = state.at + 1
+                state.at = None
+            else:
+                return events
+
+        if next_index is not None:
+            state.cursor = max(state.cursor, next_index - 1)
+        for index in range(state.cursor, min(state.cursor + self.lookahead, len(geometry.lats))):
+            self.checks += 1
+            if distance(lat, lng, geometry.lats[index], geometry.lngs[index]) <= self.enter_radius:
+                state.cursor = index
+                state.at = index
+                state.arrived_at = timestamp
+                events.append(self._event("arrival", bus_id, state, index, timestamp))
+                break
+        return events
+
+    def _event(self, kind: str, bus_id: int, state: BusStopState, stop_index: int, timestamp: float, **extra: Any) -> Dict[str, Any]:
+        self.last_id += 1
+        event = {
+            "id": self.last_id,
+            "type": kind,
+            "bus_id": bus_id,
+            "route_id": state.geometry.route_id,
+            "trip_id": state.trip_id,
+            "stop_index": stop_index,
+            "stop_name": state.geometry.names[stop_index],
+            "timestamp": timestamp,
+            **extra,
+        }
+        self.events.append(event)
+        if self._waiter is not None:
+            self._waiter.set()
+            self._waiter = None
+        return event
+
+    def forget(self, bus_id: int):
+        self.buses.pop(bus_id, None)
+
+    # --- Reads ---
+    def query(self, since: Optional[int] = None, bus_id: Optional[int] = None, route_id: Optional[int] = None,
+              stop_index: Optional[int] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        # Events after id `since`, oldest first; without `since`, the newest `limit`
+        selected = []
+        events = reversed(self.events) if since is None else self.events
+        for event in events:
+            if since is not None and event["id"] <= since:
+                continue
+            if ((bus_id is not None and event["bus_id"] != bus_id) or (route_id is not None and event["route_id"] != route_id)
+                    or (stop_index is not None and event["stop_index"] != stop_index)):
+                continue
+            selected.append(event)
+            if limit is not None and len(selected) >= limit:
+                break
+        return selected[::-1] if since is None else selected
+
+    async def wait_for_event(self, since: int, timeout: float) -> bool:
+        # Wait until an event newer than `since` is logged
+        deadline = time.monotonic() + timeout
+        while self.last_id <= since:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self._waiter is None:
+                self._waiter = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._waiter.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buses": len(self.buses),
+            "at_stop": sum(1 for state in self.buses.values() if state.at is not None),
+            "events": len(self.events),
+            "last_id": self.last_id,
+            "checks": self.checks,
+        }
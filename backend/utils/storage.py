@@ -0,0 +1,294 @@
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from .persistence import PersistenceScheduler
+from .repository import Collection
+
+# Storage backends for AppState collections. JsonStore keeps the original
+# behaviour of rewriting data/<name>.json on every change; WalStore appends each
+# mutation to data/<name>.wal and folds the log back into the JSON snapshot in
+# a background thread. Both hand their writes to a PersistenceScheduler so file
+# I/O happens off the event loop. The SQLite backend lives in sqlite_store.py;
+# it commits inline on the request path instead.
+
+COUNTERS_FILE = "counters"
+
+
+def write_json_atomic(file_path: Path, data: Any):
+    # Write to a temp file and rename over the original so a crash never leaves
+    # a truncated JSON file behind
+    file_path.parent.mkdir(exist_ok=True)
+    tmp_path = file_path.with_suffix(file_path.suffix + ".tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+class JsonStore:
+    def __init__(self, data_dir: Path, persist_window: float = 0.5, persist_max_delay: float = 5.0):
+        self.data_dir = Path(data_dir)
+        self.collections: Dict[str, Any] = {}
+        self._documents: Dict[str, List[Dict[str, Any]]] = {}
+        self.scheduler = PersistenceScheduler(self._write, window=persist_window, max_delay=persist_max_delay)
+
+    def path(self, name: str, suffix: str = ".json") -> Path:
+        return self.data_dir / f"{name}{suffix}"
+
+    def attach(self, collection: Any):
+        self.collections[collection.name] = collection
+
+    def collection(self, name: str, unique_indexes: Tuple[str, ...] = (), indexes: Tuple[str, ...] = (),
+                   on_change: Optional[Callable[..., None]] = None) -> Collection:
+        collection = Collection(name, self.load(name), unique_indexes=unique_indexes, indexes=indexes,
+                                last_id=self.load_counters().get(name, 0), on_change=on_change)
+        self.attach(collection)
+        return collection
+
+    def counters(self) -> List[Dict[str, Any]]:
+        return [{"collection": c.name, "last_id": c.last_id} for c in self.collections.values()]
+
+    def load(self, name: str) -> List[Dict[str, Any]]:
+        file_path = self.path(name)
+        file_path.parent.mkdir(exist_ok=True)
+        if not file_path.exists():
+            with open(file_path, 'w') as f:
+                json.dump([], f)
+        with open(file_path, 'r') as f:
+            return json.load(f)
+
+    def load_counters(self) -> Dict[str, int]:
+        return {c["collection"]: c["last_id"] for c in self.load(COUNTERS_FILE)}
+
+    def save(self, name: str, data: List[Dict[str, Any]]):
+        # Keep a shallow copy so the writer thread never sees a list mid-append
+        self._documents[name] = list(data)
+        self.scheduler.mark_dirty(name)
+
+    def append(self, collection: Any, op: str, record: Dict[str, Any]):
+        self.scheduler.mark_dirty(collection.name)
+        self.scheduler.mark_dirty(COUNTERS_FILE)
+
+    def data_versions(self) -> Optional[Dict[str, int]]:
+        # Per-collection write counters shared by every process using the
+        # store, or None when this process is the only writer (the JSON and WAL
+        # stores, whose change hooks already see every write)
+        return None
+
+    def changed_ids(self, name: str, since: int, until: int) -> Optional[Set[int]]:
+        # Ids of the records behind the shared counter going from `since` to
+        # `until`, or None when they are not known
+        return None
+
+    # Runs on the scheduler thread
+    def _write(self, name: str):
+        if name in self.collections:
+            collection = self.collections[name]
+            with collection.lock:
+                records = collection.to_list()
+            write_json_atomic(self.path(name), records)
+        elif name == COUNTERS_FILE:
+            write_json_atomic(self.path(name), self.counters())
+        else:
+            write_json_atomic(self.path(name), self._documents[name])
+
+    def flush(self, *names: str, timeout: Optional[float] = None) -> bool:
+        return self.scheduler.flush(names or None, timeout)
+
+    async def wait_durable(self, *names: str, timeout: Optional[float] = None) -> bool:
+        return await self.scheduler.wait_durable(*names, timeout=timeout)
+
+    def start(self):
+        self.scheduler.start()
+
+    def close(self):
+        self.scheduler.close()
+
+
+class WalStore(JsonStore):
+    def __init__(self, data_dir: Path, compact_threshold: int = 500, compact_interval: float = 30.0, fsync: bool = True,
+                 **kwargs: Any):
+        super().__init__(data_dir, **kwargs)
+        self.compact_threshold = compact_threshold
+        self.compact_interval = compact_interval
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self._logs: Dict[str, Any] = {}
+        self._pending: Dict[str, List[str]] = {}
+        self._log_sizes: Dict[str, int] = {}
+        self._replayed_counters: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._compactor: Optional[threading.Thread] = None
+
+    # --- Recovery ---
+    def _replay(self, name: str, records: List[Dict[str, Any]], log_path: Path) -> int:
+        # Put and delete entries are idempotent, so replaying a log that was
+        # partly folded into the snapshot before a crash is harmless
+        if not log_path.exists():
+            return 0
+        by_id = {record["id"]: record for record in records}
+        applied = 0
+        with open(log_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # Torn final write from a crash; everything after it is lost
+                if entry["op"] == "put":
+                    by_id[entry["record"]["id"]] = entry["record"]
+                elif entry["op"] == "delete":
+                    by_id.pop(entry["id"], None)
+                self._replayed_counters[name] = max(self._replayed_counters.get(name, 0), entry.get("last_id", 0))
+                applied += 1
+        records[:] = list(by_id.values())
+        return applied
+
+    def load(self, name: str) -> List[Dict[str, Any]]:
+        records = super().load(name)
+        compacting_path = self.path(name, ".wal.compacting")
+        applied = self._replay(name, records, compacting_path)
+        applied += self._replay(name, records, self.path(name, ".wal"))
+        if compacting_path.exists():
+            # Finish the compaction a crash interrupted before any new rotation
+            # can overwrite the old log
+            write_json_atomic(self.path(name), records)
+            write_json_atomic(self.path(COUNTERS_FILE), [
+                {"collection": collection, "last_id": last_id} for collection, last_id in self.load_counters().items()
+            ])
+            compacting_path.unlink()
+        self._log_sizes[name] = applied
+        return records
+
+    def load_counters(self) -> Dict[str, int]:
+        counters = super().load_counters()
+        for name, last_id in self._replayed_counters.items():
+            counters[name] = max(counters.get(name, 0), last_id)
+        return counters
+
+    # --- Logging ---
+    def _log(self, name: str):
+        if name not in self._logs:
+            self._logs[name] = open(self.path(name, ".wal"), 'a')
+        return self._logs[name]
+
+    def append(self, collection: Any, op: str, record: Dict[str, Any]):
+        entry = {"op": op, "last_id": collection.last_id}
+        if op == "delete":
+            entry["id"] = record["id"]
+        else:
+            entry["record"] = record
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self.lock:
+            self._pending.setdefault(collection.name, []).append(line)
+            self._log_sizes[collection.name] = self._log_sizes.get(collection.name, 0) + 1
+            if self._log_sizes[collection.name] >= self.compact_threshold:
+                self._wakeup.set()
+        self.scheduler.mark_dirty(collection.name)
+
+    def _flush_pending(self, name: str):
+        # Group commit: everything buffered since the last write goes out with
+        # a single fsync. Caller holds self.lock.
+        lines = self._pending.pop(name, None)
+        if not lines:
+            return
+        log = self._log(name)
+        log.write("".join(lines))
+        log.flush()
+        if self.fsync:
+            os.fsync(log.fileno())
+
+    def _write(self, name: str):
+        if name in self.collections:
+            with self.lock:
+                self._flush_pending(name)
+        else:
+            super()._write(name)
+
+    # --- Compaction ---
+    def compact(self, name: str):
+        collection = self.collections.get(name)
+        if collection is None:
+            return
+        with self.lock:
+            if not self._log_sizes.get(name):
+                return
+            self._flush_pending(name)
+            # Rotate the log and capture the snapshot together; appends that
+            # arrive while the snapshot is written go to the fresh log
+            if name in self._logs:
+                self._logs.pop(name).close()
+            log_path = self.path(name, ".wal")
+            compacting_path = self.path(name, ".wal.compacting")
+            if log_path.exists():
+                os.replace(log_path, compacting_path)
+            self._log_sizes[name] = 0
+            with collection.lock:
+                snapshot = collection.to_list()
+            counters = self.counters()
+        write_json_atomic(self.path(name), snapshot)
+        write_json_atomic(self.path(COUNTERS_FILE), counters)
+        if compacting_path.exists():
+            compacting_path.unlink()
+
+    def compact_all(self):
+        for name in list(self.collections):
+            self.compact(name)
+
+    def _run_compactor(self):
+        while not self._stop.is_set():
+            woken = self._wakeup.wait(self.compact_interval)
+            self._wakeup.clear()
+            # Large logs are folded as soon as they cross the threshold; smaller
+            # ones are folded once the store has been quiet for an interval
+            limit = self.compact_threshold if woken else 1
+            for name in list(self.collections):
+                if self._log_sizes.get(name, 0) >= limit:
+                    self.compact(name)
+
+    def start(self):
+        super().start()
+        if self._compactor is None:
+            self._compactor = threading.Thread(target=self._run_compactor, name="wal-compactor", daemon=True)
+            self._compactor.start()
+
+    def close(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+        super().close()
+        self.compact_all()
+        with self.lock:
+            for log in self._logs.values():
+                log.close()
+            self._logs.clear()
+
+
+def create_store(mode: str, data_dir: Path) -> JsonStore:
+    persistence = {
+        "persist_window": float(os.environ.get("BUS_TRACKING_PERSIST_WINDOW", "0.5")),
+        "persist_max_delay": float(os.environ.get("BUS_TRACKING_PERSIST_MAX_DELAY", "5")),
+    }
+    if mode == "json":
+        return JsonStore(data_dir, **persistence)
+    if mode == "wal":
+        return WalStore(
+            data_dir,
+            compact_threshold=int(os.environ.get("BUS_TRACKING_WAL_COMPACT_THRESHOLD", "500")),
+            compact_interval=float(os.environ.get("BUS_TRACKING_WAL_COMPACT_INTERVAL", "30")),
+            **persistence,
+        )
+    if mode == "sqlite":
+        from .sqlite_store import SqliteStore
+        return SqliteStore(
+            data_dir,
+            db_path=os.environ.get("BUS_TRACKING_SQLITE_PATH") or None,
+            pool_size=int(os.environ.get("BUS_TRACKING_SQLITE_POOL_SIZE", "4")),
+        )
+    raise ValueError(f"Unknown storage mode '{mode}'")
@@ -0,0 +1,87 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set, Tuple
+
+# Verified access tokens, keyed by the raw token string. An entry holds the
+# user dict get_current_user resolved for the token and is served until the
+# token's own expiry, the cache TTL, or an explicit invalidation of that user
+# (e.g. an admin editing or deleting the driver), whichever comes first.
+# Least recently used entries are evicted once max_size is reached.
+#
+# Invalidation is per process. With several SQLite workers, AppState.sync()
+# drops the users that another worker's student or driver writes touched
+# (the whole cache only if it has fallen too far behind to know which),
+# before the request's token is looked up, so a revoked user is refused on
+# the next request to any worker.
+
+
+class TokenCache:
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # token -> (user, expires_at, user_key)
+        self._entries: "OrderedDict[str, Tuple[Dict[str, Any], float, str]]" = OrderedDict()
+        self._by_user: Dict[str, Set[str]] = {}
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        user, expires_at, _ = entry
+        if time.time() >= expires_at:
+            self._remove(token)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return user
+
+    def put(self, token: str, user: Dict[str, Any], user_key: str, expires: Optional[float] = None):
+        expires_at = time.time() + self.ttl
+        if expires is not None:
+            expires_at = min(expires_at, expires)
+        if token in self._entries:
+            self._remove(token)
+        self._entries[token] = (user, expires_at, user_key)
+        self._by_user.setdefault(user_key, set()).add(token)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, token: str):
+        _, _, user_key = self._entries.pop(token)
+        tokens = self._by_user.get(user_key)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._by_user[user_key]
+
+    def invalidate_user(self, user_key: str) -> int:
+        tokens = self._by_user.pop(user_key, set())
+        for token in tokens:
+            self._entries.pop(token, None)
+        self.invalidations += len(tokens)
+        return len(tokens)
+
+    def clear(self):
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+        self._by_user.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,646 @@
+import asyncio
+import json
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from . import frames
+from .viewports import ViewportIndex
+
+# Topic-based fan-out for /tracking/ws/bus_locations. A client that has not
+# subscribed to anything keeps receiving the whole fleet, as before; once it
+# subscribes to bus or route topics it only receives the buses it watches.
+# Each bus location is serialized once per tick and the JSON fragments are
+# joined per client, so serialization cost does not grow with the audience.
+#
+# The stream is delta encoded: a client gets one "snapshot" message when it
+# connects and afterwards "delta" messages carrying only the buses whose
+# location changed, each tagged with a monotonically increasing seq. A client
+# that reconnects with ?since=<seq>&epoch=<epoch> (or sends {"action":
+# "resume", ...}) receives just the buses that changed after that seq.
+#
+# Sends never happen inline in the broadcast: every connection has its own
+# bounded outbound queue drained by a writer task, so one stalled phone only
+# delays itself. When a queue is full the oldest location frame is dropped and
+# the client is later caught up with a resume message. A client whose queue
+# fills up with messages that cannot be dropped (pings, metadata, alerts), or
+# that stays behind for too long, is disconnected.
+#
+# Connections live in a dict registry (O(1) add and remove) with per-user and
+# global caps. A heartbeat sends {"type": "ping"} every heartbeat_interval
+# seconds. A client counts as alive while it sends anything (a pong or any
+# other message); one silent for heartbeat_timeout seconds is treated as
+# half-open and reaped, even if the kernel still accepts frames for it.
+#
+# Clients may negotiate the compact binary encoding from frames.py with
+# ?format=binary or {"action": "format", "format": "binary"}. Location frames
+# are then sent as binary messages of packed records, and the per-bus fields
+# that rarely change (bus and driver name, ETA text) arrive in separate JSON
+# "metadata" messages only when they change. Control messages stay JSON.
+#
+# Map clients can instead watch a bounding box with ?bbox=south,west,north,east
+# (&zoom=) or {"action": "viewport", "bbox": [...], "zoom": z}. They receive
+# only the buses inside it, plus {"type": "enter"|"leave", "bus_ids": [...]}
+# control messages as buses cross its edge; an entering bus's location comes
+# in the frame that follows. Viewports are matched to fixes through a grid (see
+# viewports.py), so a zoomed-in client costs nothing for buses elsewhere.
+#
+# A bus that leaves the map (trip ended, bus deleted) is announced with a
+# {"type": "remove", "bus_ids": [...]} message, also replayed on resume.
+#
+# Clients connected with a student's ?token= also get that student's stop
+# alerts as {"type": "stop_alert", ...} messages (see stop_alerts.py).
+
+FORMATS = ("json", "binary")
+Message = Union[str, bytes]
+
+
+class ClientConnection:
+    def __init__(self, client_id: int, websocket: WebSocket, hub: "TrackingHub", max_queue: int = 32,
+                 user_key: Optional[str] = None, format: str = "json"):
+        self.id = client_id
+        self.websocket = websocket
+        self.user_key = user_key
+        self.format = format
+        self.hub = hub
+        self.max_queue = max_queue
+        self.connected_at = time.time()
+        self.last_seen = time.monotonic()
+        self.sent = 0
+        self.dropped = 0
+        # (frame, droppable, seq the frame's changes start after)
+        self.queue: Deque[Tuple[Message, bool, int]] = deque()
+        self.behind_since: Optional[float] = None
+        self.resync_since: Optional[int] = None
+        self.closed = False
+        self._ready = asyncio.Event()
+        self.writer = asyncio.get_running_loop().create_task(self._run_writer())
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    @property
+    def lag(self) -> float:
+        # Seconds this client has continuously had undelivered frames
+        return time.monotonic() - self.behind_since if self.behind_since is not None else 0.0
+
+    def send(self, frame: Message, droppable: bool = False, base_seq: int = 0):
+        if self.closed:
+            return
+        if len(self.queue) >= self.max_queue and not self._drop_location_frame():
+            # Nothing left to drop, so the client cannot be caught up
+            self.hub.evict(self)
+            return
+        self.queue.append((frame, droppable, base_seq))
+        if self.behind_since is None:
+            self.behind_since = time.monotonic()
+        self._ready.set()
+
+    def _drop_location_frame(self) -> bool:
+        for index, (_, queued_droppable, queued_base_seq) in enumerate(self.queue):
+            if queued_droppable:
+                del self.queue[index]
+                self.dropped += 1
+                # The dropped changes are re-sent from the per-bus latest state
+                self.resync_since = queued_base_seq if self.resync_since is None else min(self.resync_since, queued_base_seq)
+                return True
+        return False
+
+    def _next_frame(self) -> Optional[Message]:
+        if not self.queue and self.resync_since is not None:
+            since, self.resync_since = self.resync_since, None
+            for message in self.hub.resume_messages(self.websocket, since, self.hub.epoch):
+                self.queue.append((message, False, 0))
+        if self.queue:
+            return self.queue.popleft()[0]
+        return None
+
+    async def _run_writer(self):
+        try:
+            while True:
+                frame = self._next_frame()
+                if frame is None:
+                    self.behind_since = None
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                if isinstance(frame, bytes):
+                    await self.websocket.send_bytes(frame)
+                else:
+                    await self.websocket.send_text(frame)
+                self.sent += 1
+        except (WebSocketDisconnect, RuntimeError, ConnectionError):
+            self.hub.disconnect(self.websocket)
+
+    async def close(self, code: int = 1000):
+        self.closed = True
+        self.writer.cancel()
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code), timeout=1)
+        except Exception:
+            pass  # The socket is already gone or stuck; it is dropped either way
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "user": self.user_key,
+            "format": self.format,
+            "connected_at": self.connected_at,
+            "idle_seconds": round(time.monotonic() - self.last_seen, 3),
+            "lag_seconds": round(self.lag, 3),
+            "queued": len(self.queue),
+            "sent": self.sent,
+            "dropped": self.dropped,
+        }
+
+
+class TrackingHub:
+    def __init__(self, max_queue: int = 32, lag_threshold: float = 5.0, evict_after: float = 30.0,
+                 max_connections: int = 10000, max_per_user: int = 5,
+                 heartbeat_interval: float = 20.0, heartbeat_timeout: float = 60.0):
+        self.max_queue = max_queue
+        self.lag_threshold = lag_threshold
+        self.evict_after = evict_after
+        self.max_connections = max_connections
+        self.max_per_user = max_per_user
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.evicted = 0
+        self.reaped = 0
+        self.rejected = 0
+        self.connections: Dict[WebSocket, ClientConnection] = {}
+        self.by_user: Dict[str, Set[WebSocket]] = {}
+        self._next_client_id = 0
+        self.firehose: Set[WebSocket] = set()
+        self.bus_subscribers: Dict[int, Set[WebSocket]] = {}
+        self.route_subscribers: Dict[int, Set[WebSocket]] = {}
+        self.subscriptions: Dict[WebSocket, Dict[str, Set[int]]] = {}
+        self.viewports = ViewportIndex()
+        # A new epoch per process tells clients their old seq numbers are void
+        self.epoch = int(time.time() * 1000)
+        self.seq = 0
+        # bus_id -> (seq, route_id, location as published, JSON fragment, packed record)
+        self.latest: Dict[int, Tuple[int, Optional[int], Dict[str, Any], str, bytes]] = {}
+        # bus_id -> (seq, route_id) of buses taken off the map, until they return
+        self.removed: Dict[int, Tuple[int, Optional[int]]] = {}
+        # Slow-changing per-bus fields sent to binary clients, and the last
+        # known heading of every bus (derived from movement when not reported)
+        self.metadata: Dict[int, Dict[str, Any]] = {}
+        self.headings: Dict[int, float] = {}
+        # Long-poll waiters per bus id (None waits for any bus)
+        self._waiters: Dict[Optional[int], asyncio.Event] = {}
+        # Closes of evicted clients still in progress
+        self._closing: Set[asyncio.Task] = set()
+
+    # --- Connections ---
+    def admit(self, user_key: Optional[str]) -> Optional[str]:
+        # Returns the reason a new connection must be refused, if any.
+        # Anonymous clients only count toward the global cap, since a whole
+        # campus can sit behind one NAT address.
+        if len(self.connections) >= self.max_connections:
+            self.rejected += 1
+            return "Too many connections"
+        if user_key is not None and len(self.by_user.get(user_key, ())) >= self.max_per_user:
+            self.rejected += 1
+            return "Too many connections for this user"
+        return None
+
+    def connect(self, websocket: WebSocket, user_key: Optional[str] = None) -> ClientConnection:
+        self._next_client_id += 1
+        format = websocket.query_params.get("format", "json")
+        client = ClientConnection(self._next_client_id, websocket, self, max_queue=self.max_queue, user_key=user_key,
+                                  format=format if format in FORMATS else "json")
+        self.connections[websocket] = client
+        if user_key is not None:
+            self.by_user.setdefault(user_key, set()).add(websocket)
+        self.subscriptions[websocket] = {"bus_ids": set(), "route_ids": set()}
+        self.firehose.add(websocket)
+        return client
+
+    def disconnect(self, websocket: WebSocket):
+        client = self.connections.pop(websocket, None)
+        if client is not None:
+            client.closed = True
+            client.writer.cancel()
+            if client.user_key is not None:
+                sockets = self.by_user.get(client.user_key)
+                if sockets is not None:
+                    sockets.discard(websocket)
+                    if not sockets:
+                        del self.by_user[client.user_key]
+        subscriptions = self.subscriptions.pop(websocket, None)
+        if subscriptions:
+            self._unindex(websocket, subscriptions["bus_ids"], subscriptions["route_ids"])
+        self.viewports.remove(websocket)
+        self.firehose.discard(websocket)
+
+    # --- Subscriptions ---
+    def _unindex(self, websocket: WebSocket, bus_ids: Iterable[int], route_ids: Iterable[int]):
+        for topics, keys in ((self.bus_subscribers, bus_ids), (self.route_subscribers, route_ids)):
+            for key in keys:
+                subscribers = topics.get(key)
+                if subscribers is not None:
+                    subscribers.discard(websocket)
+                    if not subscribers:
+                        del topics[key]
+
+    def subscribe(self, websocket: WebSocket, bus_ids: Iterable[int] = (), route_ids: Iterable[int] = ()):
+        subscriptions = self.subscriptions[websocket]
+        for bus_id in bus_ids:
+            subscriptions["bus_ids"].add(bus_id)
+            self.bus_subscribers.setdefault(bus_id, set()).add(websocket)
+        for route_id in route_ids:
+            subscriptions["route_ids"].add(route_id)
+            self.route_subscribers.setdefault(route_id, set()).add(websocket)
+        if subscriptions["bus_ids"] or subscriptions["route_ids"]:
+            self.firehose.discard(websocket)
+
+    def unsubscribe(self, websocket: WebSocket, bus_ids: Iterable[int] = (), route_ids: Iterable[int] = ()):
+        subscriptions = self.subscriptions[websocket]
+        bus_ids = [bus_id for bus_id in bus_ids if bus_id in subscriptions["bus_ids"]]
+        route_ids = [route_id for route_id in route_ids if route_id in subscriptions["route_ids"]]
+        subscriptions["bus_ids"].difference_update(bus_ids)
+        subscriptions["route_ids"].difference_update(route_ids)
+        self._unindex(websocket, bus_ids, route_ids)
+        self._restore_firehose(websocket)
+
+    def _restore_firehose(self, websocket: WebSocket):
+        # A client with no topics and no viewport is back to the whole fleet
+        subscriptions = self.subscriptions[websocket]
+        if not subscriptions["bus_ids"] and not subscriptions["route_ids"] and websocket not in self.viewports:
+            self.firehose.add(websocket)
+
+    def set_viewport(self, websocket: WebSocket, bbox: List[float], zoom: Optional[int] = None) -> Tuple[List[int], List[int]]:
+        # Returns the buses that entered and left the client's view; raises
+        # ValueError for a malformed box
+        south, west, north, east = (float(value) for value in bbox)
+        positions = ((bus_id, entry[2]["lat"], entry[2]["lng"]) for bus_id, entry in self.latest.items())
+        entered, left = self.viewports.set(websocket, south, west, north, east, zoom, positions)
+        self.firehose.discard(websocket)
+        return entered, left
+
+    def clear_viewport(self, websocket: WebSocket) -> List[int]:
+        left = self.viewports.remove(websocket)
+        self._restore_firehose(websocket)
+        return left
+
+    def wants(self, websocket: WebSocket, bus_id: int, route_id: Optional[int]) -> bool:
+        if websocket in self.firehose:
+            return True
+        subscriptions = self.subscriptions.get(websocket)
+        if subscriptions and (bus_id in subscriptions["bus_ids"] or route_id in subscriptions["route_ids"]):
+            return True
+        return self.viewports.sees(websocket, bus_id)
+
+    def subscribe_from_query(self, websocket: WebSocket):
+        # Allow ws://.../bus_locations?bus_id=1&route_id=2 to subscribe on
+        # connect, and ?bbox=south,west,north,east&zoom=z to watch a viewport
+        params = websocket.query_params
+        try:
+            bus_ids = [int(bus_id) for bus_id in params.getlist("bus_id")]
+            route_ids = [int(route_id) for route_id in params.getlist("route_id")]
+        except ValueError:
+            return
+        self.subscribe(websocket, bus_ids, route_ids)
+        if "bbox" in params:
+            try:
+                zoom = int(params["zoom"]) if "zoom" in params else None
+                self.set_viewport(websocket, params["bbox"].split(","), zoom)
+            except ValueError:
+                pass
+
+    def handle_message(self, websocket: WebSocket, text: str) -> List[Message]:
+        # Clients send {"action": "subscribe"|"unsubscribe", "bus_ids": [...], "route_ids": [...]},
+        # {"action": "resume", "since": <seq>, "epoch": <epoch>}, {"action": "format", "format": "binary"}
+        # or {"action": "viewport", "bbox": [south, west, north, east] | null, "zoom": <zoom>}
+        try:
+            message = json.loads(text)
+            action = message.get("action")
+            bus_ids = [int(bus_id) for bus_id in message.get("bus_ids", [])]
+            route_ids = [int(route_id) for route_id in message.get("route_ids", [])]
+            since = message.get("since")
+            epoch = message.get("epoch")
+            since = int(since) if since is not None else None
+            epoch = int(epoch) if epoch is not None else None
+        except (ValueError, TypeError, AttributeError, OverflowError):
+            return [json.dumps({"type": "error", "detail": "Invalid message"})]
+        if action == "pong":
+            return []
+        if action == "resume":
+            return self.resume_messages(websocket, since, epoch)
+        if action == "format":
+            format = message.get("format")
+            if format not in FORMATS:
+                return [json.dumps({"type": "error", "detail": f"Unknown format '{format}'"})]
+            self.connections[websocket].format = format
+            # Restart the stream in the new encoding
+            return [json.dumps({"type": "format", "format": format}), *self.snapshot_messages(websocket)]
+        if action == "viewport":
+            return self._viewport_replies(websocket, message.get("bbox"), message.get("zoom"))
+        if action == "subscribe":
+            self.subscribe(websocket, bus_ids, route_ids)
+        elif action == "unsubscribe":
+            self.unsubscribe(websocket, bus_ids, route_ids)
+        else:
+            return [json.dumps({"type": "error", "detail": f"Unknown action '{action}'"})]
+        subscriptions = self.subscriptions[websocket]
+        replies = [json.dumps({"type": "subscriptions", "bus_ids": sorted(subscriptions["bus_ids"]), "route_ids": sorted(subscriptions["route_ids"])})]
+        if action == "subscribe":
+            # Newly watched buses need their current position straight away
+            replies.extend(self.snapshot_messages(websocket, only_bus_ids=set(bus_ids), only_route_ids=set(route_ids)))
+        return replies
+
+    def _viewport_replies(self, websocket: WebSocket, bbox: Any, zoom: Any) -> List[Message]:
+        if bbox is None:
+            left = self.clear_viewport(websocket)
+            replies: List[Message] = [json.dumps({"type": "viewport", "bbox": None})]
+            if left:
+                replies.append(json.dumps({"type": "leave", "bus_ids": left}))
+            if websocket in self.firehose:
+                replies.extend(self.snapshot_messages(websocket))
+            return replies
+        try:
+            if not isinstance(bbox, list) or len(bbox) != 4:
+                raise ValueError("Invalid bounding box")
+            entered, left = self.set_viewport(websocket, bbox, int(zoom) if zoom is not None else None)
+        except (ValueError, TypeError, OverflowError):
+            return [json.dumps({"type": "error", "detail": "Invalid viewport"})]
+        replies = [json.dumps({"type": "viewport", **self.viewports.get(websocket).to_dict()})]
+        if left:
+            replies.append(json.dumps({"type": "leave", "bus_ids": left}))
+        if entered:
+            replies.append(json.dumps({"type": "enter", "bus_ids": entered}))
+            replies.extend(self.snapshot_messages(websocket, only_bus_ids=set(entered)))
+        return replies
+
+    # --- Encoding ---
+    def _frame(self, kind: str, parts: List[str]) -> str:
+        return (f'{{"type": "{kind}", "epoch": {self.epoch}, "seq": {self.seq}, '
+                f'"bus_locations": [' + ", ".join(parts) + ']}')
+
+    def metadata_message(self, bus_ids: Iterable[int]) -> str:
+        return frames.metadata_message(
+            {bus_id: self.metadata[bus_id] for bus_id in bus_ids},
+            {bus_id: self.latest[bus_id][1] for bus_id in bus_ids},
+        )
+
+    def encode(self, format: str, kind: str, bus_ids: List[int], metadata_for: Iterable[int] = ()) -> List[Message]:
+        # Render the latest state of bus_ids as one location frame, preceded by
+        # a metadata message for metadata_for when the client speaks binary
+        if format == "binary":
+            messages: List[Message] = []
+            metadata_for = list(metadata_for)
+            if metadata_for:
+                messages.append(self.metadata_message(metadata_for))
+            records = [self.latest[bus_id][4] for bus_id in bus_ids]
+            messages.append(frames.pack_frame(kind, self.epoch, self.seq, records))
+            return messages
+        return [self._frame(kind, [self.latest[bus_id][3] for bus_id in bus_ids])]
+
+    def _format(self, websocket: WebSocket) -> str:
+        client = self.connections.get(websocket)
+        return client.format if client is not None else "json"
+
+    # --- Snapshots and resume ---
+    def snapshot_messages(self, websocket: WebSocket, only_bus_ids: Optional[Set[int]] = None,
+                          only_route_ids: Optional[Set[int]] = None) -> List[Message]:
+        bus_ids = []
+        for bus_id, (_, route_id, _, _, _) in self.latest.items():
+            if only_bus_ids is not None or only_route_ids is not None:
+                if bus_id not in (only_bus_ids or ()) and route_id not in (only_route_ids or ()):
+                    continue
+            elif not self.wants(websocket, bus_id, route_id):
+                continue
+            bus_ids.append(bus_id)
+        return self.encode(self._format(websocket), "snapshot", bus_ids, metadata_for=bus_ids)
+
+    def resume_messages(self, websocket: WebSocket, since: Optional[int], epoch: Optional[int]) -> List[Message]:
+        # Every bus remembers the seq of its latest change, so resuming only
+        # needs the buses whose seq is newer than the client's; seq numbers
+        # from another process (different epoch) force a full snapshot.
+        # Metadata messages are never dropped, so a resuming binary client
+        # already has current metadata for everything it watches.
+        if since is None or epoch != self.epoch or since > self.seq:
+            return self.snapshot_messages(websocket)
+        bus_ids = [
+            bus_id for bus_id, (seq, route_id, _, _, _) in self.latest.items()
+            if seq > since and self.wants(websocket, bus_id, route_id)
+        ]
+        # Buses that left the map meanwhile (they are in no viewport any more,
+        # so viewport clients hear about all of them)
+        removed = [
+            bus_id for bus_id, (seq, route_id) in self.removed.items()
+            if seq > since and (self.wants(websocket, bus_id, route_id) or websocket in self.viewports)
+        ]
+        messages = [self.remove_message(removed)] if removed else []
+        return messages + self.encode(self._format(websocket), "delta", bus_ids)
+
+    def connect_messages(self, websocket: WebSocket) -> List[Message]:
+        params = websocket.query_params
+        try:
+            since = int(params["since"]) if "since" in params else None
+            epoch = int(params["epoch"]) if "epoch" in params else None
+        except ValueError:
+            since = epoch = None
+        return self.resume_messages(websocket, since, epoch)
+
+    # --- Fan-out ---
+    def recipients(self, bus_id: int, route_id: Optional[int]) -> Set[WebSocket]:
+        recipients = set(self.bus_subscribers.get(bus_id, ()))
+        if route_id is not None:
+            recipients.update(self.route_subscribers.get(route_id, ()))
+        return recipients
+
+    def record(self, locations: Dict[int, Dict[str, Any]], route_of: Callable[[int], Optional[int]]) -> Dict[int, Tuple[Optional[int], bool]]:
+        # Assign a seq to every bus whose location differs from what was last
+        # published, serialize it once per encoding, and return
+        # {bus_id: (route_id, metadata changed)} for those buses
+        changed = {}
+        for bus_id, location in locations.items():
+            previous = self.latest.get(bus_id)
+            if previous is not None and previous[2] == location:
+                continue
+            self.seq += 1
+            self.removed.pop(bus_id, None)
+            route_id = route_of(bus_id)
+            fragment = json.dumps({**location, "seq": self.seq})
+            if previous is not None and (previous[2]["lat"], previous[2]["lng"]) != (location["lat"], location["lng"]):
+                self.headings[bus_id] = frames.bearing(previous[2]["lat"], previous[2]["lng"], location["lat"], location["lng"])
+            record = frames.pack_record(bus_id, location, heading=self.headings.get(bus_id, 0.0))
+            self.latest[bus_id] = (self.seq, route_id, dict(location), fragment, record)
+            metadata = frames.metadata_of(location)
+            metadata_changed = self.metadata.get(bus_id) != metadata or (previous is not None and previous[1] != route_id)
+            self.metadata[bus_id] = metadata
+            changed[bus_id] = (route_id, metadata_changed)
+        if changed:
+            self._wake(changed)
+        return changed
+
+    def _wake(self, bus_ids: Iterable[int]):
+        for key in (None, *bus_ids):
+            event = self._waiters.pop(key, None)
+            if event is not None:
+                event.set()
+
+    def remove_message(self, bus_ids: List[int]) -> str:
+        return json.dumps({"type": "remove", "epoch": self.epoch, "seq": self.seq, "bus_ids": bus_ids})
+
+    def remove(self, bus_id: int) -> bool:
+        # Take a bus off the map (its trip ended or it was deleted): it leaves
+        # the latest state, and every client that was receiving it gets a
+        # {"type": "remove", "bus_ids": [...]} message
+        latest = self.latest.pop(bus_id, None)
+        if latest is None:
+            return False
+        self.seq += 1
+        route_id = latest[1]
+        self.removed[bus_id] = (self.seq, route_id)
+        self.metadata.pop(bus_id, None)
+        self.headings.pop(bus_id, None)
+        recipients = self.recipients(bus_id, route_id) | self.firehose | self.viewports.forget(bus_id)
+        message = self.remove_message([bus_id])
+        for websocket in recipients:
+            client = self.connections.get(websocket)
+            if client is not None:
+                client.send(message)
+        self._wake((bus_id,))
+        return True
+
+    # --- Versions and long-polling ---
+    def version(self, bus_id: Optional[int] = None) -> int:
+        # The seq of a bus's latest change, or of the latest change overall
+        if bus_id is None:
+            return self.seq
+        latest = self.latest.get(bus_id)
+        if latest is not None:
+            return latest[0]
+        removed = self.removed.get(bus_id)
+        return removed[0] if removed is not None else 0
+
+    async def wait_for_change(self, since: int, bus_id: Optional[int] = None, timeout: float = 0.0) -> bool:
+        # Wait until the version moves past `since`. A `since` from the future
+        # (e.g. from before a restart) returns at once so the caller resyncs.
+        deadline = time.monotonic() + timeout
+        while self.version(bus_id) <= since <= self.seq:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            event = self._waiters.setdefault(bus_id, asyncio.Event())
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def publish(self, locations: Dict[int, Dict[str, Any]], route_of: Callable[[int], Optional[int]]):
+        base_seq = self.seq
+        changed = self.record(locations, route_of)
+        if not changed:
+            return
+        per_client: Dict[WebSocket, List[int]] = {}
+        # Viewport crossings per client: (entered, left)
+        crossings: Dict[WebSocket, Tuple[List[int], List[int]]] = {}
+        for bus_id, (route_id, _) in changed.items():
+            recipients = self.recipients(bus_id, route_id)
+            if self.viewports:
+                location = self.latest[bus_id][2]
+                entered, left, stayed = self.viewports.moved(bus_id, location["lat"], location["lng"])
+                for websocket in entered:
+                    crossings.setdefault(websocket, ([], []))[0].append(bus_id)
+                for websocket in left:
+                    crossings.setdefault(websocket, ([], []))[1].append(bus_id)
+                recipients |= entered | stayed
+            for websocket in recipients:
+                per_client.setdefault(websocket, []).append(bus_id)
+        if self.firehose:
+            everything = list(changed)
+            for websocket in self.firehose:
+                per_client[websocket] = everything
+
+        for websocket, (entered, left) in crossings.items():
+            client = self.connections.get(websocket)
+            if client is None:
+                continue
+            if left:
+                client.send(json.dumps({"type": "leave", "bus_ids": left}))
+            if entered:
+                client.send(json.dumps({"type": "enter", "bus_ids": entered}))
+
+        # Clients watching the same buses in the same format share one encoding
+        encoded: Dict[Tuple[str, Tuple[int, ...], Tuple[int, ...]], List[Message]] = {}
+        for websocket, bus_ids in per_client.items():
+            client = self.connections.get(websocket)
+            if client is None:
+                continue
+            # A bus entering the client's viewport needs its metadata too
+            entered = tuple(crossings[websocket][0]) if websocket in crossings else ()
+            key = (client.format, tuple(bus_ids), entered)
+            if key not in encoded:
+                encoded[key] = self.encode(client.format, "delta", bus_ids,
+                                           metadata_for=[bus_id for bus_id in bus_ids if changed[bus_id][1] or bus_id in entered])
+            *metadata, frame = encoded[key]
+            for message in metadata:
+                client.send(message)
+            client.send(frame, droppable=True, base_seq=base_seq)
+        await self.evict_slow_clients()
+
+    async def evict_slow_clients(self):
+        # A client is lagging once it has been behind for lag_threshold seconds
+        # and is dropped after lagging for another evict_after seconds
+        limit = self.lag_threshold + self.evict_after
+        slow = [client for client in self.connections.values() if client.lag > limit]
+        for client in slow:
+            self.disconnect(client.websocket)
+            self.evicted += 1
+            await client.close(code=1013)
+
+    def evict(self, client: ClientConnection):
+        # Drop a client whose queue overflowed, from inside a send; the close
+        # frame goes out in the background
+        self.disconnect(client.websocket)
+        self.evicted += 1
+        task = asyncio.get_running_loop().create_task(client.close(code=1013))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    # --- Heartbeats ---
+    async def reap_idle_clients(self) -> int:
+        now = time.monotonic()
+        idle = [client for client in self.connections.values() if now - client.last_seen > self.heartbeat_timeout]
+        for client in idle:
+            self.disconnect(client.websocket)
+            self.reaped += 1
+            await client.close(code=1001)
+        return len(idle)
+
+    async def run_heartbeats(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            await self.reap_idle_clients()
+            ping = json.dumps({"type": "ping", "t": time.time()})
+            for client in list(self.connections.values()):
+                client.send(ping)
+
+    def send_to_user(self, user_key: str, message: Message) -> int:
+        # A control message for every connection of one signed-in user (stop
+        # alerts); returns how many connections it was queued on
+        sockets = list(self.by_user.get(user_key, ()))
+        for websocket in sockets:
+            self.connections[websocket].send(message)
+        return len(sockets)
+
+    def stats(self) -> Dict[str, Any]:
+        clients = [client.stats() for client in self.connections.values()]
+        return {
+            "connected": len(clients),
+            "users": len(self.by_user),
+            "lagging": sum(1 for client in clients if client["lag_seconds"] > self.lag_threshold),
+            "evicted": self.evicted,
+            "reaped": self.reaped,
+            "rejected": self.rejected,
+            "seq": self.seq,
+            "viewports": self.viewports.stats(),
+            "clients": clients,
+        }
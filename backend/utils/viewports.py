@@ -0,0 +1,159 @@
+import math
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+# Map viewports registered by tracking clients, indexed so that a bus fix can
+# be matched to the viewports containing it without looking at every client.
+# A viewport is registered in the cells of a lat/lng grid whose resolution
+# follows its zoom level (cells are the size of a map tile at that zoom, 360 /
+# 2**zoom degrees), so a zoomed-in client covers a handful of small cells and
+# a zoomed-out one a handful of large ones. A fix looks up its cell at each
+# zoom level in use and checks only the viewports registered there.
+#
+# Every bus remembers which viewports it is currently inside, so a move
+# reports the viewports it entered, left, and stayed in.
+
+MAX_ZOOM = 22
+MAX_CELLS = 64  # Per viewport; a coarser level is used beyond this
+
+Cell = Tuple[int, int]
+
+
+class Viewport:
+    __slots__ = ("south", "west", "north", "east", "zoom", "cells", "inside")
+
+    def __init__(self, south: float, west: float, north: float, east: float, zoom: int):
+        self.south = south
+        self.west = west
+        self.north = north
+        self.east = east
+        self.zoom = zoom
+        self.cells: List[Cell] = []
+        self.inside: Set[int] = set()
+
+    def contains(self, lat: float, lng: float) -> bool:
+        return self.south <= lat <= self.north and self.west <= lng <= self.east
+
+    def to_dict(self) -> Dict[str, object]:
+        return {"bbox": [self.south, self.west, self.north, self.east], "zoom": self.zoom}
+
+
+def cell_of(zoom: int, lat: float, lng: float) -> Cell:
+    degrees = 360.0 / (1 << zoom)
+    return math.floor((lat + 90.0) / degrees), math.floor((lng + 180.0) / degrees)
+
+
+class ViewportIndex:
+    def __init__(self):
+        self.viewports: Dict[Hashable, Viewport] = {}
+        # zoom -> cell -> clients registered there
+        self._cells: Dict[int, Dict[Cell, Set[Hashable]]] = {}
+        # bus_id -> clients whose viewport it is inside
+        self._viewers: Dict[int, Set[Hashable]] = {}
+
+    def __len__(self) -> int:
+        return len(self.viewports)
+
+    def __contains__(self, client: Hashable) -> bool:
+        return client in self.viewports
+
+    def get(self, client: Hashable) -> Optional[Viewport]:
+        return self.viewports.get(client)
+
+    def sees(self, client: Hashable, bus_id: int) -> bool:
+        viewport = self.viewports.get(client)
+        return viewport is not None and bus_id in viewport.inside
+
+    # --- Registration ---
+    def set(self, client: Hashable, south: float, west: float, north: float, east: float, zoom: Optional[int],
+            positions: Iterable[Tuple[int, float, float]]) -> Tuple[List[int], List[int]]:
+        # Register or replace a client's viewport; positions are the current
+        # (bus_id, lat, lng) of every bus. Returns the buses that entered and
+        # left the client's view.
+        if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+            raise ValueError("Invalid bounding box")
+        previous = self._unregister(client)
+        if zoom is None:
+            # The zoom at which the box spans about one tile
+            span = max(north - south, east - west, 1e-9)
+            zoom = int(math.floor(math.log2(360.0 / span)))
+        zoom = min(max(int(zoom), 0), MAX_ZOOM)
+        while zoom > 0 and self._cell_count(zoom, south, west, north, east) > MAX_CELLS:
+            zoom -= 1
+        viewport = Viewport(south, west, north, east, zoom)
+        (row1, column1), (row2, column2) = cell_of(zoom, south, west), cell_of(zoom, north, east)
+        cells = self._cells.setdefault(zoom, {})
+        for row in range(row1, row2 + 1):
+            for column in range(column1, column2 + 1):
+                viewport.cells.append((row, column))
+                cells.setdefault((row, column), set()).add(client)
+        self.viewports[client] = viewport
+        for bus_id, lat, lng in positions:
+            if viewport.contains(lat, lng):
+                viewport.inside.add(bus_id)
+                self._viewers.setdefault(bus_id, set()).add(client)
+        old_inside = previous.inside if previous is not None else set()
+        return sorted(viewport.inside - old_inside), sorted(old_inside - viewport.inside)
+
+    @staticmethod
+    def _cell_count(zoom: int, south: float, west: float, north: float, east: float) -> int:
+        (row1, column1), (row2, column2) = cell_of(zoom, south, west), cell_of(zoom, north, east)
+        return (row2 - row1 + 1) * (column2 - column1 + 1)
+
+    def remove(self, client: Hashable) -> List[int]:
+        # Drop a client's viewport; returns the buses that were in view
+        viewport = self._unregister(client)
+        return sorted(viewport.inside) if viewport is not None else []
+
+    def _unregister(self, client: Hashable) -> Optional[Viewport]:
+        viewport = self.viewports.pop(client, None)
+        if viewport is None:
+            return None
+        cells = self._cells[viewport.zoom]
+        for cell in viewport.cells:
+            clients = cells[cell]
+            clients.discard(client)
+            if not clients:
+                del cells[cell]
+        if not cells:
+            del self._cells[viewport.zoom]
+        for bus_id in viewport.inside:
+            viewers = self._viewers.get(bus_id)
+            if viewers is not None:
+                viewers.discard(client)
+                if not viewers:
+                    del self._viewers[bus_id]
+        return viewport
+
+    # --- Matching ---
+    def moved(self, bus_id: int, lat: float, lng: float) -> Tuple[Set[Hashable], Set[Hashable], Set[Hashable]]:
+        # Returns the clients the bus entered, left, and stayed inside of
+        now: Set[Hashable] = set()
+        for zoom, cells in self._cells.items():
+            for client in cells.get(cell_of(zoom, lat, lng), ()):
+                if self.viewports[client].contains(lat, lng):
+                    now.add(client)
+        before = self._viewers.get(bus_id, set())
+        entered, left = now - before, before - now
+        for client in entered:
+            self.viewports[client].inside.add(bus_id)
+        for client in left:
+            self.viewports[client].inside.discard(bus_id)
+        if now:
+            self._viewers[bus_id] = now
+        else:
+            self._viewers.pop(bus_id, None)
+        return entered, left, now & before
+
+    def forget(self, bus_id: int) -> Set[Hashable]:
+        # The bus is gone; returns the clients it was in view of
+        viewers = self._viewers.pop(bus_id, set())
+        for client in viewers:
+            self.viewports[client].inside.discard(bus_id)
+        return viewers
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "viewports": len(self.viewports),
+            "zoom_levels": sorted(self._cells),
+            "cells": sum(len(cells) for cells in self._cells.values()),
+        }
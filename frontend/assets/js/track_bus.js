@@ -72,8 +72,8 @@ document.addEventListener('DOMContentLoaded', () => {
                 map: map,
             });
 
-            // Start fetching real-time location updates
-            setInterval(fetchBusLocation, 10000); // Every 10 seconds
+            // Start receiving real-time location updates
+            streamBusLocation();
 
         } catch (error) {
             console.error('Error initializing map or fetching bus details:', error);
@@ -82,33 +82,101 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     };
 
+    // Long-poll: the server holds the request until the bus moves past the
+    // version we already have (or 25 seconds pass and it answers 304)
+    let locationVersion = null;
+
+    const showBusLocation = (data) => {
+        if (!busMarker.getMap()) {
+            busMarker.setMap(map);
+        }
+        busMarker.setPosition({ lat: data.lat, lng: data.lng });
+        map.setCenter({ lat: data.lat, lng: data.lng });
+        busSpeedSpan.textContent = data.speed;
+        etaSpan.textContent = data.estimated_arrival;
+    };
+
+    // The trip ended or the bus was removed: take it off the map until it
+    // reports a position again
+    const hideBusLocation = () => {
+        busMarker.setMap(null);
+        busSpeedSpan.textContent = '-';
+        etaSpan.textContent = 'Not running';
+    };
+
     const fetchBusLocation = async () => {
         const token = localStorage.getItem('access_token');
         if (!token) {
             window.location.href = '../login/student.html';
-            return;
+            return false;
         }
         try {
-            const response = await fetch(`http://localhost:8000/tracking/bus/${busId}`, {
+            const query = locationVersion === null ? '' : `?since=${locationVersion}&wait=25`;
+            const response = await fetch(`http://localhost:8000/tracking/bus/${busId}${query}`, {
                 headers: {
                     'Authorization': `Bearer ${token}`,
                 },
             });
+            if (response.status === 304) {
+                return true;
+            }
+            if (response.status === 404) {
+                // Not tracking (any more); check again after the back-off
+                locationVersion = null;
+                hideBusLocation();
+                return false;
+            }
             if (!response.ok) {
                 throw new Error('Failed to fetch bus location');
             }
             const data = await response.json();
-            
-            busMarker.setPosition({ lat: data.lat, lng: data.lng });
-            map.setCenter({ lat: data.lat, lng: data.lng });
-            busSpeedSpan.textContent = data.speed;
-            etaSpan.textContent = data.estimated_arrival;
+            locationVersion = data.seq;
+            showBusLocation(data);
+            return true;
 
         } catch (error) {
             console.error('Error fetching bus location:', error);
+            return false;
         }
     };
 
+    const pollBusLocation = async () => {
+        const ok = await fetchBusLocation();
+        // Back off for 10 seconds after an error, otherwise ask again right away
+        setTimeout(pollBusLocation, ok ? 0 : 10000);
+    };
+
+    // Prefer a server-sent event stream (the browser reconnects and resumes
+    // by itself); fall back to long-polling if the stream cannot be opened.
+    // Both "location" and "remove" events carry an id of <epoch>:<seq>, which
+    // the browser sends back as Last-Event-ID, so a reconnect neither replays
+    // a removal nor misses a trip that started meanwhile.
+    const streamBusLocation = () => {
+        const token = localStorage.getItem('access_token');
+        if (!window.EventSource || !token) {
+            pollBusLocation();
+            return;
+        }
+        let opened = false;
+        const source = new EventSource(`http://localhost:8000/tracking/bus/${busId}/stream?token=${encodeURIComponent(token)}`);
+        source.onopen = () => { opened = true; };
+        source.addEventListener('location', (event) => {
+            const data = JSON.parse(event.data);
+            locationVersion = data.seq;
+            showBusLocation(data);
+        });
+        source.addEventListener('remove', (event) => {
+            locationVersion = Number(event.lastEventId.split(':')[1]);
+            hideBusLocation();
+        });
+        source.onerror = () => {
+            if (!opened) {
+                source.close();
+                pollBusLocation();
+            }
+        };
+    };
+
     logoutBtn.addEventListener('click', () => {
         localStorage.removeItem('access_token');
         localStorage.removeItem('user_role');